@@ -5,13 +5,17 @@ import datetime
 import os
 import sys
 import collections
+import io
+import csv
 
 import handler
 import db
 import util
 import settings
 import leaderboard
+import ratings
 import scores
+import importgames
 
 class AdminPanelHandler(handler.BaseHandler):
     @handler.is_admin
@@ -108,21 +112,27 @@ class DeleteGameHandler(handler.BaseHandler):
         else:
             self.render("deletegame.html", id=q, game=game)
     @handler.is_admin
-    def post(self, q):
-        gamedate = None
-        with db.getCur() as cur:
-            cur.execute("SELECT Date FROM Scores WHERE GameId = ?", (q,))
-            gamedate = cur.fetchone()
-            if gamedate is not None:
-                gamedate = gamedate[0]
-                db.make_backup()
-                cur.execute("DELETE FROM Scores WHERE GameId = ?", (q,))
+    async def post(self, q):
+        gamedate = await db.run(deleteGame, q)
         if gamedate is not None:
-            leaderboard.genLeaderboard(gamedate)
             self.redirect("/history")
         else:
             self.render("message.html", message = "Game not found", title = "Delete Game")
 
+def deleteGame(gameid):
+    """Delete a game and update the leaderboards and rating history.
+    Returns the date of the deleted game or None if it wasn't found."""
+    with db.getCur() as cur:
+        cur.execute("SELECT Date FROM Scores WHERE GameId = ?", (gameid,))
+        gamedate = cur.fetchone()
+        if gamedate is not None:
+            gamedate = gamedate[0]
+            cur.execute("DELETE FROM Scores WHERE GameId = ?", (gameid,))
+    if gamedate is not None:
+        leaderboard.scheduleLeaderboard(gamedate)
+        ratings.scheduleRatingHistory(gamedate)
+    return gamedate
+
 class EditGameHandler(handler.BaseHandler):
     @handler.is_admin
     def get(self, q):
@@ -146,7 +156,7 @@ class EditGameHandler(handler.BaseHandler):
                             unusedPoints=unusedPoints,
                             unusedPointsIncrement=unusedPointsIncrement)
     @handler.is_admin_ajax
-    def post(self, q):
+    async def post(self, q):
         gamescores = self.get_argument('scores', None)
         gamedate = self.get_argument('gamedate', None)
 
@@ -160,8 +170,8 @@ class EditGameHandler(handler.BaseHandler):
                 return
             gameid = row[0]
 
-        db.make_backup()
-        self.write(json.dumps(scores.addGame(gamescores, gamedate, gameid)))
+        self.write(json.dumps(
+            await db.run(scores.addGame, gamescores, gamedate, gameid)))
 
 quarterFields = db.table_field_names('Quarters')
 
@@ -232,7 +242,7 @@ class EditQuarterHandler(handler.BaseHandler):
                         quarters=[])
 
         finally:
-            leaderboard.genLeaderboard(scores.quarterDate(quarter))
+            leaderboard.scheduleLeaderboard(scores.quarterDate(quarter))
 
             self.render("message.html",
                         message = "Quarter {0} updated".format(quarter),
@@ -312,13 +322,62 @@ class DeleteQuarterHandler(handler.BaseHandler):
                         title = "Quarter Deleted",
                         next = "Manage quarters",
                         next_url = "/admin/quarters")
-            leaderboard.genLeaderboard(scores.quarterDate(q))
+            leaderboard.scheduleLeaderboard(scores.quarterDate(q))
         else:
             self.render("quarters.html",
                         message = ("Error: Multiple quarters named {0} "
                                    "found. See Adminstrator.").format(q),
                         quarters=rows)
 
+class ImportGamesHandler(handler.BaseHandler):
+    @handler.is_admin
+    def get(self):
+        self.render("importgames.html", message = "", results = [])
+    @handler.is_admin
+    async def post(self):
+        files = self.request.files.get('games', [])
+        if len(files) == 0:
+            return self.render("importgames.html", results = [],
+                               message = "Please choose a file to import")
+        upload = files[0]
+        fmt = self.get_argument('format', None) or (
+            'json' if upload['filename'].lower().endswith(('.json', '.ndjson'))
+            else 'csv')
+        try:
+            games = list(importgames.read_games(
+                io.TextIOWrapper(io.BytesIO(upload['body']),
+                                 encoding='utf-8', newline=''), fmt))
+        except (ValueError, csv.Error) as e:
+            return self.render("importgames.html", results = [],
+                               message = "Unable to read {}: {}".format(
+                                   upload['filename'], e))
+        dryRun = self.get_argument('dryrun', None) is not None
+        result = await db.run(
+            importgames.import_games, games,
+            skipInvalid = self.get_argument('skip', None) is not None,
+            dryRun = dryRun)
+        message = result.get('error', "{} of {} games {}".format(
+            len(result['results']) - sum(
+                1 for game in result['results'] if game['status'] != 0),
+            len(result['results']),
+            "are valid" if dryRun else "imported"))
+        self.render("importgames.html", message = message,
+                    results = result['results'])
+
+class QueryStatsHandler(handler.BaseHandler):
+    @handler.is_admin
+    def get(self):
+        limit = self.get_argument('limit', '50')
+        queries = db.query_stats()
+        self.render("querystats.html",
+                    queries=queries[:int(limit) if limit.isdigit() else 50],
+                    total=sum(q['seconds'] for q in queries),
+                    buckets=db.queryBuckets, enabled=settings.QUERYSTATS)
+    @handler.is_admin
+    def post(self):
+        db.reset_query_stats()
+        self.redirect("/admin/queries")
+
 def getSettingsDescriptions():
     descriptions = collections.defaultdict(lambda : '')
     prefix = "#   "
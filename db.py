@@ -9,10 +9,20 @@ import sqlite3
 import datetime
 import re
 import collections
-import shutil
 import os
 import logging
 import argparse
+import threading
+import json
+import time
+import functools
+import concurrent.futures
+import contextvars
+import bisect
+import zlib
+
+import tornado.ioloop
+import tornado.locks
 
 import util
 import settings
@@ -20,21 +30,443 @@ from sqlite_schema import *
 
 log = logging.getLogger("WebServer")
 
+# Count of committed modifications to each table made through getCur.
+# Caches of data derived from tables compare these counts to determine
+# when they need to be rebuilt (see tableVersion).
+tableVersions = collections.Counter()
+tableVersionsLock = threading.Lock()
+
+def tableVersion(*tables):
+    "Return a tuple of the modification counts for the given tables"
+    with tableVersionsLock:
+        return tuple(tableVersions[table.lower()] for table in tables)
+
+# Handlers run slow database work, like rebuilding leaderboards, on this
+# pool of threads so other requests are served while it runs (see run)
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.DBTHREADS, thread_name_prefix='db')
+executorSlots = tornado.locks.Semaphore(settings.DBQUEUESIZE)
+
+async def run(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) on the database thread pool and return its
+    result, e.g. board = await db.run(leaderboard.genLeaderboard, date).
+    At most DBQUEUESIZE calls are queued or running at once; later callers
+    wait for one of them to finish before queuing their work."""
+    context = contextvars.copy_context() # Keep queryTag of the caller
+    async with executorSlots:
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            executor, functools.partial(context.run, fn, *args, **kwargs))
+
+def fetch_rows(query, bindings=()):
+    "Execute a query and return all of its rows"
+    with getCur() as cur:
+        cur.execute(query, bindings)
+        return cur.fetchall()
+
+async def stream(query, bindings=()):
+    """Execute a query that only reads the database and generate its rows
+    asynchronously, e.g. async for row in db.stream(query): ...
+    The rows are fetched on the database threads, DBFETCHROWS at a time,
+    as they are needed, so a handler can write them to the client as they
+    are read without holding them all or blocking the IOLoop.  The query
+    has a connection of its own, which the threads take turns using."""
+    con = sqlite3.connect(settings.DBFILE, check_same_thread=False)
+    try:
+        con.execute("PRAGMA query_only = 1")
+        cur = con.cursor(
+            factory=statsCursor if settings.QUERYSTATS else loggingCursor)
+        await run(cur.execute, query, bindings)
+        while True:
+            rows = await run(cur.fetchmany, settings.DBFETCHROWS)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        cur.close()
+    finally:
+        con.close()
+
+# Named statements for the busiest queries.  Their SQL is built once, when
+# the module using them loads, and is fully parameterized, so each use
+# finds it already prepared in the connection's statement cache.
+# check_statements validates them all when the server starts.
+statements = {}
+
+def statement(name, sql, scans=()):
+    """Register a named statement and return its SQL.  scans lists the
+    tables it is expected to read in full"""
+    statements[name] = (sql, scans)
+    return sql
+
+namedParameter = re.compile(r'(?<![\w:]):(\w+)')
+fullScan = re.compile(r'SCAN (\w+)$')
+
+def check_statements():
+    """Prepare every registered statement and check its query plan, so
+    one that doesn't fit the schema fails when the server starts instead
+    of when it's first used.  Full scans of tables a statement isn't
+    expected to scan are logged as warnings.  Returns the query plan steps
+    of each statement by name."""
+    plans = {}
+    tables = set(table.lower() for table in schema)
+    con = sqlite3.connect(settings.DBFILE)
+    try:
+        for name, (sql, scans) in statements.items():
+            names = namedParameter.findall(sql)
+            bindings = dict.fromkeys(names) if names else (
+                [None] * sql.count('?'))
+            try:
+                steps = [row[-1] for row in con.execute(
+                    "EXPLAIN QUERY PLAN " + sql, bindings)]
+            except sqlite3.Error as e:
+                raise Exception('Invalid {0} statement: {1}'.format(name, e))
+            plans[name] = steps
+            log.debug('Query plan of {0}: {1}'.format(name, '; '.join(steps)))
+            for step in steps:
+                match = fullScan.match(step)
+                if (match and match.group(1).lower() in tables and
+                    match.group(1).lower() not in
+                    [table.lower() for table in scans]):
+                    log.warning('The {0} statement scans all of {1}'.format(
+                        name, match.group(1)))
+    finally:
+        con.close()
+    return plans
+
+# Modifications to these tables are recorded in the change log so the
+# database can be restored to any point in time from a full backup (see
+# restore.py).  This includes the user accounts, administrators, and user
+# settings.  Of the other tables, Leaderboards and RatingHistory are
+# derived from these, and the rest hold transient data like links,
+# queued email, timers, and the current seating.
+changeLogTables = ('players', 'scores', 'memberships', 'quarters', 'users',
+                   'admins', 'settings')
+changeLogEnabled = True
+changeLogLock = threading.Lock()
+
+def changeLogFile(dbfile=None):
+    "Return the path of the change log for the database"
+    return os.path.join(settings.DBBACKUPS,
+                        os.path.split(dbfile or settings.DBFILE)[1] + '.changes')
+
+# Each thread keeps its connection open between uses of getCur, so the
+# statements it has prepared stay in its statement cache.  A getCur used
+# inside another on the same thread gets a connection of its own.
+connections = threading.local()
+
+def connection(user):
+    """Return this thread's open connection to the database for a getCur,
+    or a new one if it is in use, the database setting changed, or the file
+    was replaced, e.g. by a migration"""
+    try:
+        key = (settings.DBFILE, os.stat(settings.DBFILE).st_ino)
+    except OSError:
+        key = (settings.DBFILE, None)
+    con = getattr(connections, 'con', None)
+    if con is not None and getattr(connections, 'user', None):
+        con = sqlite3.connect(settings.DBFILE,
+                              cached_statements=settings.DBCACHEDSTATEMENTS)
+        con.set_authorizer(user.authorizer)
+        return con
+    if con is None or connections.key != key:
+        if con is not None:
+            con.close()
+        con = sqlite3.connect(settings.DBFILE,
+                              cached_statements=settings.DBCACHEDSTATEMENTS)
+        # Changing the authorizer expires the prepared statements, so the
+        # kept connection's authorizer calls that of its current user
+        con.set_authorizer(keptAuthorizer)
+        connections.con, connections.key = con, key
+    connections.user = user
+    return con
+
+def keptAuthorizer(*args):
+    user = getattr(connections, 'user', None)
+    return user.authorizer(*args) if user else sqlite3.SQLITE_OK
+
+def release(con, failed):
+    """Finish with a connection from connection(), rolling back any
+    changes if failed.  Only this thread's kept connection stays open."""
+    if failed:
+        con.rollback()
+    if con is getattr(connections, 'con', None):
+        connections.user = None
+    else:
+        con.close()
+
+# The tables modified by each statement that modifies any.  The authorizer
+# only sees statements when they are prepared, not when they are reused
+# from the statement cache, so these are remembered by their SQL.  Only
+# statements that modify tables are kept, and they are few enough that
+# none need to be forgotten.
+statementTables = {}
+
 class getCur():
     con = None
     cur = None
     def __enter__(self):
-        self.con = sqlite3.connect(settings.DBFILE)
-        self.cur = self.con.cursor()
+        self.written = set()
+        self.changes = []
+        self.preparedTables = set()
+        self.onCommit = [] # Functions to call after committing
+        self.con = connection(self)
+        self.cur = self.con.cursor(
+            factory=statsCursor if settings.QUERYSTATS else loggingCursor)
+        self.cur.getCur = self
         self.cur.execute("PRAGMA foreign_keys = 1;")
         return self.cur
     def __exit__(self, type, value, traceback):
+        if self.con and value:
+            release(self.con, True)
         if self.cur and self.con and not value:
             self.cur.close()
-            self.con.commit()
-            self.con.close()
+            try:
+                if self.changes and changeLogEnabled:
+                    self.log_changes()
+                self.con.commit()
+            except:
+                release(self.con, True)
+                raise
+            release(self.con, False)
+            if self.written:
+                with tableVersionsLock:
+                    for table in self.written:
+                        tableVersions[table] += 1
+            if self.changes and changeLogEnabled:
+                snapshot_if_due()
+            for fn in self.onCommit:
+                fn()
 
         return False
+    def authorizer(self, action, arg1, arg2, dbname, source):
+        "Record names of tables modified by statements being prepared"
+        if action in (sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+                      sqlite3.SQLITE_DELETE):
+            self.preparedTables.add(arg1.lower())
+        return sqlite3.SQLITE_OK
+    def wrote(self, sql):
+        """Record the tables modified by the statement just executed and
+        return whether any of them are in changeLogTables"""
+        if self.preparedTables:
+            statementTables[sql] = tables = self.preparedTables
+        else:
+            tables = statementTables.get(sql, ())
+        self.written.update(tables)
+        return any(table in changeLogTables for table in tables)
+    def log_changes(self):
+        """Append the logged changes of this transaction to the change log
+        before they are committed.  The change log entry's sequence number
+        is stored as the database's user_version in the same transaction,
+        so each database file, including backups, records how much of the
+        log it contains."""
+        cur = self.con.cursor()
+        cur.execute("PRAGMA user_version")
+        sequence = cur.fetchone()[0] + 1
+        entry = json.dumps({
+            'seq': sequence,
+            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'changes': self.changes})
+        if not os.path.isdir(settings.DBBACKUPS):
+            os.mkdir(settings.DBBACKUPS)
+        with changeLogLock, open(changeLogFile(), 'a') as log:
+            log.write(entry + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        cur.execute("PRAGMA user_version = {0}".format(sequence))
+        cur.close()
+
+class loggingCursor(sqlite3.Cursor):
+    """Cursor that records the statements (and their parameters) that
+    modify tables in changeLogTables for the change log of its getCur, if
+    it has one.  It also adds the time spent executing statements and
+    in its fetch methods to the queryTimer, e.g. for the request metrics.
+    Rows read by iterating over the cursor aren't timed, so that stays
+    fast; statsCursor times them too."""
+    getCur = None
+    def execute(self, sql, parameters=()):
+        if self.getCur:
+            self.getCur.preparedTables = set()
+        start = time.perf_counter()
+        result = super().execute(sql, parameters)
+        self.timed(start)
+        if self.getCur and self.getCur.wrote(sql):
+            self.getCur.changes.append({'sql': sql, 'params': parameters})
+        return result
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if self.getCur:
+            self.getCur.preparedTables = set()
+        start = time.perf_counter()
+        result = super().executemany(sql, seq_of_parameters)
+        self.timed(start)
+        if self.getCur and self.getCur.wrote(sql):
+            self.getCur.changes.append({'sql': sql, 'many': seq_of_parameters})
+        return result
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.timed(start)
+        return row
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self.timed(start)
+        return rows
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.timed(start)
+        return rows
+    def timed(self, start):
+        "Add the seconds since start to the queryTimer"
+        timer = queryTimer.get()
+        if timer is not None:
+            timer[0] += time.perf_counter() - start
+
+# Name of what is running queries, e.g. the request handler, for the query
+# statistics
+queryTag = contextvars.ContextVar('queryTag', default=None)
+# A list whose first element accumulates the seconds spent in queries,
+# e.g. for the current request
+queryTimer = contextvars.ContextVar('queryTimer', default=None)
+
+# Upper bounds in seconds of the query latency histogram buckets.  The
+# last bucket holds all slower queries.
+queryBuckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+queryStats = {}
+queryStatsLock = threading.Lock()
+
+class statsCursor(loggingCursor):
+    """Cursor that also measures the time spent executing each statement
+    and fetching its results, and counts the rows returned or modified,
+    for the query statistics"""
+    statement = None
+    def timed(self, start):
+        pass # record_query adds the statement's time to the queryTimer
+    def execute(self, sql, parameters=()):
+        self.finish_statement()
+        self.statement = {'sql': sql, 'params': parameters, 'seconds': 0.0,
+                          'rows': 0}
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.statement['seconds'] += time.perf_counter() - start
+            self.statement['rows'] += max(0, self.rowcount)
+    def executemany(self, sql, seq_of_parameters):
+        self.finish_statement()
+        seq_of_parameters = list(seq_of_parameters)
+        self.statement = {'sql': sql, 'params': seq_of_parameters[0]
+                          if seq_of_parameters else (),
+                          'seconds': 0.0, 'rows': 0}
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.statement['seconds'] += time.perf_counter() - start
+            self.statement['rows'] += max(0, self.rowcount)
+    def fetched(self, start, rows):
+        if self.statement:
+            self.statement['seconds'] += time.perf_counter() - start
+            self.statement['rows'] += rows
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(start, 0)
+            self.finish_statement()
+            raise
+        self.fetched(start, 1)
+        return row
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(start, 0 if row is None else 1)
+        return row
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self.fetched(start, len(rows))
+        return rows
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(start, len(rows))
+        self.finish_statement()
+        return rows
+    def close(self):
+        self.finish_statement()
+        super().close()
+    def finish_statement(self):
+        if self.statement:
+            record_query(self.statement['sql'], self.statement['params'],
+                         self.statement['seconds'], self.statement['rows'])
+            self.statement = None
+
+literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+placeholder_lists = re.compile(r'\?(?:\s*,\s*\?)+')
+
+@functools.lru_cache(maxsize=1024)
+def query_template(sql):
+    """Reduce a SQL statement to a template that is the same for all its
+    variations of literal values, placeholder counts, and whitespace"""
+    return placeholder_lists.sub(
+        '?, ...', literals.sub('?', ' '.join(sql.split())))
+
+def record_query(sql, parameters, seconds, rows):
+    """Add the time and row count of a statement to the query statistics
+    of its template and tag, and log it if it took at least
+    SLOWQUERYSECONDS"""
+    key = (queryTag.get() or threading.current_thread().name,
+           query_template(sql))
+    with queryStatsLock:
+        stats = queryStats.get(key)
+        if stats is None:
+            stats = queryStats[key] = {
+                'tag': key[0], 'template': key[1], 'count': 0,
+                'seconds': 0.0, 'max': 0.0, 'rows': 0,
+                'histogram': [0] * (len(queryBuckets) + 1)}
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        stats['rows'] += rows
+        stats['histogram'][bisect.bisect_left(queryBuckets, seconds)] += 1
+    timer = queryTimer.get()
+    if timer is not None:
+        timer[0] += seconds
+    if seconds >= settings.SLOWQUERYSECONDS:
+        log.warning("Slow query from {0} took {1:.3f} seconds for {2} rows: "
+                    "{3} {4}\n{5}".format(
+                        key[0], seconds, rows, ' '.join(sql.split()),
+                        parameters, explain_query_plan(sql, parameters)))
+
+def explain_query_plan(sql, parameters=()):
+    "Return SQLite's query plan for a statement as indented lines of text"
+    con = sqlite3.connect(settings.DBFILE)
+    try:
+        depth = {0: 0}
+        lines = []
+        for id, parent, notused, detail in con.execute(
+                "EXPLAIN QUERY PLAN " + sql, parameters):
+            depth[id] = depth.get(parent, 0) + 1
+            lines.append('  ' * depth[id] + detail)
+        return '\n'.join(lines)
+    except sqlite3.Error as e:
+        return '  (No query plan: {0})'.format(e)
+    finally:
+        con.close()
+
+def query_stats():
+    "Return the query statistics sorted by total time, slowest first"
+    with queryStatsLock:
+        stats = [dict(s, histogram=list(s['histogram']))
+                 for s in queryStats.values()]
+    return sorted(stats, key=lambda s: s['seconds'], reverse=True)
+
+def reset_query_stats():
+    with queryStatsLock:
+        queryStats.clear()
 
 schema = collections.OrderedDict({
     'Players': [
@@ -55,7 +487,8 @@ schema = collections.OrderedDict({
         'Chombos INTEGER',
         'Quarter TEXT',
         'DeltaRating REAL',
-        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE'
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'CREATE INDEX Scores_GameId ON Scores(GameId)'
     ],
     'CurrentPlayers': [
         'PlayerId INTEGER PRIMARY KEY',
@@ -119,7 +552,9 @@ schema = collections.OrderedDict({
         'GameCount INTEGER',
         'DropGames INTEGER',
         'DateCount INTEGER',
-        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE'
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'CREATE INDEX Leaderboards_Period_Date'
+        ' ON Leaderboards(Period, Date, Place)'
     ],
     'Memberships': [
         'PlayerId INTEGER',
@@ -128,38 +563,296 @@ schema = collections.OrderedDict({
         'FOREIGN KEY(QuarterId) REFERENCES Quarters(Quarter) ON DELETE CASCADE',
         'UNIQUE(PlayerId, QuarterId)'
     ],
+    'RatingHistory': [
+        'PlayerId INTEGER',
+        'Date DATE',
+        'Rating REAL',
+        'GameCount INTEGER',
+        'FOREIGN KEY(PlayerId) REFERENCES Players(Id) ON DELETE CASCADE',
+        'UNIQUE(PlayerId, Date)'
+    ],
+    'Outbox': [
+        'Id INTEGER PRIMARY KEY AUTOINCREMENT',
+        'Recipient TEXT NOT NULL',
+        'Sender TEXT',
+        'Subject TEXT',
+        'Body TEXT',
+        'MimeType TEXT',
+        'Queued DATETIME',
+        'Attempts INTEGER DEFAULT 0',
+        'NextAttempt REAL',
+        'Error TEXT',
+        'CREATE INDEX Outbox_NextAttempt ON Outbox(NextAttempt)'
+    ],
 })
 
 def init(force=False, dbfile=settings.DBFILE, verbose=0):
-    existing_schema = get_sqlite_db_schema(dbfile)
-    desired_schema = parse_database_schema(schema)
-
-    if not compare_and_prompt_to_upgrade_database(
-            desired_schema, existing_schema, dbfile,
-            ordermatters=False, prompt_prefix='SCHEMA CHANGE: ',
-            force_response='y' if force else None,
-            backup_dir=settings.DBBACKUPS,
-            backup_prefix=settings.DBDATEFORMAT + '-', verbose=verbose):
-        log.error('Database upgrade during initialization {}.'.format(
-            'failed' if force else 'was either cancelled or failed'))
-
-def make_backup():
+    # The database's application_id holds the fingerprint of the schemas
+    # from the last time they were found to match.  Comparing them in full
+    # is slow, so it is only done when the fingerprint changes.
+    sequence = user_version(dbfile)
+    stored = application_id(dbfile)
+    original = schema_fingerprint(dbfile)
+    current = original == stored
+    if not current:
+        existing_schema = get_sqlite_db_schema(dbfile)
+        desired_schema = parse_database_schema(schema)
+        if not compare_and_prompt_to_upgrade_database(
+                desired_schema, existing_schema, dbfile,
+                ordermatters=False, prompt_prefix='SCHEMA CHANGE: ',
+                force_response='y' if force else None,
+                backup_dir=settings.DBBACKUPS,
+                backup_prefix=settings.DBDATEFORMAT + '-', verbose=verbose,
+                progress=log_migration_progress):
+            log.error('Database upgrade during initialization {}.'.format(
+                'failed' if force else 'was either cancelled or failed'))
+        current = schema_is_current(desired_schema, dbfile)
+
+    # Write ahead logging lets readers, including backups, proceed while
+    # another connection writes.  The mode persists in the database file.
+    # Migrations copy the data to a new database, so restore the change
+    # log sequence number after them
+    migrated = user_version(dbfile) != sequence
+    fingerprint = schema_fingerprint(dbfile)
+    with sqliteCur(DBfile=dbfile) as cur:
+        cur.execute("PRAGMA journal_mode = WAL")
+        if migrated:
+            cur.execute("PRAGMA user_version = {0}".format(sequence))
+        if current and fingerprint != stored:
+            cur.execute("PRAGMA application_id = {0}".format(fingerprint))
+
+    if dbfile == settings.DBFILE:
+        truncate_change_log(sequence)
+        # Changes are replayed on a backup with the same schema, so one is
+        # made after the schema changes and when none has the current schema.
+        # Wait for it after a change, so it completes even if this is a
+        # command line migration that exits next.
+        if fingerprint != original:
+            make_backup(wait=True)
+        elif not any(schema_fingerprint(backup) == fingerprint
+                     for backup in reversed(list_backups())):
+            make_backup()
+
+def log_migration_progress(table, copied, total):
+    log.info('Migrated {0} of {1} rows of {2}'.format(copied, total, table))
+
+def schema_fingerprint(dbfile):
+    """Return a 31-bit hash of the schema specification and the SQL that
+    created the tables and indices in a database file"""
+    with sqliteCur(DBfile=dbfile) as cur:
+        cur.execute("SELECT type, name, sql FROM sqlite_master"
+                    "  ORDER BY type, name")
+        actual = cur.fetchall()
+    return zlib.crc32(json.dumps([schema, actual]).encode()) & 0x7fffffff
+
+def schema_is_current(desired_schema, dbfile):
+    "Check that a database file has no differences from the desired schema"
+    delta = compare_db_schema(desired_schema, get_sqlite_db_schema(dbfile))
+    return upgrade_path(delta) == 'none'
+
+def application_id(dbfile):
+    "Return the schema fingerprint stored in a database file"
+    with sqliteCur(DBfile=dbfile) as cur:
+        cur.execute("PRAGMA application_id")
+        return cur.fetchone()[0]
+
+def user_version(dbfile):
+    "Return the change log sequence number stored in a database file"
+    with sqliteCur(DBfile=dbfile) as cur:
+        cur.execute("PRAGMA user_version")
+        return cur.fetchone()[0]
+
+def read_change_log(dbfile=None):
+    "Generate the entries in the change log of a database"
+    logfile = changeLogFile(dbfile)
+    if os.path.exists(logfile):
+        with open(logfile) as log:
+            for line in log:
+                if line.strip():
+                    yield json.loads(line)
+
+def last_change_log_entry(dbfile=None):
+    """Return the last entry in the change log of a database or None.  Only
+    the end of the file is read."""
+    logfile = changeLogFile(dbfile)
+    if not os.path.exists(logfile):
+        return None
+    chunks = []
+    with open(logfile, 'rb') as log:
+        end = log.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - 65536)
+            log.seek(start)
+            chunk = log.read(end - start)
+            end = start
+            if not chunks:
+                chunk = chunk.rstrip()
+                if not chunk:
+                    continue
+            newline = chunk.rfind(b'\n')
+            chunks.insert(0, chunk[newline + 1:])
+            if newline >= 0:
+                break
+    return json.loads(b''.join(chunks)) if chunks else None
+
+def truncate_change_log(sequence):
+    """Remove any entries after sequence from the change log.  These were
+    logged but never committed to the database.  Entries are logged in
+    sequence order, so the log is only rewritten if the last one is
+    uncommitted."""
+    with changeLogLock:
+        last = last_change_log_entry()
+        if last is not None and last['seq'] > sequence:
+            entries = list(read_change_log())
+            log.warning('Removing uncommitted entries from {0}'.format(
+                changeLogFile()))
+            with open(changeLogFile(), 'w') as logfile:
+                for entry in entries:
+                    if entry['seq'] <= sequence:
+                        logfile.write(json.dumps(entry) + '\n')
+
+def trim_change_log(sequence, dbfile=None):
+    """Remove the entries up to sequence from the change log of a database.
+    They are in every kept backup, so they are not needed to restore it."""
+    logfile = changeLogFile(dbfile)
+    with changeLogLock:
+        first = next(read_change_log(dbfile), None)
+        if first is None or first['seq'] > sequence:
+            return
+        log.info('Removing entries through {0} from {1}'.format(
+            sequence, logfile))
+        with open(logfile + '.tmp', 'w') as trimmed:
+            for entry in read_change_log(dbfile):
+                if entry['seq'] > sequence:
+                    trimmed.write(json.dumps(entry) + '\n')
+        os.replace(logfile + '.tmp', logfile)
+
+# Only one backup is made at a time
+backupLock = threading.Lock()
+
+def make_backup(wait=False):
+    """Back up the database to a timestamped file in the DBBACKUPS
+    directory.  The copy is made on a background thread with SQLite's
+    online backup API, DBBACKUPPAGES pages at a time, so callers don't
+    wait for it.  In WAL mode, the backup is of the database as it is
+    when this is called, even if other connections write to it before the
+    copy is complete.  Returns the backup thread, after it finishes if wait
+    is true.
+    """
     backupdb = datetime.datetime.now().strftime(settings.DBDATEFORMAT) + "-" + os.path.split(settings.DBFILE)[1]
     backupdb = os.path.join(settings.DBBACKUPS, backupdb)
+    prefix, copies = backupdb[:-len(os.path.split(settings.DBFILE)[1])], 1
+    # Don't replace other backups made in the same second
+    while os.path.exists(backupdb) or os.path.exists(backupdb + ".part"):
+        copies += 1
+        backupdb = "{0}{1}-{2}".format(prefix, copies,
+                                       os.path.split(settings.DBFILE)[1])
     log.info("Making backup of database {0} to {1}".format(
         settings.DBFILE, backupdb))
 
     if not os.path.isdir(settings.DBBACKUPS):
         os.mkdir(settings.DBBACKUPS)
-    shutil.copyfile(settings.DBFILE, backupdb)
+    global lastSnapshot
+    lastSnapshot = time.time()
+    source = sqlite3.connect(settings.DBFILE, check_same_thread=False,
+                             isolation_level=None)
+    if source.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+        # Start a read transaction to hold the current snapshot for the
+        # backup.  Without WAL, this would block writers until it's done.
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    thread = threading.Thread(target=backup_database,
+                              args=(source, backupdb),
+                              name="Backup " + backupdb, daemon=True)
+    thread.start()
+    if wait:
+        thread.join()
+    return thread
+
+def backup_database(source, backupdb, pages=None, keep=None):
+    """Copy the database open on the source connection to backupdb with
+    SQLite's online backup API, close the source, and prune old backups.
+    The copy is written to a temporary file that is renamed when complete,
+    so partial backups never have a backup file name."""
+    partial = backupdb + '.part'
+    with backupLock:
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                source.backup(target, sleep=0.001,
+                              pages=pages or settings.DBBACKUPPAGES)
+            finally:
+                target.close()
+                source.close()
+            os.replace(partial, backupdb)
+        except (sqlite3.Error, OSError) as e:
+            log.error("Backup to {0} failed: {1}".format(backupdb, e))
+            if os.path.exists(partial):
+                os.remove(partial)
+            return
+        prune_backups(os.path.dirname(backupdb),
+                      settings.DBBACKUPKEEP if keep is None else keep)
+
+def list_backups(backup_dir=None, dbfile=None):
+    """Return the paths of backups of the dbfile database in the
+    backup_dir directory, oldest first."""
+    backup_dir = backup_dir or settings.DBBACKUPS
+    suffix = "-" + os.path.split(dbfile or settings.DBFILE)[1]
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        (os.path.join(backup_dir, f) for f in os.listdir(backup_dir)
+         if f.endswith(suffix)),
+        key=os.path.getmtime)
+
+def prune_backups(backup_dir=None, keep=None, dbfile=None):
+    """Delete all but the most recent keep backups of the dbfile database
+    in the backup_dir directory, or none of them if keep is 0, and any
+    partial backups left by copies that never finished.  Change log
+    entries already in the oldest remaining backup are removed.  Call this
+    while holding backupLock, so no backup is in progress."""
+    keep = settings.DBBACKUPKEEP if keep is None else keep
+    backup_dir = backup_dir or settings.DBBACKUPS
+    suffix = "-" + os.path.split(dbfile or settings.DBFILE)[1] + ".part"
+    for partial in os.listdir(backup_dir) if os.path.isdir(backup_dir) else []:
+        if partial.endswith(suffix):
+            log.info("Removing partial database backup {0}".format(partial))
+            os.remove(os.path.join(backup_dir, partial))
+    backups = list_backups(backup_dir, dbfile)
+    if keep:
+        for backup in backups[:-keep]:
+            log.info("Removing old database backup {0}".format(backup))
+            os.remove(backup)
+        backups = backups[-keep:]
+    if backups:
+        trim_change_log(user_version(backups[0]), dbfile)
+
+# Time of the most recent full backup, found when first needed
+lastSnapshot = None
+
+def snapshot_if_due():
+    """Start a full backup if none has been made in the last DBSNAPSHOTDAYS.
+    Changes in between are kept in the change log."""
+    global lastSnapshot
+    if lastSnapshot is None:
+        backups = list_backups()
+        lastSnapshot = os.path.getmtime(backups[-1]) if backups else 0
+    if time.time() - lastSnapshot >= settings.DBSNAPSHOTDAYS * 24 * 60 * 60:
+        make_backup()
 
 def words(spec):
     return re.findall(r'\w+', spec)
 
 def table_field_names(tablename):
-    return [words(fs)[0] for fs in schema.get(tablename, [])
-            if not words(fs)[0].upper() in [
-                    'FOREIGN', 'UNIQUE', 'CONSTRAINT', 'PRIMARY', 'CHECK']]
+    return list(field_names(tablename))
+
+@functools.lru_cache(maxsize=None)
+def field_names(tablename):
+    "The field names of a table in the schema, which doesn't change"
+    return tuple(words(fs)[0] for fs in schema.get(tablename, [])
+                 if not words(fs)[0].upper() in [
+                         'FOREIGN', 'UNIQUE', 'CONSTRAINT', 'PRIMARY',
+                         'CHECK', 'CREATE'])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -19,6 +19,53 @@ DBBACKUPS = "backups"
 #   DBDATEFORMAT is datetime format string to use in naming the database
 #   backup files with their timestamp
 DBDATEFORMAT = "%Y-%m-%d-%H-%M-%S"
+#   DBBACKUPPAGES is the number of database pages copied in each step of
+#   a backup.  Writers can update the database between steps.
+DBBACKUPPAGES = 256
+#   DBBACKUPKEEP is the number of the most recent database backups to keep
+#   in the DBBACKUPS directory.  Older backups, and the change log entries
+#   they hold, are deleted after each new backup is made.  Set it to 0 to
+#   keep all backups.
+DBBACKUPKEEP = 100
+#   DBSNAPSHOTDAYS is the number of days between full backups of the
+#   database.  Changes to players, scores, memberships, quarters, and user
+#   accounts in between are recorded in a change log in the DBBACKUPS
+#   directory, so the database can be restored to any time with restore.py.
+DBSNAPSHOTDAYS = 7
+#   DBTHREADS is the number of threads that run slow database work, such
+#   as rebuilding leaderboards, for web requests.  DBQUEUESIZE limits how
+#   many of those calls may be queued or running at once.
+DBTHREADS = 4
+DBQUEUESIZE = 64
+#   DBCACHEDSTATEMENTS is the number of prepared statements each database
+#   connection keeps for reuse.  Connections are kept open by each thread.
+DBCACHEDSTATEMENTS = 256
+#   DBFETCHROWS is the number of rows fetched at a time on the database
+#   threads for responses that are written to the client as they are read,
+#   like exports and leaderboard data.
+DBFETCHROWS = 1000
+#   JOBDELAY is the number of seconds that background jobs, such as
+#   rebuilding leaderboards after a game is edited, wait before running.
+#   Further edits during the delay that need the same rebuild share it.
+JOBDELAY = 1.0
+#   QUERYSTATS is a flag that turns on collecting the time and row counts
+#   of every database query for the /admin/queries page.  Queries that take
+#   SLOWQUERYSECONDS or more are logged with their query plans.  Timing
+#   each row fetched slows down every query, so it is off unless needed.
+QUERYSTATS = False
+SLOWQUERYSECONDS = 0.25
+#   METRICSWINDOWS are the lengths in seconds of the sliding time windows
+#   over which request latency percentiles are reported at /metrics.
+#   METRICSSAMPLES is the most requests kept for each route to compute
+#   them; the oldest are dropped first.
+METRICSWINDOWS = (60, 300, 3600)
+METRICSSAMPLES = 10000
+#   STARTUPBUDGET is the most seconds the web server should take to import
+#   its modules and open the database.  startup.py checks it.
+STARTUPBUDGET = 2.0
+#   VERSIONCACHESECONDS is how long the commit information shown at
+#   /version and /version.json is kept before it is read from git again.
+VERSIONCACHESECONDS = 600
 #   DEVELOPERMODE is a flag that bypasses user authentication and makes
 #   every access be done as the first, administrative user.  Only set this
 #   to true when working on enhancing the code
@@ -91,6 +138,11 @@ EMAILUSETLS = True
 EMAILUSER = "email@address.com"
 EMAILFROM = "{0} <{1}>".format(CLUBNAME, EMAILUSER)
 EMAILPASSWORD = ""
+#   EMAILMAXATTEMPTS is the number of times to try sending an email before
+#   giving up on it.  The first retry waits EMAILRETRYDELAY seconds and
+#   each later one waits twice as long as the one before.
+EMAILMAXATTEMPTS = 6
+EMAILRETRYDELAY = 30
 #   LINKVALIDDAYS is the number of days links for invitations and
 #   password resets should remain valid.  They expire after LINKVALIDDAYS
 #   has passed.
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Export scores, games, and leaderboards as CSV or newline delimited JSON.
+Rows are streamed from the database a chunk at a time so memory use
+stays constant no matter how much is exported.  Scores and games can be filtered by
+date range and quarter.  Leaderboards can be filtered by period and by
+the range of their Date labels (e.g. 2019, 2019 1st).
+"""
+
+import sys
+import csv
+import io
+import json
+import argparse
+
+import tornado.web
+
+import db
+import handler
+import leaderboard
+import scores
+
+exports = {
+    'scores': {
+        'columns': ['GameId', 'Date', 'Quarter', 'PlayerId', 'Name', 'Rank',
+                    'PlayerCount', 'RawScore', 'Chombos', 'Score',
+                    'DeltaRating'],
+        'query': """SELECT Scores.GameId, Scores.Date, Scores.Quarter,
+              Scores.PlayerId, Players.Name, Scores.Rank, Scores.PlayerCount,
+              Scores.RawScore, Scores.Chombos, Scores.Score,
+              Scores.DeltaRating
+            FROM Scores JOIN Players ON Players.Id = Scores.PlayerId
+            {where}
+            ORDER BY Scores.Date, Scores.GameId, Scores.Rank""",
+        'date': 'Scores.Date',
+        'quarter': 'Scores.Quarter',
+    },
+    'games': {
+        'columns': ['GameId', 'Date', 'Quarter', 'PlayerCount', 'Players',
+                    'UnusedPoints'],
+        'query': """SELECT Scores.GameId, Scores.Date, Scores.Quarter,
+              MAX(Scores.PlayerCount),
+              GROUP_CONCAT(CASE WHEN Scores.PlayerId != ? THEN Players.Name
+                           END, ', '),
+              COALESCE(SUM(CASE WHEN Scores.PlayerId = ? THEN Scores.RawScore
+                           END), 0)
+            FROM Scores JOIN Players ON Players.Id = Scores.PlayerId
+            {where}
+            GROUP BY Scores.GameId
+            ORDER BY Scores.Date, Scores.GameId""",
+        'date': 'Scores.Date',
+        'quarter': 'Scores.Quarter',
+        'unusedPlayer': 2,
+    },
+    'leaderboards': {
+        'columns': ['Period', 'Date', 'Place', 'PlayerId', 'Name', 'AvgScore',
+                    'GameCount', 'DropGames', 'DateCount'],
+        'query': """SELECT Leaderboards.Period, Leaderboards.Date,
+              Leaderboards.Place, Leaderboards.PlayerId, Players.Name,
+              Leaderboards.AvgScore, Leaderboards.GameCount,
+              Leaderboards.DropGames, Leaderboards.DateCount
+            FROM Leaderboards JOIN Players ON Players.Id = Leaderboards.PlayerId
+            {where}
+            ORDER BY Leaderboards.Period, Leaderboards.Date,
+              Leaderboards.Place""",
+        'date': 'Leaderboards.Date',
+        'period': 'Leaderboards.Period',
+    },
+}
+
+formats = {
+    'csv': 'text/csv; charset=UTF-8',
+    'ndjson': 'application/x-ndjson; charset=UTF-8',
+}
+
+def exportQuery(name, fromDate=None, toDate=None, quarter=None, period=None):
+    """Build the SQL query and bindings to export the named table with
+    the given filters.  Filters that don't apply to the table are ignored.
+    """
+    export = exports[name]
+    bindings = []
+    if 'unusedPlayer' in export:
+        bindings += [scores.getUnusedPointsPlayerID()] * export['unusedPlayer']
+    conditions = []
+    if fromDate and 'date' in export:
+        conditions.append(export['date'] + " >= ?")
+        bindings.append(fromDate)
+    if toDate and 'date' in export:
+        conditions.append(export['date'] + " <= ?")
+        bindings.append(toDate)
+    if quarter and 'quarter' in export:
+        conditions.append(export['quarter'] + " = ?")
+        bindings.append(quarter)
+    if period and 'period' in export:
+        conditions.append(export['period'] + " = ?")
+        bindings.append(period)
+    return (export['query'].format(
+        where="WHERE " + " AND ".join(conditions) if conditions else ""),
+            bindings)
+
+def exportLine(name, fmt='csv'):
+    """Return a function that formats a row exported from the named table
+    as a line of text"""
+    columns = exports[name]['columns']
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        def line(row):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            return buffer.getvalue()
+        return line
+    return lambda row: json.dumps(dict(zip(columns, row))) + '\n'
+
+def exportLines(rows, name, fmt='csv'):
+    """Generate the lines of text for exporting the named table from the
+    rows of its export query, e.g. from a cursor that has executed it"""
+    line = exportLine(name, fmt)
+    if fmt == 'csv':
+        yield line(exports[name]['columns'])
+    for row in rows:
+        yield line(row)
+
+class ExportHandler(handler.BaseHandler):
+    async def get(self, name, fmt):
+        fromDate = self.get_argument('from', None)
+        toDate = self.get_argument('to', None)
+        quarter = self.get_argument('quarter', None)
+        period = self.get_argument('period', None)
+        if period and period not in leaderboard.periods:
+            raise tornado.web.HTTPError(400, "Unknown period")
+
+        query, bindings = exportQuery(name, fromDate, toDate, quarter, period)
+        self.set_header('Content-Type', formats[fmt])
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{}.{}"'.format(name, fmt))
+        line = exportLine(name, fmt)
+        async def lines():
+            if fmt == 'csv':
+                yield line(exports[name]['columns'])
+            async for row in db.stream(query, bindings):
+                yield line(row)
+        await self.write_chunked(lines())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'table', choices=sorted(exports.keys()),
+        help='Data to export.')
+    parser.add_argument(
+        '-f', '--format', choices=sorted(formats.keys()), default='csv',
+        help='Output format.')
+    parser.add_argument(
+        '--from', dest='fromDate',
+        help='Earliest date to export (YYYY-MM-DD or leaderboard Date).')
+    parser.add_argument(
+        '--to', dest='toDate',
+        help='Latest date to export (YYYY-MM-DD or leaderboard Date).')
+    parser.add_argument(
+        '-q', '--quarter',
+        help='Only export scores or games from this quarter, e.g. 2019 1st.')
+    parser.add_argument(
+        '-p', '--period', choices=sorted(leaderboard.periods.keys()),
+        help='Only export leaderboards for this period.')
+    parser.add_argument(
+        '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+        help='File to write.  Defaults to stdout.')
+
+    args = parser.parse_args()
+
+    query, bindings = exportQuery(args.table, args.fromDate, args.toDate,
+                                  args.quarter, args.period)
+    with db.getCur() as cur:
+        cur.execute(query, bindings)
+        for line in exportLines(cur, args.table, args.format):
+            args.output.write(line)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Generate a synthetic club database for load and scale testing.  The
+database is created with the real schema in db.schema and filled with
+players, weekly game nights, quarters, and memberships.  Every game is
+scored with scores.rankGame and rated with scores.ratingChange, so the
+leaderboards, rating histories, and player statistics built from it are
+the same as if the games had been entered one by one.
+
+Each player has a hidden skill that drifts a little after every night
+they play, along with a chance of coming to each night and the dates they
+joined and left the club.  Raw scores follow from the skills of the
+players at a table plus some luck.  The same seed always produces the
+same database.
+"""
+
+import sys
+import os
+import random
+import datetime
+import collections
+import argparse
+import time
+
+import settings
+import db
+import scores
+import leaderboard
+import ratings
+
+syllables = ['ka', 'ri', 'to', 'mi', 'na', 'sa', 'ko', 'ha', 'yu', 'ta',
+             'shi', 'ro', 'ne', 'ma', 'ki', 'da', 'le', 'an', 'jo', 'el']
+
+def playerName(rng, taken):
+    "Return a new random player name that isn't in the taken set"
+    while True:
+        name = ' '.join(
+            ''.join(rng.choice(syllables) for i in range(rng.randint(2, 3)))
+            .capitalize() for part in range(2))
+        if name not in taken:
+            taken.add(name)
+            return name
+
+def rawScores(rng, skills, total, luck):
+    """Return raw scores in multiples of 100 points that add up to total
+    for players with the given skills"""
+    performance = [skill + rng.gauss(0, luck) for skill in skills]
+    mean = sum(performance) / len(performance)
+    result = [total // len(skills) // 100 * 100 +
+              100 * round((p - mean) * 120) for p in performance]
+    result[rng.randrange(len(result))] += total - sum(result)
+    return result
+
+def generate(players=60, years=3, gamesPerNight=6, nightsPerWeek=1,
+             members=0.4, quarters=None, drift=0.05, fivePlayers=0.1,
+             chombos=0.01, seed=1, start=None, verbose=False):
+    """Fill the database in settings.DBFILE with synthetic games.
+    players is the number of people who ever come to the club and years
+    is how long the club has been running up to start (today by default).
+    Each of the nightsPerWeek nights has gamesPerNight games with 4 or
+    5 (the fivePlayers fraction) of the players who came that night.
+    The members fraction of the regular players hold a membership in each
+    of the last quarters quarters (all by default), which are added to
+    the Quarters table.  Each night's play changes a player's skill by a
+    random amount with standard deviation drift.  chombos is the chance
+    of a player having a chombo in a game.
+    Returns a dictionary of the counts of records created."""
+    rng = random.Random(seed)
+    end = datetime.datetime.strptime(start, scores.dateFormat) if start else \
+          datetime.datetime.combine(datetime.date.today(), datetime.time())
+    first = end - datetime.timedelta(days=int(365.25 * years))
+    unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
+    unusedPointsIncr = 1000
+    perPlayer = settings.SCOREPERPLAYER
+
+    # Players arrive and leave throughout the club's history, but about a
+    # third of them have been coming since it started
+    taken = set()
+    people = []
+    for i in range(players):
+        joined = first + datetime.timedelta(
+            days=0 if rng.random() < 0.3 else rng.randrange((end - first).days))
+        left = end + datetime.timedelta(days=1) if rng.random() < 0.6 else \
+               joined + datetime.timedelta(days=rng.randrange(30, 3 * 365))
+        people.append({'Name': playerName(rng, taken), 'skill': rng.gauss(0, 1),
+                       'attendance': rng.betavariate(2, 3),
+                       'joined': joined, 'left': left})
+    with db.getCur() as cur:
+        cur.executemany("INSERT INTO Players(Name) VALUES(?)",
+                        [(person['Name'],) for person in people])
+        cur.execute("SELECT Id, Name FROM Players")
+        playerIDs = dict((name, id) for id, name in cur.fetchall())
+    for person in people:
+        person['PlayerId'] = playerIDs[person['Name']]
+
+    # Game nights are spread through the week, starting on Tuesdays
+    nights = []
+    day = first + datetime.timedelta(days=(1 - first.weekday()) % 7)
+    while day <= end:
+        for night in range(nightsPerWeek):
+            date = day + datetime.timedelta(days=night * 7 // nightsPerWeek)
+            if date <= end:
+                nights.append(date)
+        day += datetime.timedelta(days=7)
+
+    columns = ["GameId", "PlayerId", "Rank", "PlayerCount", "RawScore",
+               "Chombos", "Score", "Date", "Quarter", "DeltaRating"]
+    rating = collections.defaultdict(lambda: settings.DEFAULT_RATING)
+    gameCount = collections.Counter()
+    gameid, rows, lastQuarter = 0, [], None
+    for date in nights:
+        present = [person for person in people
+                   if person['joined'] <= date < person['left'] and
+                   rng.random() < person['attendance']]
+        if len(present) < 4:
+            continue
+        dateString = scores.dateString(date)
+        quarter = scores.quarterString(date)
+        deltas = collections.defaultdict(float)
+        played = collections.Counter()
+        for g in range(gamesPerNight):
+            table = rng.sample(
+                present, 5 if len(present) >= 5 and rng.random() < fivePlayers
+                else 4)
+            unused = unusedPointsIncr * rng.choice((0, 0, 0, 0, 0, 1, 2))
+            game = [{'PlayerId': person['PlayerId'], 'RawScore': raw,
+                     'Chombos': 1 if rng.random() < chombos else 0}
+                    for person, raw in zip(table, rawScores(
+                        rng, [person['skill'] for person in table],
+                        perPlayer * len(table) - unused, 1.0))]
+            if unused:
+                game.append({'PlayerId': unusedPointsPlayerID,
+                             'RawScore': unused, 'Chombos': 0})
+            status = scores.rankGame(game, perPlayer, unusedPointsIncr)
+            if status['status'] != 0:
+                raise Exception('Generated invalid game: {}'.format(
+                    status['error']))
+            seated = [score['PlayerId'] for score in game
+                      if score['PlayerId'] != unusedPointsPlayerID]
+            for score in game:
+                score['DeltaRating'] = 0
+                if score['PlayerId'] != unusedPointsPlayerID:
+                    avgOppRating = sum(
+                        rating[p] for p in seated
+                        if p != score['PlayerId']) / (len(seated) - 1)
+                    score['DeltaRating'] = scores.ratingChange(
+                        score['uma'], rating[score['PlayerId']],
+                        avgOppRating, gameCount[score['PlayerId']])
+                    deltas[score['PlayerId']] += score['DeltaRating']
+                    played[score['PlayerId']] += 1
+                score.update(GameId=gameid, Date=dateString, Quarter=quarter,
+                             PlayerCount=status['realPlayerCount'])
+                rows.append([score[col] for col in columns])
+            gameid += 1
+
+        # Ratings change at the end of the night, so every game of a night
+        # uses the ratings from before it, and players' skills drift
+        for person in present:
+            person['skill'] += rng.gauss(0, drift)
+        for playerID, delta in deltas.items():
+            rating[playerID] += delta
+        gameCount.update(played)
+        if verbose and quarter != lastQuarter:
+            print('Generating games for {}, {} so far'.format(quarter, gameid))
+        lastQuarter = quarter
+
+    # Quarters get the usual settings and regular players buy memberships
+    allQuarters = sorted(set(row[8] for row in rows))
+    configured = allQuarters[-quarters:] if quarters else allQuarters
+    quarterGames = collections.Counter(
+        (row[1], row[8]) for row in rows if row[1] != unusedPointsPlayerID)
+    memberships = [
+        (person['PlayerId'], quarter) for quarter in configured
+        for person in people
+        if quarterGames[person['PlayerId'], quarter] >= 4 and
+        rng.random() < members]
+    with db.getCur() as cur:
+        cur.executemany(
+            "INSERT INTO Quarters(Quarter, ScorePerPlayer,"
+            "  UnusedPointsIncrement, GameCount, QualifyingGames,"
+            "  QualifyingDistinctDates) VALUES(?, ?, ?, ?, ?, ?)",
+            [(quarter, perPlayer, unusedPointsIncr, settings.DROPGAMECOUNT,
+              settings.QUALIFYINGGAMES, settings.QUALIFYINGDISTINCTDATES)
+             for quarter in configured])
+        cur.executemany(
+            "INSERT INTO Scores({columns}) VALUES({values})".format(
+                columns=",".join(columns),
+                values=",".join(["?"] * len(columns))),
+            rows)
+        cur.executemany(
+            "INSERT INTO Memberships(PlayerId, QuarterId) VALUES(?, ?)",
+            memberships)
+
+    if verbose:
+        print('Building rating history and leaderboards')
+    ratings.genRatingHistory()
+    leaderboard.genLeaderboard()
+    return {'players': len(people), 'nights': len(nights), 'games': gameid,
+            'scores': len(rows), 'quarters': len(configured),
+            'memberships': len(memberships)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'output', help='Database file to create.')
+    parser.add_argument(
+        '-p', '--players', type=int, default=60,
+        help='Number of people who ever play at the club.')
+    parser.add_argument(
+        '-y', '--years', type=float, default=3,
+        help='Number of years of games.')
+    parser.add_argument(
+        '-g', '--games-per-night', type=int, default=6,
+        help='Number of games played each night.')
+    parser.add_argument(
+        '-w', '--nights-per-week', type=int, default=1,
+        help='Number of game nights each week.')
+    parser.add_argument(
+        '-m', '--members', type=float, default=0.4,
+        help='Fraction of regular players who are members each quarter.')
+    parser.add_argument(
+        '-q', '--quarters', type=int, default=None,
+        help='Number of the most recent quarters to configure with '
+        'memberships.  Defaults to all of them.')
+    parser.add_argument(
+        '-d', '--drift', type=float, default=0.05,
+        help='Standard deviation of the change in a player\'s skill after '
+        'each night.')
+    parser.add_argument(
+        '-5', '--five-players', type=float, default=0.1,
+        help='Fraction of games with 5 players.')
+    parser.add_argument(
+        '-c', '--chombos', type=float, default=0.01,
+        help='Chance of a player having a chombo in a game.')
+    parser.add_argument(
+        '-x', '--scale', type=int, default=1,
+        help='Multiply the players and games per night by this factor.')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=1,
+        help='Seed for the random number generator.')
+    parser.add_argument(
+        '--start', help='Date of the last game night in YYYY-MM-DD format.  '
+        'Defaults to today.')
+    parser.add_argument(
+        '-f', '--force', default=False, action='store_true',
+        help='Replace the output file if it exists.')
+    parser.add_argument(
+        '-v', '--verbose', default=False, action='store_true',
+        help='Print progress.')
+
+    args = parser.parse_args()
+    if os.path.exists(args.output):
+        if not args.force:
+            print('{} already exists.  Use --force to replace it.'.format(
+                args.output))
+            sys.exit(1)
+        os.remove(args.output)
+
+    # The synthetic games are not recorded in the change log
+    settings.DBFILE = args.output
+    db.changeLogEnabled = False
+    db.init(force=True, dbfile=args.output)
+    begin = time.time()
+    counts = generate(
+        args.players * args.scale, args.years,
+        args.games_per_night * args.scale, args.nights_per_week, args.members,
+        args.quarters, args.drift, args.five_players, args.chombos, args.seed,
+        args.start, args.verbose)
+    print('Generated {games} games with {scores} scores by {players} players '
+          'on {nights} nights, {quarters} quarters, and {memberships} '
+          'memberships'.format(**counts), end='')
+    print(' in {:.1f} seconds'.format(time.time() - begin))
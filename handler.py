@@ -1,11 +1,54 @@
 #!/usr/bin/env python3
+import json
+import time
 import tornado.web
+import tornado.escape
 
 import db
 import settings
+import metrics
+import util
 from util import stringify
 
 class BaseHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        # Tag and time the database queries made for this request
+        db.queryTag.set(type(self).__name__)
+        self.queryTimer = [0.0]
+        db.queryTimer.set(self.queryTimer)
+
+    renderTime = 0.0
+    responseSize = 0
+
+    def write(self, chunk):
+        if isinstance(chunk, dict):
+            chunk = tornado.escape.json_encode(chunk)
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        chunk = tornado.escape.utf8(chunk)
+        self.responseSize += len(chunk)
+        super().write(chunk)
+
+    def render_string(self, template_name, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render_string(template_name, **kwargs)
+        finally:
+            self.renderTime += time.perf_counter() - start
+
+    def route_pattern(self):
+        "Return the pattern of the application route that matched the request"
+        for rule in self.application.wildcard_router.rules:
+            if (rule.target is type(self) and
+                rule.matcher.match(self.request) is not None):
+                return rule.matcher.regex.pattern.rstrip("$")
+        return type(self).__name__
+
+    def on_finish(self):
+        metrics.record(self.route_pattern(), self.request.method,
+                       self.get_status(), self.request.request_time(),
+                       getattr(self, 'queryTimer', [0.0])[0], self.renderTime,
+                       self.responseSize)
+
     def get_current_player(self):
         return stringify(self.get_secure_cookie("playerId"))
     def get_current_player_name(self):
@@ -66,12 +109,50 @@ class BaseHandler(tornado.web.RequestHandler):
             **kwargs
         )
 
+    # Number of characters of JSON to accumulate before flushing to client
+    JSONCHUNKSIZE = 64 * 1024
+
+    async def write_json_list(self, items, before='[', after=']',
+                              chunksize=JSONCHUNKSIZE):
+        """Write the items, typically generated from a database query with
+        db.stream, as the elements of a JSON list.  The items can be an
+        iterable or an asynchronous iterable.  The elements are encoded one
+        at a time and flushed to the client about every chunksize
+        characters, so the full list is never held in memory.  The before
+        and after strings surround the elements and can embed the list in
+        an object, e.g. before='{"players": [', after=']}'.  The output is
+        identical to that of json.dumps on the equivalent object.
+        """
+        async def texts():
+            yield before
+            separator = ''
+            async for item in util.as_async(items):
+                yield separator + json.dumps(item)
+                separator = ', '
+            yield after
+        await self.write_chunked(texts(), chunksize)
+
+    async def write_chunked(self, texts, chunksize=JSONCHUNKSIZE):
+        """Write a sequence of strings, which can be an asynchronous
+        iterable, to the client, flushing about every chunksize characters
+        and waiting for each flush to be sent."""
+        chunk = []
+        size = 0
+        async for text in util.as_async(texts):
+            chunk.append(text)
+            size += len(text)
+            if size >= chunksize:
+                self.write(''.join(chunk))
+                await self.flush()
+                chunk, size = [], 0
+        self.write(''.join(chunk))
+
 def is_admin(func):
     def func_wrapper(self, *args, **kwargs):
         if not self.get_is_admin():
             self.render("message.html", message = "You must be admin to do that")
         else:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
 
     return func_wrapper
 
@@ -80,6 +161,6 @@ def is_admin_ajax(func):
         if not self.get_is_admin():
             self.write('{"status":1, "error":"You must be admin to do that"}')
         else:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
 
     return func_wrapper
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Import many games at once from a CSV or JSON file.  Every game is
+validated with scores.rankGame, players are looked up (or created) all
+together, and all the games are inserted in a single transaction.
+Leaderboards and rating histories are then recalculated once for each
+affected period instead of once per game.
+
+CSV files need a header row naming the columns.  Each row holds one
+player's score in a game.  Consecutive rows with the same Game label and
+Date belong to the same game (the label is not stored).  Dates are in
+YYYY-MM-DD format.  The Chombos and UnusedPoints columns are optional,
+and unused points may be given on any one row of a game:
+    Game,Date,Name,RawScore,Chombos,UnusedPoints
+
+JSON files hold either a list of games or one game per line.  Each game
+is an object like:
+    {"Date": "2018-02-27", "UnusedPoints": 1000,
+     "Scores": [{"Name": "Alice", "RawScore": 32000, "Chombos": 0}, ...]}
+"""
+
+import sys
+import csv
+import json
+import datetime
+import collections
+import itertools
+import argparse
+import time
+
+import db
+import settings
+import scores
+import leaderboard
+import ratings
+import jobs
+
+def read_games(stream, fmt='csv'):
+    """Generate games from a text stream in 'csv' or 'json' format.
+    Each game is a dictionary with 'Game', 'Date', 'UnusedPoints', and
+    'Scores' fields.  The 'Scores' are a list of dictionaries with
+    'Name', 'RawScore', and 'Chombos' fields."""
+    if fmt == 'csv':
+        game = None
+        for row in csv.DictReader(stream):
+            key = (row.get('Game') or '', (row.get('Date') or '').strip())
+            if game is None or key != (game['Game'], game['Date']):
+                if game is not None:
+                    yield game
+                game = {'Game': key[0], 'Date': key[1], 'UnusedPoints': 0,
+                        'Scores': []}
+            game['Scores'].append({
+                'Name': (row.get('Name') or '').strip(),
+                'RawScore': row.get('RawScore') or 0,
+                'Chombos': row.get('Chombos') or 0})
+            if row.get('UnusedPoints'):
+                game['UnusedPoints'] = row['UnusedPoints']
+        if game is not None:
+            yield game
+    else:
+        lines = (line for line in stream if line.strip())
+        first = next(lines, '')
+        if first.lstrip().startswith('['):
+            games = json.loads(first + ''.join(lines))
+            if not isinstance(games, list):
+                raise ValueError("Expected a list of games")
+        else:
+            games = (json.loads(line)
+                     for line in itertools.chain([first], lines) if line)
+        for i, game in enumerate(games):
+            yield json_game(game, i + 1)
+
+def json_game(game, number):
+    """Convert one game object read from JSON to the form generated by
+    read_games.  Entries that are not objects with a list of score objects
+    get an 'Error' field so they are reported as invalid games."""
+    if not isinstance(game, dict):
+        return {'Game': str(number), 'Date': '', 'UnusedPoints': 0,
+                'Scores': [], 'Error': "Game must be an object"}
+    result = {'Game': str(game.get('Game', number)),
+              'Date': game.get('Date', ''),
+              'UnusedPoints': game.get('UnusedPoints', 0),
+              'Scores': []}
+    scoreList = game.get('Scores', [])
+    if not (isinstance(scoreList, list) and
+            all(isinstance(score, dict) and
+                isinstance(score.get('Name') or '', str)
+                for score in scoreList)):
+        result['Error'] = "Scores must be a list of objects with names"
+        return result
+    result['Scores'] = [{'Name': (score.get('Name') or '').strip(),
+                         'RawScore': score.get('RawScore', 0),
+                         'Chombos': score.get('Chombos', 0)}
+                        for score in scoreList]
+    return result
+
+def validate_game(game, pointSettings, unusedPointsPlayerID):
+    """Check the date and numbers of a game read by read_games and rank
+    its scores with scores.rankGame.  Returns the rankGame status after
+    filling in the 'Quarter' and 'PlayerCount' of the game."""
+    if 'Error' in game:
+        return {"status": 1, "error": game['Error']}
+    try:
+        date = datetime.datetime.strptime(game['Date'], scores.dateFormat)
+    except (ValueError, TypeError):
+        return {"status": 1,
+                "error": "Invalid date '{}'".format(game['Date'])}
+    game['Date'] = scores.dateString(date)
+    try:
+        for score in game['Scores']:
+            score['RawScore'] = int(score['RawScore'])
+            score['Chombos'] = int(score['Chombos'])
+        unusedPoints = int(game['UnusedPoints'] or 0)
+    except (ValueError, TypeError):
+        return {"status": 1, "error": "Scores must be integers"}
+    game['Quarter'] = scores.quarterString(date)
+    if game['Quarter'] not in pointSettings:
+        pointSettings[game['Quarter']] = scores.getPointSettings(
+            quarter=game['Quarter'])
+    unusedPointsIncr, perPlayer = pointSettings[game['Quarter']]
+    if unusedPoints:
+        game['Scores'].append({'PlayerId': unusedPointsPlayerID,
+                               'RawScore': unusedPoints, 'Chombos': 0})
+    status = scores.rankGame(game['Scores'], perPlayer, unusedPointsIncr)
+    if status['status'] == 0:
+        game['PlayerCount'] = status['realPlayerCount']
+    return status
+
+def import_games(games, skipInvalid=False, dryRun=False):
+    """Validate and insert a sequence of games read by read_games into
+    the Scores table in one transaction.  If any game is invalid, no games
+    are imported unless skipInvalid is true.  With dryRun, the games are
+    validated but nothing is written.  Leaderboards and rating histories
+    are scheduled to be regenerated once for all the affected periods.
+    Returns a dictionary with a 'status', the count of 'imported' games,
+    and a list of per game 'results' that have 'game', 'date', 'status',
+    and either 'error' or 'gameid' fields.  Status of 0 means success.
+    """
+    # Get unused points playerID before opening cursor to avoid db deadlock
+    unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
+    pointSettings = {}
+    results, valid = [], []
+    for game in games:
+        status = validate_game(game, pointSettings, unusedPointsPlayerID)
+        results.append({'game': game['Game'], 'date': game['Date'],
+                        'status': status['status']})
+        if status['status'] == 0:
+            valid.append((game, results[-1]))
+        else:
+            results[-1]['error'] = status['error']
+    invalid = len(results) - len(valid)
+    if len(results) == 0:
+        return {"status": 1, "error": "No games found", "imported": 0,
+                "results": results}
+    if invalid and not skipInvalid:
+        return {"status": 1, "imported": 0, "results": results,
+                "error": "{} of {} games are invalid; none imported".format(
+                    invalid, len(results))}
+    if dryRun or len(valid) == 0:
+        return {"status": 0 if valid else 1, "imported": 0,
+                "results": results}
+
+    # Games are rated in date order, each using ratings from before its date
+    valid.sort(key=lambda pair: pair[0]['Date'])
+    columns = ["GameId", "PlayerId", "Rank", "PlayerCount",
+               "RawScore", "Chombos", "Score", "Date", "Quarter",
+               "DeltaRating"]
+    with db.getCur() as cur:
+        cur.execute("SELECT Id, Name FROM Players")
+        playerIDs = dict((name, id) for id, name in cur.fetchall())
+        newPlayers = sorted(set(
+            score['Name'] for game, result in valid for score in game['Scores']
+            if 'PlayerId' not in score and score['Name'] not in playerIDs))
+        cur.executemany("INSERT INTO Players(Name) VALUES(?)",
+                        [(name,) for name in newPlayers])
+        if newPlayers:
+            cur.execute("SELECT Id, Name FROM Players WHERE Name IN ({})"
+                        .format(",".join(["?"] * len(newPlayers))),
+                        newPlayers)
+            playerIDs.update((name, id) for id, name in cur.fetchall())
+        for game, result in valid:
+            for score in game['Scores']:
+                if 'PlayerId' not in score:
+                    score['PlayerId'] = playerIDs[score['Name']]
+
+        # Load the rating history of all players in the imported games
+        players = set(score['PlayerId'] for game, result in valid
+                      for score in game['Scores'])
+        players.discard(unusedPointsPlayerID)
+        history = collections.defaultdict(list)
+        cur.execute(
+            "SELECT PlayerId, Date, SUM(DeltaRating), COUNT(*) FROM Scores"
+            "  WHERE PlayerId IN ({}) GROUP BY PlayerId, Date".format(
+                ",".join(["?"] * len(players))),
+            list(players))
+        for playerID, date, delta, count in cur.fetchall():
+            history[playerID].append([date, delta, count])
+
+        def ratingBefore(playerID, date):
+            rating, gameCount = settings.DEFAULT_RATING, 0
+            for day, delta, count in history[playerID]:
+                if day < date:
+                    rating += delta
+                    gameCount += count
+            return rating, gameCount
+
+        cur.execute("SELECT COALESCE(MAX(GameId), -1) FROM Scores")
+        gameid = cur.fetchone()[0]
+        rows = []
+        for game, result in valid:
+            gameid += 1
+            before = {}
+            for score in game['Scores']:
+                if score['PlayerId'] != unusedPointsPlayerID:
+                    before[score['PlayerId']] = ratingBefore(
+                        score['PlayerId'], game['Date'])
+            for score in game['Scores']:
+                score['DeltaRating'] = 0
+                if score['PlayerId'] in before:
+                    rating, gameCount = before[score['PlayerId']]
+                    avgOppRating = (
+                        sum(r for p, (r, c) in before.items()
+                            if p != score['PlayerId']) / (len(before) - 1))
+                    score['DeltaRating'] = scores.ratingChange(
+                        score['uma'], rating, avgOppRating, gameCount)
+                    history[score['PlayerId']].append(
+                        [game['Date'], score['DeltaRating'], 1])
+                score.update(GameId=gameid, Date=game['Date'],
+                             Quarter=game['Quarter'],
+                             PlayerCount=game['PlayerCount'])
+                rows.append([score[col] for col in columns])
+            result['gameid'] = gameid
+
+        cur.executemany(
+            "INSERT INTO Scores({columns}) VALUES({values})".format(
+                columns=",".join(columns),
+                values=",".join(["?"] * len(columns))),
+            rows)
+
+    regenerate([game['Date'] for game, result in valid])
+    return {"status": 0, "imported": len(valid), "results": results}
+
+def regenerate(dates):
+    """Schedule regenerating the leaderboards for every period that
+    includes one of the dates and the rating history from the earliest
+    date on.  Each leaderboard is only rebuilt once."""
+    for date in sorted(set(dates)):
+        leaderboard.scheduleLeaderboard(date)
+    if dates:
+        ratings.scheduleRatingHistory(min(dates))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'file', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+        help='CSV or JSON file of games to import.  Defaults to stdin.')
+    parser.add_argument(
+        '-f', '--format', choices=['csv', 'json'],
+        help='Format of the input.  Defaults to the file extension or csv.')
+    parser.add_argument(
+        '-s', '--skip-invalid', default=False, action='store_true',
+        help='Import the valid games even if some games are invalid.')
+    parser.add_argument(
+        '-n', '--dry-run', default=False, action='store_true',
+        help='Validate the games without importing them.')
+    parser.add_argument(
+        '-v', '--verbose', default=False, action='store_true',
+        help='Print the result of every game.')
+
+    args = parser.parse_args()
+    fmt = args.format or (
+        'json' if args.file.name.lower().endswith(('.json', '.ndjson'))
+        else 'csv')
+
+    db.init()
+    start = time.time()
+    result = import_games(read_games(args.file, fmt), args.skip_invalid,
+                          args.dry_run)
+    jobs.wait()
+    for game in result['results']:
+        if args.verbose or game['status'] != 0:
+            print('Game {game} on {date}: {0}'.format(
+                game.get('error', 'OK'), **game))
+    if 'error' in result:
+        print(result['error'])
+    print('{} of {} games imported in {:.3f} seconds'.format(
+        result['imported'], len(result['results']), time.time() - start))
+    sys.exit(result['status'])
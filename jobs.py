@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Run slow maintenance work, such as rebuilding leaderboards, on a
+background thread so requests that need it can respond immediately.
+Each job has a key, and scheduling a job whose key is already waiting to
+run merges the two, so a burst of edits needing the same rebuild only
+runs it once.
+"""
+
+import time
+import threading
+import collections
+import logging
+import json
+
+import handler
+import db
+import settings
+
+log = logging.getLogger("WebServer")
+
+_pending = collections.OrderedDict()  # Jobs waiting to run by key
+_running = None
+_finished = collections.deque(maxlen=50)  # Most recent finished jobs
+_counts = collections.Counter()
+_condition = threading.Condition()
+_worker = None
+
+def schedule(key, fn, *args, merge=None):
+    """Run fn(*args) on the job thread after JOBDELAY seconds.  If a job
+    with the same key is already waiting, only one of them runs.  It is
+    called with the arguments returned by merge(waitingArgs, args), if
+    merge is given, or else with the arguments of the waiting job.
+    """
+    global _worker
+    with _condition:
+        job = _pending.get(key)
+        if job is None:
+            _pending[key] = {'key': key, 'fn': fn, 'args': args,
+                             'scheduled': time.time(), 'merged': 0}
+            _counts['scheduled'] += 1
+        else:
+            if merge:
+                job['args'] = merge(job['args'], args)
+            job['merged'] += 1
+            _counts['merged'] += 1
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name="Jobs", daemon=True)
+            _worker.start()
+        _condition.notify_all()
+
+def _work():
+    global _running
+    while True:
+        with _condition:
+            while not _pending:
+                _condition.wait()
+            key, job = next(iter(_pending.items()))
+            delay = job['scheduled'] + settings.JOBDELAY - time.time()
+            if delay > 0:
+                _condition.wait(delay)
+                continue
+            del _pending[key]
+            _running = job
+            job['started'] = time.time()
+        try:
+            db.queryTag.set('Job ' + str(key[0]))
+            job['fn'](*job['args'])
+            job['status'] = 'done'
+        except Exception as e:
+            log.exception("Job {0} failed".format(key))
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        with _condition:
+            job['finished'] = time.time()
+            _running = None
+            _finished.append(job)
+            _counts[job['status']] += 1
+            _condition.notify_all()
+
+def wait(timeout=None):
+    """Wait until no jobs are waiting or running, or the timeout in seconds
+    expires.  Returns True if all jobs are finished."""
+    with _condition:
+        return _condition.wait_for(
+            lambda: not _pending and _running is None, timeout)
+
+def describe(job):
+    "Return a dictionary describing a job that can be encoded as JSON"
+    result = {'key': [str(k) for k in job['key']],
+              'args': [str(a) for a in job['args']],
+              'merged': job['merged'],
+              'waited': round(job.get('started', time.time()) -
+                              job['scheduled'], 3)}
+    if 'finished' in job:
+        result['status'] = job['status']
+        result['seconds'] = round(job['finished'] - job['started'], 3)
+        result['finished'] = time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(job['finished']))
+        if 'error' in job:
+            result['error'] = job['error']
+    return result
+
+def status():
+    "Return a dictionary describing the waiting, running, and recent jobs"
+    with _condition:
+        return {'pending': [describe(job) for job in _pending.values()],
+                'running': describe(_running) if _running else None,
+                'finished': [describe(job) for job in reversed(_finished)],
+                'counts': dict(_counts)}
+
+class JobStatusHandler(handler.BaseHandler):
+    @handler.is_admin_ajax
+    def get(self):
+        self.write(json.dumps(status()))
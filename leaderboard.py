@@ -2,11 +2,14 @@
 
 import json
 import collections
+import threading
 
 import db
 import handler
+import jobs
 import settings
 import scores
+import util
 
 LBDcolumns = [col for col in db.table_field_names('Leaderboards')
               if col not in ['Place']]
@@ -73,6 +76,86 @@ periods = {
         }
 }
 
+def periodKey(periodName, date):
+    """Return the leaderboard Date for the named period that includes the
+    given date string (YYYY-MM-DD).  This matches the period's datefmt."""
+    year, month = date[0:4], int(date[5:7])
+    if periodName == 'annual':
+        return year
+    elif periodName == 'biannual':
+        return year + ' ' + ['1st', '2nd'][(month - 1) * 2 // 12]
+    return year + ' ' + ['1st', '2nd', '3rd', '4th'][(month - 1) * 4 // 12]
+
+# The statements that delete and recalculate each period's leaderboards,
+# keyed by period name and whether they are for one date or all dates
+leaderboardSQL = {}
+for periodname, period in periods.items():
+    datefmt = period['datefmt']
+    for onDate in (False, True):
+        name = periodname + 'Leaderboards' + ('OnDate' if onDate else '')
+        if onDate:
+            datetest = "(" + datefmt + ") = (" + datefmt.format(date="?") + ")"
+        else:
+            datetest = "1"
+        leaderboardSQL[periodname, onDate] = (
+            db.statement(
+                'delete' + name[0].upper() + name[1:],
+                "DELETE FROM Leaderboards WHERE Period = ? " +
+                (" AND Date = " + datefmt.format(date="?") if onDate else "")),
+            [db.statement(
+                name + ('' if i == 0 else str(i + 1)),
+                query.format(
+                    datetest=datetest, datefmt=datefmt,
+                    DEFDROPGAMES=settings.DROPGAMECOUNT).format(
+                        date="Scores.Date"),
+                scans=['Scores'])
+             for i, query in enumerate(period['queries'])])
+
+droppedGamesSQL = db.statement(
+    'droppedGameScores',
+    "SELECT Score FROM Scores"
+    "  WHERE PlayerId = ? AND Quarter = ?"
+    "  ORDER BY Score ASC LIMIT -1 OFFSET ?",
+    scans=['Scores'])
+leadercols = ['Place'] + LBDcolumns
+insertLeaderboardSQL = db.statement(
+    'insertLeaderboard',
+    "INSERT INTO Leaderboards({columns}) VALUES({colvals})".format(
+        columns=",".join(leadercols),
+        colvals=",".join(["?"] * len(leadercols))))
+
+displaycols = ['Name', 'Place', 'Symbol'] + LBDcolumns
+# A string that sorts after every leaderboard Date
+lastDate = '\uffff'
+# LeaderDataHandler's conditions on the rows of the leaderboards it returns.
+# The Dates are bounded by :start, :end, and :before, which are '' or
+# lastDate when not limited, so SQLite can search for them in the
+# Leaderboards_Period_Date index.  The other conditions given as NULL are
+# not applied.  :players is a JSON list of player names or IDs.
+leaderDataConditions = (
+    "Period = :period"
+    " AND Date >= :start AND Date <= :end AND Date < :before"
+    " AND (:top IS NULL OR Place <= :top)"
+    " AND (:players IS NULL"
+    "      OR Players.Name IN (SELECT value FROM json_each(:players))"
+    "      OR Players.Id IN (SELECT value FROM json_each(:players)))")
+leaderDatesSQL = db.statement(
+    'leaderboardDates',
+    "SELECT DISTINCT Date FROM Leaderboards"
+    " JOIN Players ON PlayerId = Players.Id"
+    " WHERE " + leaderDataConditions + " ORDER BY Date DESC LIMIT :limit")
+leaderDataSQL = db.statement(
+    'leaderboardData',
+    "SELECT {columns} FROM Leaderboards"
+    " JOIN Players ON PlayerId = Players.Id"
+    " WHERE {conditions} ORDER BY Date DESC, Place ASC".format(
+        columns=",".join(displaycols), conditions=leaderDataConditions))
+
+# Tables whose contents determine the eligibility flags
+eligibleTables = ('Scores', 'Memberships', 'Quarters', 'Players')
+_eligibleSnapshot = {'version': None, 'eligible': None}
+_eligibleLock = threading.Lock()
+
 def get_eligible(quarter=None):
     """Return a nested dictionary structure indexed by quarter and player ID
     that returns a dictionary with the following flags:
@@ -80,7 +163,21 @@ def get_eligible(quarter=None):
     'Played' for whether they played any games that quarter, and
     'Eligible' indicating whether or not the player qualified for the
        end-of-quarter tournament in that quarter.
+    The structure is a snapshot of plain dictionaries that is shared among
+    callers and only recomputed when one of the eligibleTables has been
+    modified since it was built, so callers must not change it.  Use
+    eligibility to look up flags, which are False for players and
+    quarters that aren't in it.
     """
+    with _eligibleLock:
+        version = db.tableVersion(*eligibleTables)
+        if _eligibleSnapshot['version'] != version:
+            _eligibleSnapshot['eligible'] = compute_eligible()
+            _eligibleSnapshot['version'] = version
+        return _eligibleSnapshot['eligible']
+
+def compute_eligible():
+    "Compute the eligibility structure described in get_eligible"
     eligible = collections.defaultdict(
         lambda: collections.defaultdict(
             lambda: collections.defaultdict(lambda: False)))
@@ -130,14 +227,36 @@ def get_eligible(quarter=None):
         eligible[Quarter][PlayerId]['Eligible'] = Memb and (
             Games >= eligible[Quarter]['QGames'] or
             Dates >= eligible[Quarter]['QDistinctDates'])
-    return eligible
+    # Convert to plain dictionaries so looking up missing keys in the
+    # shared snapshot can't add them
+    return dict((quarter, dict((key, dict(value) if isinstance(value, dict)
+                                else value)
+                               for key, value in players.items()))
+                for quarter, players in eligible.items())
+
+def eligibility(eligible, quarter, playerId, flag):
+    """Return the flag for a player in a quarter from the structure returned
+    by get_eligible, or False if it isn't there"""
+    return eligible.get(quarter, {}).get(playerId, {}).get(flag, False)
 
 class LeaderboardHandler(handler.BaseHandler):
     def get(self, period):
         self.render("leaderboard.html")
 
 class LeaderDataHandler(handler.BaseHandler):
-    def get(self, period):
+    """Return leaderboards for a period as JSON.  Optional query arguments
+    select which boards and rows are returned:
+    date=D           only the leaderboard for date D (e.g. '2018 1st')
+    from=D1, to=D2   leaderboards with dates in the range D1 to D2 inclusive
+    before=D         leaderboards with dates before D
+    boards=N         only the N most recent leaderboards that match, and
+                     add a 'more' flag indicating whether older ones exist
+    top=N            only rows with places 1 through N
+    player=P         only rows for player P (name or ID; may be repeated)
+    stream=1         write each leaderboard to the client as it is built
+    """
+    async def get(self, period):
+        period = period or ''
         while period.startswith('/'):
             period = period[1:]
         if '/' in period:
@@ -145,65 +264,95 @@ class LeaderDataHandler(handler.BaseHandler):
         if period not in periods:
             period = "quarter"
 
-        rows = []
-        with db.getCur() as cur:
-            displaycols = ['Name', 'Place', 'Symbol'] + LBDcolumns
-            cur.execute(
-                ("SELECT {columns} FROM Leaderboards"
-                 " JOIN Players ON PlayerId = Players.Id"
-                 " WHERE Period = ? ORDER BY Date DESC, Place ASC").format(
-                     columns=",".join(displaycols)),
-                (period,)
-            )
-            rows = [dict(zip(displaycols, row)) for row in cur.fetchall()]
+        date = self.get_argument('date', None)
+        top = self.get_argument('top', None)
+        players = self.get_arguments('player')
+        bindings = {
+            'period': period,
+            'start': max(date or '', self.get_argument('from', None) or ''),
+            'end': min(date or lastDate,
+                       self.get_argument('to', None) or lastDate),
+            'before': self.get_argument('before', None) or lastDate,
+            'top': int(top) if top and top.isdigit() else None,
+            'players': json.dumps(players) if players else None}
+        boards = self.get_argument('boards', None)
+        boards = int(boards) if boards and boards.isdigit() else None
+        stream = self.get_argument('stream', '0') not in ('', '0', 'false')
 
-        eligible = get_eligible()
+        # Only quarterly leaderboards show membership and eligibility.
+        # Get them before opening cursor since they may need to be rebuilt
+        eligible = await db.run(get_eligible) if period == 'quarter' else None
 
-        leaderboards = collections.defaultdict(lambda: [])
-        for row in rows:
-            date = row['Date']
+        def flagged(row):
             for flag in ['Member', 'Eligible']:
-                row[flag] = (row['Period'] == 'quarter' and
-                             eligible[date][row['PlayerId']][flag])
-            leaderboards[date].append(row)
+                row[flag] = (eligible is not None and eligibility(
+                    eligible, row['Date'], row['PlayerId'], flag))
+            return row
 
-        leaderboards = [
-            {'Date': date, 'Board': board}
-            for date, board in sorted(leaderboards.items(), reverse=True)]
+        more = False
+        rows = []
+        if boards is not None:
+            dates = [row[0] for row in await db.run(
+                db.fetch_rows, leaderDatesSQL, dict(bindings, limit=boards + 1))]
+            more = len(dates) > boards
+            dates = dates[:boards]
+            if dates:
+                bindings['start'] = max(bindings['start'], dates[-1])
+        if boards is None or dates:
+            rows = db.stream(leaderDataSQL, bindings)
+        # Rows arrive grouped by date with the most recent first, so
+        # each leaderboard can be encoded as soon as its rows are read
+        leaderboards = (
+            {'Date': date,
+             'Board': [flagged(dict(zip(displaycols, row))) for row in board]}
+            async for date, board in util.async_groupby(
+                    util.as_async(rows),
+                    key=lambda row: row[displaycols.index('Date')]))
+        await self.write_json_list(
+            leaderboards, before='{"leaderboards": [',
+            after=']}' if boards is None else
+            ('], "more": ' + json.dumps(more) + '}'),
+            chunksize=1 if stream else self.JSONCHUNKSIZE)
 
-        self.write(json.dumps({'leaderboards':list(leaderboards)}))
+def scheduleLeaderboard(leaderDate = None):
+    """Schedule a background job to recalculate the leaderboards for the
+    given date, or all leaderboards if leaderDate is None.  Requests for
+    the same period's leaderboard are combined while they wait."""
+    if leaderDate is None:
+        jobs.schedule(('leaderboard',), genLeaderboard)
+        return
+    date = scores.dateString(leaderDate)
+    for periodName in periods:
+        jobs.schedule(('leaderboard', periodName, periodKey(periodName, date)),
+                      genLeaderboard, date, [periodName])
 
-def genLeaderboard(leaderDate = None):
+def genLeaderboard(leaderDate = None, periodNames = None):
     """Recalculates the leaderboard for the given datetime object.
-    If leaderDate is None, then recalculates all leaderboards."""
+    If leaderDate is None, then recalculates all leaderboards.
+    If periodNames is given, only recalculates leaderboards for those
+    periods, otherwise recalculates them for all periods."""
 
     # Get unused points playerID before opening cursor to change leaderboard
     # records to avoid db deadlock if no unused player is yet defined
     unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
     with db.getCur() as cur:
-        leadercols = ['Place'] + LBDcolumns
         leaderrows = []
 
         for periodname, period in periods.items():
+            if periodNames and periodname not in periodNames:
+                continue
             rows = []
-            queries = period['queries']
-            datefmt = period['datefmt']
-            sql = "DELETE FROM Leaderboards WHERE Period = ? "
+            deleteSQL, queries = leaderboardSQL[
+                periodname, leaderDate is not None]
             if leaderDate is not None:
-                datetest = "(" + datefmt + ") = (" + datefmt.format(date="?") + ")"
-                bindings = [scores.dateString(leaderDate)] * datefmt.count("{date}")
-                sql += " AND Date = " + datefmt.format(date="?")
+                bindings = [scores.dateString(leaderDate)] * period[
+                    'datefmt'].count("{date}")
             else:
-                datetest = "1"
                 bindings = []
-            cur.execute(sql, [periodname] + bindings)
+            cur.execute(deleteSQL, [periodname] + bindings)
 
             for query in queries:
-                sql = query.format(
-                    datetest=datetest, datefmt=datefmt,
-                    DEFDROPGAMES=settings.DROPGAMECOUNT).format(
-                        date="Scores.Date")
-                cur.execute(sql, [unusedPointsPlayerID] + bindings)
+                cur.execute(query, [unusedPointsPlayerID] + bindings)
                 for row in cur.fetchall():
                     record = dict(zip(LBDcolumns, row))
                     # For Quarterly Leaderboards, compute dropped game average
@@ -211,9 +360,7 @@ def genLeaderboard(leaderDate = None):
                         record['DropGames'] = min(settings.MAXDROPGAMES,
                                                   record['DropGames'])
                         cur.execute(
-                            "SELECT Score FROM Scores"
-                            "  WHERE PlayerId = ? AND Quarter = ?"
-                            "  ORDER BY Score ASC LIMIT -1 OFFSET ?",
+                            droppedGamesSQL,
                             (record['PlayerId'], record['Date'],
                              record['DropGames']))
                         total = 0.0
@@ -237,11 +384,7 @@ def genLeaderboard(leaderDate = None):
                 leaderrow = [row[col] for col in leadercols]
                 leaderrows += [leaderrow]
 
-        query = "INSERT INTO Leaderboards({columns}) VALUES({colvals})".format(
-                columns=",".join(leadercols),
-                colvals=",".join(["?"] * len(leadercols))
-            )
-        cur.executemany(query, leaderrows)
+        cur.executemany(insertLeaderboardSQL, leaderrows)
 
 if __name__ == '__main__':
     import timeit, argparse
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Load test the web server with a realistic mix of traffic.  The server
+(main.Application) runs in its own process on a local port against a copy
+of a database, which is generated with gendata.py if none is given.
+
+Simulated visitors repeatedly pick an activity, load its page and data
+the way the browser does, and pause to read it.  The activities are
+viewing leaderboards and loading older ones, paging through the game
+history, viewing player statistics and rating histories, and viewing
+the ratings.  Seating tablets poll the current players and tables every
+few seconds, and a scorekeeper enters games.  At the end, the throughput
+and latency percentiles of every route are reported.
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import sqlite3
+import tempfile
+import collections
+import multiprocessing
+import argparse
+import logging
+import urllib.parse
+
+import tornado.ioloop
+import tornado.httpclient
+import tornado.gen
+
+import settings
+import scores
+
+activities = collections.OrderedDict([
+    ('leaderboard', 4), ('history', 2), ('playerstats', 3), ('ratings', 1)])
+
+def serve(dbfile, port, ready):
+    "Run the web server on the given database and port until killed"
+    import tornado.httpserver
+    import tornado.netutil
+    import main
+    settings.DBFILE = dbfile
+    settings.DBBACKUPS = os.path.join(os.path.dirname(dbfile), 'backups')
+    settings.DEVELOPERMODE = True # Lets the scorekeeper enter games
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    server = tornado.httpserver.HTTPServer(main.Application(force=True))
+    server.add_sockets(tornado.netutil.bind_sockets(port, '127.0.0.1'))
+    ready.set()
+    tornado.ioloop.IOLoop.current().start()
+
+def quantile(values, q):
+    "Return the q quantile of a sorted list of values"
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class LoadTest():
+    def __init__(self, base, players, duration, users, tablets, think,
+                 pollInterval, gameInterval, mix, seed):
+        self.base = base
+        self.players = players
+        self.duration = duration
+        self.users = users
+        self.tablets = tablets
+        self.think = think
+        self.pollInterval = pollInterval
+        self.gameInterval = gameInterval
+        self.mix = mix
+        self.seed = seed
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=users + tablets + 1)
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.running = False
+
+    async def fetch(self, route, path, **kwargs):
+        """Request a path and record its latency under the route.  Returns
+        the parsed JSON response, if any"""
+        start = time.perf_counter()
+        response = await self.client.fetch(
+            self.base + path, raise_error=False, request_timeout=120,
+            **kwargs)
+        if not self.running:
+            return None
+        self.latencies[route].append(time.perf_counter() - start)
+        if response.code != 200:
+            self.errors[route] += 1
+            return None
+        if ('json' in response.headers.get('Content-Type', '') or
+            response.body.startswith(b'{')):
+            try:
+                return json.loads(response.body)
+            except ValueError:
+                self.errors[route] += 1
+        return None
+
+    def quote(self, name):
+        return urllib.parse.quote(name, safe='')
+
+    async def leaderboard(self, rng):
+        period = rng.choice(('quarter', 'quarter', 'biannual', 'annual'))
+        await self.fetch('/leaderboard/{period}', '/leaderboard/' + period)
+        data = await self.fetch('/leaderdata/{period}',
+                                '/leaderdata/' + period + '?boards=1')
+        while (data and data.get('leaderboards') and data.get('more') and
+               rng.random() < 0.4):
+            await tornado.gen.sleep(rng.expovariate(1 / self.think))
+            data = await self.fetch(
+                '/leaderdata/{period}?before', '/leaderdata/{}?{}'.format(
+                    period, urllib.parse.urlencode({
+                        'boards': 4,
+                        'before': data['leaderboards'][-1]['Date']})))
+
+    async def history(self, rng):
+        page = 1
+        await self.fetch('/history', '/history')
+        while rng.random() < 0.6:
+            await tornado.gen.sleep(rng.expovariate(1 / self.think))
+            page += 1
+            await self.fetch('/history/{page}', '/history/{}'.format(page))
+
+    async def playerstats(self, rng):
+        player = self.quote(rng.choice(self.players))
+        await self.fetch('/playerstats/{player}', '/playerstats/' + player)
+        await self.fetch('/playerstatsdata/{player}',
+                         '/playerstatsdata/' + player)
+        await self.fetch('/ratingsdata/history',
+                         '/ratingsdata/history?points=200&player=' + player)
+
+    async def ratings(self, rng):
+        await self.fetch('/ratings', '/ratings')
+        await self.fetch('/ratingsdata', '/ratingsdata')
+
+    async def visitor(self, rng):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        while self.running:
+            activity = rng.choices(names, weights)[0]
+            await getattr(self, activity)(rng)
+            await tornado.gen.sleep(rng.expovariate(1 / self.think))
+
+    async def tablet(self, rng):
+        await tornado.gen.sleep(rng.uniform(0, self.pollInterval))
+        while self.running:
+            start = time.perf_counter()
+            await self.fetch('/seating/currentplayers.json',
+                             '/seating/currentplayers.json')
+            await self.fetch('/seating/currenttables.json',
+                             '/seating/currenttables.json')
+            await tornado.gen.sleep(max(
+                0, self.pollInterval - (time.perf_counter() - start)))
+
+    async def scorekeeper(self, rng):
+        while self.running:
+            await tornado.gen.sleep(rng.expovariate(1 / self.gameInterval))
+            table = rng.sample(self.players, 4)
+            raw = [rng.randrange(-100, 700) * 100 for player in table[1:]]
+            raw.append(4 * settings.SCOREPERPLAYER - sum(raw))
+            data = await self.fetch('/addgame', '/addgame', method='POST',
+                                    body=urllib.parse.urlencode({
+                'scores': json.dumps([
+                    {'Name': player, 'RawScore': score, 'Chombos': 0}
+                    for player, score in zip(table, raw)])}))
+            if data is not None and data.get('status') != 0:
+                self.errors['/addgame'] += 1
+
+    async def run(self):
+        self.running = True
+        tasks = [self.visitor(random.Random(self.seed + i))
+                 for i in range(self.users)]
+        tasks += [self.tablet(random.Random(-self.seed - i))
+                  for i in range(1, self.tablets + 1)]
+        if self.gameInterval > 0:
+            tasks.append(self.scorekeeper(random.Random(self.seed - 1)))
+        futures = [tornado.gen.convert_yielded(task) for task in tasks]
+        start = time.perf_counter()
+        await tornado.gen.sleep(self.duration)
+        self.running = False
+        self.elapsed = time.perf_counter() - start
+        for future in futures:
+            future.cancel()
+
+    def report(self):
+        """Return a dictionary of the request count, errors, throughput,
+        and latency percentiles in milliseconds of each route and in
+        total"""
+        results = collections.OrderedDict()
+        everything = []
+        for route in sorted(self.latencies):
+            everything.extend(self.latencies[route])
+        for route, latencies in sorted(self.latencies.items()) + [
+                ('Total', everything)]:
+            latencies = sorted(latencies)
+            results[route] = {
+                'requests': len(latencies),
+                'errors': (sum(self.errors.values()) if route == 'Total' else
+                           self.errors[route]),
+                'rate': len(latencies) / self.elapsed,
+                'p50': 1000 * quantile(latencies, 0.5),
+                'p95': 1000 * quantile(latencies, 0.95),
+                'p99': 1000 * quantile(latencies, 0.99),
+                'max': 1000 * latencies[-1]}
+        return results
+
+def copy_database(source, destination):
+    "Copy a database with the SQLite backup API so the source is unchanged"
+    sourcedb = sqlite3.connect(source)
+    copydb = sqlite3.connect(destination)
+    sourcedb.backup(copydb)
+    copydb.close()
+    sourcedb.close()
+
+def generate_database(dbfile, scale, years, seed):
+    "Generate a synthetic database in a separate process"
+    import db
+    import gendata
+    settings.DBFILE = dbfile
+    settings.DBBACKUPS = os.path.join(os.path.dirname(dbfile), 'backups')
+    db.changeLogEnabled = False
+    db.init(force=True, dbfile=dbfile)
+    gendata.generate(players=60 * scale, years=years,
+                     gamesPerNight=6 * scale, seed=seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'database', nargs='?',
+        help='Database to test with.  It is copied so the test does not '
+        'change it.  Defaults to one made by gendata.py.')
+    parser.add_argument(
+        '-x', '--scale', type=int, default=1,
+        help='Scale of the generated database (see gendata.py).')
+    parser.add_argument(
+        '-y', '--years', type=float, default=3,
+        help='Years of games in the generated database.')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=60,
+        help='Seconds to run the test.')
+    parser.add_argument(
+        '-u', '--users', type=int, default=20,
+        help='Number of simultaneous visitors.')
+    parser.add_argument(
+        '-t', '--tablets', type=int, default=4,
+        help='Number of seating tablets.')
+    parser.add_argument(
+        '--think', type=float, default=2.0,
+        help='Average seconds visitors pause between requests.')
+    parser.add_argument(
+        '--poll', type=float, default=5.0,
+        help='Seconds between seating tablet updates.')
+    parser.add_argument(
+        '-g', '--game-interval', type=float, default=30.0,
+        help='Average seconds between games entered.  0 for none.')
+    parser.add_argument(
+        '-m', '--mix', default=','.join(
+            '{}={}'.format(*item) for item in activities.items()),
+        help='Relative frequencies of the visitor activities.  '
+        'Defaults to %(default)s.')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8765,
+        help='Port for the server.')
+    parser.add_argument(
+        '-s', '--seed', type=int, default=1,
+        help='Seed for the random number generators.')
+    parser.add_argument(
+        '-o', '--output',
+        help='Write the results as JSON to this file.')
+
+    args = parser.parse_args()
+    mix = collections.OrderedDict()
+    for item in args.mix.split(','):
+        name, weight = item.split('=')
+        if name not in activities:
+            parser.error('Unknown activity {}.  Choose from {}'.format(
+                name, ', '.join(activities)))
+        mix[name] = float(weight)
+
+    tempdir = tempfile.TemporaryDirectory()
+    dbfile = os.path.join(tempdir.name, 'loadtest.db')
+    spawn = multiprocessing.get_context('spawn')
+    if args.database:
+        copy_database(args.database, dbfile)
+    else:
+        print('Generating a database at scale {}'.format(args.scale))
+        generator = spawn.Process(target=generate_database, args=(
+            dbfile, args.scale, args.years, args.seed))
+        generator.start()
+        generator.join()
+        if generator.exitcode != 0:
+            sys.exit(generator.exitcode)
+    with sqlite3.connect(dbfile) as con:
+        players = [row[0] for row in con.execute(
+            "SELECT Name FROM Players WHERE Name != ? AND"
+            "  Id IN (SELECT PlayerId FROM Scores)",
+            (scores.unusedPointsPlayerName,))]
+    if len(players) < 5:
+        print('The database needs at least 5 players with games')
+        sys.exit(1)
+
+    ready = spawn.Event()
+    server = spawn.Process(target=serve, args=(dbfile, args.port, ready),
+                           daemon=True)
+    server.start()
+    if not ready.wait(600):
+        print('The server did not start')
+        server.terminate()
+        sys.exit(1)
+
+    test = LoadTest('http://127.0.0.1:{}'.format(args.port), players,
+                    args.duration, args.users, args.tablets, args.think,
+                    args.poll, args.game_interval, mix, args.seed)
+    print('Running {} visitors and {} tablets for {} seconds'.format(
+        args.users, args.tablets, args.duration))
+    tornado.ioloop.IOLoop.current().run_sync(test.run)
+    server.terminate()
+    server.join()
+
+    results = test.report()
+    width = max(len(route) for route in results)
+    print('{:{width}} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'Route', 'Requests', 'Errors', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'Max ms', width=width))
+    for route, result in results.items():
+        print('{:{width}} {requests:8d} {errors:6d} {rate:8.2f} {p50:8.1f} '
+              '{p95:8.1f} {p99:8.1f} {max:8.1f}'.format(
+                  route, width=width, **result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'arguments': vars(args), 'seconds': test.elapsed,
+                       'routes': results}, output, indent=2)
@@ -8,7 +8,6 @@ import json
 import re
 import urllib
 import tornado.web
-from passlib.hash import pbkdf2_sha256
 import logging
 
 import handler
@@ -18,6 +17,9 @@ import util
 
 log = logging.getLogger("WebServer")
 
+# Password hashing is only needed for logins and account changes
+passlib_hash = util.lazy_import('passlib.hash')
+
 def format_invite(clubname, host, code):
     return """
 <p>You've been invited to {clubname}\n<br />
@@ -153,7 +155,7 @@ class VerifyHandler(handler.BaseHandler):
                 return
 
             with db.getCur() as cur:
-                passhash = pbkdf2_sha256.encrypt(password)
+                passhash = passlib_hash.pbkdf2_sha256.encrypt(password)
 
                 cur.execute("INSERT INTO Users (Email, Password) VALUES (LOWER(?), ?)", (email, passhash))
                 self.set_secure_cookie("user", str(cur.lastrowid))
@@ -192,7 +194,8 @@ class ResetPasswordHandler(handler.BaseHandler):
 Click <a href="http://{host}/reset/{code}">this link</a> to reset your password,
 or copy and paste the following into your URL bar:<br />
 http://{host}/reset/{code} </p>
-""".format(clubname=settings.CLUBNAME, host=self.request.host, code=code))
+""".format(clubname=settings.CLUBNAME, host=self.request.host, code=code),
+                    cur)
                 self.render("message.html",
                             message = "Your password reset link has been sent")
             else:
@@ -240,7 +243,7 @@ class ResetPasswordLinkHandler(handler.BaseHandler):
                     self.render("resetpassword.html", email = email, id = q,
                     message = "Your passwords didn't match")
                     return
-                passhash = pbkdf2_sha256.encrypt(password)
+                passhash = passlib_hash.pbkdf2_sha256.encrypt(password)
 
                 cur.execute("UPDATE Users SET Password = ? WHERE Id = ?", (passhash, id))
                 cur.execute("DELETE FROM ResetLinks WHERE Id = ?", (q,))
@@ -278,7 +281,7 @@ class LoginHandler(handler.BaseHandler):
                 passhash = row[1]
                 playerId = row[2]
 
-                if pbkdf2_sha256.verify(password, passhash):
+                if passlib_hash.pbkdf2_sha256.verify(password, passhash):
                     self.set_secure_cookie("user", str(userID))
                     log.info("Successful login for {0} (ID = {1})".format(
                         email, userID))
@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
-# Utility for sending email invitations from the command line
-usage='''mail_invite.py [-v] email_address [email_address ...]
-
-where -v enables verbose log messages (level = DEBUG)
+__doc__ = '''
+Utility for sending email invitations from the command line.  Addresses
+can be given as arguments or read, one or more per line, from a file or
+standard input.  All the invitations are added to the outbox in one
+transaction and then sent by a few SMTP connections at a limited rate.
+Invitations that can't be sent yet are retried by the web server.
+The result for each address is printed at the end.
 '''
 
-import sys, signal
+import re, argparse, time, collections
 
 import util
 import db
-import datetime
 import settings
 import login
 import logging
-from quemail import QueMail
+import outbox
+from quemail import QueMail, RateLimit, Email
 
 log = logging.getLogger("QueMail")
 log.setLevel(logging.INFO)
@@ -22,53 +25,142 @@ log.setLevel(logging.INFO)
 if not getattr(settings, 'WEBHOST', None):
     settings.WEBHOST = 'seattlemahjong.club'
 
-def email(email_address):
-    with db.getCur() as cur:
-        code = util.randString(32)
-        cur.execute(
-            "INSERT INTO VerifyLinks (Id, Email, Expires) VALUES (?, ?, ?)",
-            (code, email_address, 
-             (datetime.date.today() + datetime.timedelta(days=7)).isoformat()))
-
-        util.sendEmail(email_address,
-                       "Your {0} Account".format(settings.CLUBNAME),
-                       login.format_invite(
-                           settings.CLUBNAME, settings.WEBHOST, code))
+def read_addresses(stream):
+    "Generate the words with an @ in them from each line of a text stream"
+    for line in stream:
+        for word in re.split(r'[\s,;]+', line):
+            if '@' in word:
+                yield word.strip('<>"\'')
 
-qm = None
+def invite(addresses):
+    """Create verify links for the addresses and queue their invitations
+    in one transaction.  Returns a dictionary with the result of each
+    address.  Addresses that are invalid, repeated, or already have an
+    account are skipped.  The queued invites get their outbox Id."""
+    results = {}
+    with db.getCur() as cur:
+        cur.execute("SELECT Email FROM Users")
+        existing = set(row[0].lower() for row in cur.fetchall())
+        links = []
+        for address in addresses:
+            if address in results:
+                continue
+            if not re.match("^[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]+$", address,
+                            flags=re.IGNORECASE):
+                results[address] = {'status': 'skipped',
+                                    'error': 'not a valid email address'}
+            elif address.lower() in existing:
+                results[address] = {'status': 'skipped',
+                                    'error': 'account already exists'}
+            else:
+                results[address] = {'status': 'queued'}
+                links.append((util.randString(32), address))
+        cur.executemany(
+            "INSERT INTO VerifyLinks (Id, Email, Expires) "
+            "VALUES (?, LOWER(?), ?)",
+            [(code, address, login.expiration_date().isoformat())
+             for code, address in links])
+        cur.execute("SELECT COALESCE(MAX(Id), 0) FROM Outbox")
+        lastId = cur.fetchone()[0]
+        subject = "Your {0} Account".format(settings.CLUBNAME)
+        outbox.enqueue(cur, [
+            Email(subject=subject, adr_to=address, adr_from=settings.EMAILFROM,
+                  text=login.format_invite(
+                      settings.CLUBNAME, settings.WEBHOST, code),
+                  mime_type='html')
+            for code, address in links])
+        cur.execute("SELECT Id, Recipient FROM Outbox WHERE Id > ?", (lastId,))
+        for id, address in cur.fetchall():
+            results[address]['id'] = id
+    return results
 
-def sigint_handler(signum, frame):
-    qm.end()
+def send(connections=3, rate=5):
+    """Send the email in the outbox that is due using a pool of SMTP
+    connections, sending no more than rate emails per second in total.
+    Returns when there is none left to send now."""
+    limit = RateLimit(rate) if rate else None
+    qms = []
+    for i in range(connections):
+        qm = QueMail()
+        qm.init(settings.EMAILSERVER, settings.EMAILUSER,
+                settings.EMAILPASSWORD, settings.EMAILPORT,
+                settings.EMAILUSETLS, max_attempts=settings.EMAILMAXATTEMPTS,
+                retry_delay=settings.EMAILRETRYDELAY, outbox=outbox.Outbox(),
+                batch_size=10, rate_limit=limit)
+        qm.name = "QueMail-{}".format(i + 1)
+        qm.start()
+        qms.append(qm)
+    for qm in qms:
+        qm.end()
 
-def init():
-    qm = QueMail.get_instance()
-    qm.init(settings.EMAILSERVER, settings.EMAILUSER, 
-            settings.EMAILPASSWORD, settings.EMAILPORT,
-            settings.EMAILUSETLS)
-    qm.start()
-    return qm
+def update_results(results):
+    """Update the status of queued invites from the outbox.  Sent ones
+    have been removed from it."""
+    ids = dict((result['id'], address) for address, result in results.items()
+               if 'id' in result)
+    unsent = {}
+    with db.getCur() as cur:
+        cur.execute("SELECT Id, NextAttempt, Error FROM Outbox")
+        for id, nextAttempt, error in cur.fetchall():
+            if id in ids:
+                unsent[id] = (nextAttempt, error)
+    for id, address in ids.items():
+        if id not in unsent:
+            results[address]['status'] = 'sent'
+        elif unsent[id][0] is None:
+            results[address].update(status='failed', error=unsent[id][1])
+        elif unsent[id][1]:
+            results[address].update(status='retrying', error=unsent[id][1])
 
 if __name__ == '__main__':
-    if '-v' in sys.argv[1:]:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'address', nargs='*', help='Email address to invite.')
+    parser.add_argument(
+        '-f', '--file', type=argparse.FileType('r'),
+        help='File of email addresses to invite.  Use - for standard input.')
+    parser.add_argument(
+        '-c', '--connections', type=int, default=3,
+        help='Number of SMTP connections to send with.')
+    parser.add_argument(
+        '-r', '--rate', type=float, default=5,
+        help='Most emails to send per second.')
+    parser.add_argument(
+        '-q', '--queue-only', default=False, action='store_true',
+        help='Only add the invitations to the outbox for the web server to '
+        'send.')
+    parser.add_argument(
+        '-v', '--verbose', default=False, action='store_true',
+        help='Enable verbose log messages (level = DEBUG).')
+
+    args = parser.parse_args()
+    if args.verbose:
         print('Using verbose logging')
         log.setLevel(logging.DEBUG)
-        pos = sys.argv.index('-v')
-        sys.argv[pos:pos+1] = []
-        
-    valid_emails = [arg for arg in sys.argv[1:] if '@' in arg and '.' in arg]
-    if len(valid_emails) < len(sys.argv[1:]):
-        for arg in [a for a in sys.argv[1:] if not ('@' in a and '.' in a)]:
-            print('Skipped {} because it is not a valid email address'.format(
-                repr(arg)))
-        
-    if len(valid_emails):
-        qm = init()
-        signal.signal(signal.SIGINT, sigint_handler)
-        
-        for address in valid_emails:
-            email(address)
-        print('Queued {} email{} to be sent.'.format(
-            len(valid_emails), '' if len(valid_emails) == 1 else 's'))
-        
-        print('Use Ctrl-C and wait 5 seconds to exit')
-        qm.join()
+    addresses = list(args.address)
+    if args.file:
+        addresses.extend(read_addresses(args.file))
+    if not addresses:
+        parser.error('No email addresses given')
+
+    db.init()
+    start = time.time()
+    results = invite(addresses)
+    queued = sum(1 for result in results.values() if 'id' in result)
+    print('Queued {} email{} to be sent.'.format(
+        queued, '' if queued == 1 else 's'))
+    if queued and not args.queue_only:
+        send(args.connections, args.rate)
+        update_results(results)
+
+    for address, result in results.items():
+        print('{}: {}{}'.format(
+            address, result['status'],
+            ' ({})'.format(result['error']) if 'error' in result else ''))
+    counts = collections.Counter(
+        result['status'] for result in results.values())
+    print(', '.join('{} {}'.format(count, status)
+                    for status, count in sorted(counts.items())),
+          'in {:.1f} seconds'.format(time.time() - start))
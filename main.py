@@ -15,7 +15,6 @@ import os
 import stat
 import math
 import tornado.httpserver
-from tornado.httpclient import AsyncHTTPClient
 import tornado.ioloop
 import tornado.options
 import tornado.web
@@ -40,6 +39,10 @@ import playerstats
 import players
 import ratings
 import version
+import export
+import jobs
+import metrics
+import outbox
 
 # import and define tornado-y things
 from tornado.options import options
@@ -186,9 +189,16 @@ class PointCalculator(handler.BaseHandler):
     def get(self):
         self.render("pointcalculator.html")
 
+class MetricsHandler(handler.BaseHandler):
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(await db.run(metrics.prometheus_text))
+
 class Application(tornado.web.Application):
     def __init__(self, force=False):
         db.init(force=force)
+        ratings.initRatingHistory()
+        db.check_statements()
 
         handlers = [
                 (r"/", MainHandler),
@@ -204,6 +214,9 @@ class Application(tornado.web.Application):
                 (r"/leaderdata(/[^/]*)?", leaderboard.LeaderDataHandler),
                 (r"/ratings", ratings.RatingsHandler),
                 (r"/ratingsdata", ratings.RatingsDataHandler),
+                (r"/ratingsdata/history", ratings.RatingHistoryDataHandler),
+                (r"/export/(scores|games|leaderboards)\.(csv|ndjson)",
+                 export.ExportHandler),
                 (r"/history(/[0-9]+)?", HistoryHandler),
                 (r"/playerhistory/(.*?)(/[0-9]+)?", PlayerHistory),
                 (r"/playerstats/([^/]+)/?([^/]+)?", playerstats.PlayerStatsHandler),
@@ -235,10 +248,15 @@ class Application(tornado.web.Application):
                 (r"/admin/quarters", admin.QuartersHandler),
                 (r"/admin/deletequarter/([^/]*)", admin.DeleteQuarterHandler),
                 (r"/admin/delete/([0-9]*)", admin.DeleteGameHandler),
+                (r"/admin/import", admin.ImportGamesHandler),
+                (r"/admin/jobs", jobs.JobStatusHandler),
+                (r"/admin/queries", admin.QueryStatsHandler),
                 (r"/admin/edit/([0-9]*)", admin.EditGameHandler),
                 (r"/admin/promote/([0-9]*)", admin.PromoteUserHandler),
                 (r"/admin/demote/([0-9]*)", admin.DemoteUserHandler),
                 (r"/version", version.VersionHandler),
+                (r"/version.json", version.VersionDataHandler),
+                (r"/metrics", MetricsHandler),
         ]
         settings = dict(
                 template_path = os.path.join(os.path.dirname(__file__), "templates"),
@@ -311,8 +329,19 @@ def main():
         qm = QueMail.get_instance()
         qm.init(settings.EMAILSERVER, settings.EMAILUSER,
                 settings.EMAILPASSWORD, settings.EMAILPORT, 
-                settings.EMAILUSETLS)
+                settings.EMAILUSETLS, max_attempts=settings.EMAILMAXATTEMPTS,
+                retry_delay=settings.EMAILRETRYDELAY, outbox=outbox.Outbox())
         qm.start()
+        metrics.gauge('email_queued', 'Emails waiting to be sent',
+                      qm.stats, key='queued')
+        metrics.gauge('email_retrying', 'Emails waiting to be sent again',
+                      qm.stats, key='retrying')
+        metrics.gauge('email_dead_letters', 'Emails that could not be sent',
+                      qm.stats, key='dead')
+        metrics.gauge('email_sent_total', 'Emails sent',
+                      qm.stats, 'counter', 'sent')
+        metrics.gauge('email_failures_total', 'Failed attempts to send email',
+                      qm.stats, 'counter', 'failures')
 
     http_server = tornado.httpserver.HTTPServer(Application(force=force),
                                                 max_buffer_size=24*1024**3)
@@ -323,6 +352,9 @@ def main():
 
     signal.signal(signal.SIGINT, sigint_handler)
 
+    # Look up the version once the server is running so it's ready when
+    # first requested without delaying startup
+    tornado.ioloop.IOLoop.current().add_callback(version.commit_info)
     tornado.ioloop.PeriodicCallback(periodicCleanup, 60 * 60 * 1000).start() # run periodicCleanup once an hour
     # start up web server
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Collect the latency, database time, template render time, and response
+size of web requests for each route and report them in the Prometheus
+text format, with percentiles over sliding time windows.
+"""
+
+import time
+import threading
+import collections
+
+import settings
+
+# Samples of recent requests for each route, oldest first, as tuples of
+# (time, latency, database seconds, render seconds, response bytes)
+_samples = collections.defaultdict(
+    lambda: collections.deque(maxlen=settings.METRICSSAMPLES))
+# Totals since startup for each route, method, and status
+_totals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0])
+_lock = threading.Lock()
+# Functions giving the current values of other measures, like queue
+# lengths, by name, with their descriptions, types, and result keys
+_gauges = collections.OrderedDict()
+
+measures = (
+    ('request_seconds', 'Time to handle requests'),
+    ('database_seconds', 'Time spent in database queries per request'),
+    ('render_seconds', 'Time spent rendering templates per request'),
+    ('response_bytes', 'Size of responses'),
+)
+quantiles = (0.5, 0.9, 0.95, 0.99)
+
+def record(route, method, status, latency, dbtime, rendertime, size):
+    "Record the measurements of one request"
+    now = time.time()
+    with _lock:
+        _samples[route].append((now, latency, dbtime, rendertime, size))
+        totals = _totals[(route, method, status)]
+        totals[0] += 1
+        for i, value in enumerate((latency, dbtime, rendertime, size)):
+            totals[i + 1] += value
+
+def gauge(name, description, fn, kind='gauge', key=None):
+    """Report the number returned by fn() as the named measure.  The kind
+    is 'counter' for totals that only increase.  With a key, fn returns a
+    dictionary and the measure is its value for the key.  Gauges sharing
+    the same fn call it only once for each report."""
+    _gauges[name] = (description, fn, kind, key)
+
+def quantile(values, q):
+    "Return the q quantile of a sorted list of values"
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def label(**labels):
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels.items()) + '}'
+
+def prometheus_text(prefix='mahjong_'):
+    """Return the metrics in the Prometheus text exposition format.
+    Quantiles of each measure are given for each window in METRICSWINDOWS
+    seconds, and the sums and counts are totals since startup."""
+    now = time.time()
+    with _lock:
+        samples = dict((route, list(s)) for route, s in _samples.items())
+        totals = dict((key, list(t)) for key, t in _totals.items())
+    routeTotals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0])
+    for (route, method, status), total in totals.items():
+        for i, value in enumerate(total):
+            routeTotals[route][i] += value
+
+    lines = ['# HELP {}requests_total Requests handled'.format(prefix),
+             '# TYPE {}requests_total counter'.format(prefix)]
+    for (route, method, status), total in sorted(totals.items()):
+        lines.append('{}requests_total{} {}'.format(
+            prefix, label(route=route, method=method, status=status),
+            total[0]))
+    for m, (name, description) in enumerate(measures):
+        lines += ['# HELP {}{} {}'.format(prefix, name, description),
+                  '# TYPE {}{} summary'.format(prefix, name)]
+        for route in sorted(routeTotals):
+            for window in settings.METRICSWINDOWS:
+                values = sorted(sample[m + 1] for sample in samples.get(
+                    route, []) if sample[0] >= now - window)
+                if not values:
+                    continue
+                for q in quantiles:
+                    lines.append('{}{}{} {}'.format(
+                        prefix, name, label(route=route, window=window,
+                                            quantile=q),
+                        quantile(values, q)))
+            lines.append('{}{}_sum{} {}'.format(
+                prefix, name, label(route=route), routeTotals[route][m + 1]))
+            lines.append('{}{}_count{} {}'.format(
+                prefix, name, label(route=route), routeTotals[route][0]))
+    results = {}
+    for name, (description, fn, kind, key) in list(_gauges.items()):
+        if fn not in results:
+            results[fn] = fn()
+        value = results[fn] if key is None else results[fn][key]
+        lines += ['# HELP {}{} {}'.format(prefix, name, description),
+                  '# TYPE {}{} {}'.format(prefix, name, kind),
+                  '{}{} {}'.format(prefix, name, value)]
+    return '\n'.join(lines) + '\n'
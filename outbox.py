@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Durable queue of outgoing email in the Outbox table.  util.sendEmail adds
+messages to it in the caller's transaction, and the QueMail thread claims
+them in batches, sends them, and records the results.  Messages that
+haven't been sent survive restarts of the server.
+
+A message is due when its NextAttempt time (in seconds since the epoch)
+has passed.  Claiming a batch moves the NextAttempt of its messages
+CLAIMSECONDS ahead, so another sender, like mail_invite.py, doesn't send
+them too, and a sender that stops before finishing leaves them to be
+claimed again later.  Sent messages are deleted.  Messages that can't be
+sent have a NULL NextAttempt and keep their last Error.
+"""
+
+import time
+import datetime
+
+import db
+from quemail import Email
+
+CLAIMSECONDS = 15 * 60
+
+columns = ['Id', 'Recipient', 'Sender', 'Subject', 'Body', 'MimeType',
+           'Attempts']
+
+def enqueue(cur, emails):
+    """Add Email objects to the outbox with the cursor of an open
+    transaction.  They can be claimed once it is committed."""
+    now = time.time()
+    cur.executemany(
+        "INSERT INTO Outbox (Recipient, Sender, Subject, Body, MimeType,"
+        "  Queued, Attempts, NextAttempt) VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+        [(eml.adr_to, eml.adr_from, eml.subject, eml.text, eml.mime_type,
+          datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), now)
+         for eml in emails])
+
+class Outbox():
+    "The Outbox table as the store of emails for QueMail"
+    def add(self, emails):
+        with db.getCur() as cur:
+            enqueue(cur, emails)
+
+    def claim(self, limit):
+        """Return up to limit due emails in the order they were queued and
+        postpone them for CLAIMSECONDS"""
+        now = time.time()
+        with db.getCur() as cur:
+            cur.execute(
+                "UPDATE Outbox SET NextAttempt = ? WHERE Id IN ("
+                "  SELECT Id FROM Outbox WHERE NextAttempt <= ?"
+                "  ORDER BY NextAttempt, Id LIMIT ?) RETURNING {0}".format(
+                    ",".join(columns)),
+                (now + CLAIMSECONDS, now, limit))
+            rows = sorted(cur.fetchall())
+        return [Email(id=row[0], adr_to=row[1], adr_from=row[2],
+                      subject=row[3], text=row[4], mime_type=row[5],
+                      attempts=row[6]) for row in rows]
+
+    def update(self, sent=[], retry=[], dead=[]):
+        """Delete the sent emails and record the attempts of the others,
+        which are retried at their retry_at time or never if dead"""
+        with db.getCur() as cur:
+            cur.executemany("DELETE FROM Outbox WHERE Id = ?",
+                            [(eml.id,) for eml in sent])
+            cur.executemany(
+                "UPDATE Outbox SET Attempts = ?, NextAttempt = ?, Error = ?"
+                "  WHERE Id = ?",
+                [(eml.attempts, eml.retry_at, eml.error, eml.id)
+                 for eml in retry] +
+                [(eml.attempts, None, eml.error, eml.id) for eml in dead])
+
+    def next_due(self):
+        "Return the time the next email is due, if any"
+        with db.getCur() as cur:
+            cur.execute("SELECT MIN(NextAttempt) FROM Outbox")
+            return cur.fetchone()[0]
+
+    def stats(self):
+        "Return counts of the emails queued, being retried, and dead"
+        with db.getCur() as cur:
+            cur.execute(
+                "SELECT COALESCE(SUM(NextAttempt IS NOT NULL AND Attempts = 0),"
+                "    0),"
+                "  COALESCE(SUM(NextAttempt IS NOT NULL AND Attempts > 0), 0),"
+                "  COALESCE(SUM(NextAttempt IS NULL), 0) FROM Outbox")
+            queued, retrying, dead = cur.fetchone()
+        return {'queued': queued, 'retrying': retrying, 'dead': dead}
@@ -10,16 +10,30 @@ import db
 import settings
 import scores
 
+playerFields = db.table_field_names('Players')
+playerMembershipsSQL = db.statement(
+    'playerMemberships',
+    "SELECT {}, QuarterId FROM Players"
+    " LEFT OUTER JOIN Memberships"
+    " ON Players.Id = Memberships.PlayerId"
+    " WHERE Id != ?"
+    " ORDER BY Name ASC, QuarterId ASC".format(', '.join(playerFields)),
+    scans=['Players'])
+playerGameCountsSQL = db.statement(
+    'playerGameCounts',
+    "SELECT Players.Id, Quarter, COUNT(Scores.Id)"
+    " FROM Players"
+    " LEFT OUTER JOIN Scores"
+    " ON Players.Id = Scores.PlayerId"
+    " WHERE Players.Id != ?"
+    " GROUP BY Players.Id, Scores.Quarter"
+    " ORDER BY Players.Id ASC, Quarter ASC",
+    scans=['Players'])
+
 class PlayersHandler(handler.BaseHandler):
     def get(self):
         with db.getCur() as cur:
-            playerFields = db.table_field_names('Players')
-            cur.execute(("SELECT {}, QuarterId FROM Players"
-                         " LEFT OUTER JOIN Memberships"
-                         " ON Players.Id = Memberships.PlayerId"
-                         " WHERE Id != ?"
-                         " ORDER BY Name ASC, QuarterId ASC").format(
-                             ', '.join(playerFields)),
+            cur.execute(playerMembershipsSQL,
                         (scores.getUnusedPointsPlayerID(),))
             rows = cur.fetchall()
             players = collections.OrderedDict({})
@@ -35,14 +49,7 @@ class PlayersHandler(handler.BaseHandler):
                 if memberQtr is not None:  # Memberships is a list of qtrs
                     players[row[0]]['Memberships'].append(memberQtr)
 
-            cur.execute(("SELECT Players.Id, Quarter, COUNT(Scores.Id)"
-                         " FROM Players"
-                         " LEFT OUTER JOIN Scores"
-                         " ON Players.Id = Scores.PlayerId"
-                         " WHERE Players.Id != ?"
-                         " GROUP BY Players.Id, Scores.Quarter"
-                         " ORDER BY Players.Id ASC, Quarter ASC").format(
-                             ', '.join(playerFields)),
+            cur.execute(playerGameCountsSQL,
                         (scores.getUnusedPointsPlayerID(),))
             # Update player dictionary with game counts
             for row in cur.fetchall():
@@ -118,13 +118,17 @@ class PlayerStatsHandler(handler.BaseHandler):
             playerID, name, meetupname, symbol = player
             isSelf = self.get_current_player() == stringify(playerID)
             eligible = leaderboard.get_eligible()
-            everplayed = any(eligible[qtr][playerID]['Played']
-                             for qtr in eligible)
+            everplayed = any(
+                leaderboard.eligibility(eligible, qtr, playerID, 'Played')
+                for qtr in eligible)
             quarterHistory = [
                 {'Name': qtr,
-                 'Played': eligible[qtr][playerID]['Played'],
-                 'Member': eligible[qtr][playerID]['Member'],
-                 'Eligible': eligible[qtr][playerID]['Eligible']}
+                 'Played': leaderboard.eligibility(
+                     eligible, qtr, playerID, 'Played'),
+                 'Member': leaderboard.eligibility(
+                     eligible, qtr, playerID, 'Member'),
+                 'Eligible': leaderboard.eligibility(
+                     eligible, qtr, playerID, 'Eligible')}
                 for qtr in sorted(eligible.keys())[-settings.TIMELINEQUARTERS:]]
             self.render("playerstats.html",
                         error = None,
@@ -21,22 +21,57 @@ Example of use:
 import smtplib
 import logging
 import time
+import heapq
+import itertools
+import collections
 
 from email.mime.text import MIMEText
 from email.utils import make_msgid, formatdate
 
 from time import sleep
-from queue import Queue
-from threading import Thread
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
 
 
 log = logging.getLogger("QueMail")
 
+def permanent_failure(error):
+    '''
+    Tells whether the SMTP server rejected a message with a permanent (5xx)
+    error, so sending it again would fail the same way
+    '''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in error.recipients.values())
+    return (isinstance(error, smtplib.SMTPResponseException) and
+            500 <= error.smtp_code < 600)
+
 class QueMail(Thread):
     instance = None
 
     def init(self, smtp_host, smtp_login, smtp_pswd,
-             smtp_port = 25, use_tls = False, queue_size = 100, interval=5):
+             smtp_port = 25, use_tls = False, queue_size = 100, interval=5,
+             max_attempts = 6, retry_delay = 30, max_retry_delay = 3600,
+             keepalive = 60, dead_letters = 100, outbox = None,
+             batch_size = 50, poll_interval = 60, rate_limit = None):
+        '''
+        @param interval: seconds to wait for the SMTP server to respond
+        @param max_attempts: number of times to try sending each email
+        @param retry_delay: seconds to wait before the first retry of an
+            email; each later retry waits twice as long as the previous one,
+            up to max_retry_delay seconds
+        @param keepalive: seconds to keep the SMTP connection open when no
+            email is waiting
+        @param dead_letters: number of emails that could not be sent to
+            keep in the dead_letters list
+        @param outbox: durable store of the emails to send used in place of
+            the in memory queue, like outbox.Outbox, with add, claim,
+            update, next_due, and stats methods
+        @param batch_size: number of emails to take from the outbox at once
+        @param poll_interval: longest time in seconds to wait before
+            checking the outbox for email, in case notify() isn't called
+        @param rate_limit: RateLimit to wait on before sending each email,
+            which may be shared by several QueMail threads
+        '''
         self._queue = Queue(queue_size)
         log.info("Initializing QueMail (queue size = %i). "
                  "Using SMTP server: %s:%i %s TLS." % (
@@ -48,8 +83,18 @@ class QueMail(Thread):
         self.smtp_port = smtp_port
         self.use_tls = use_tls
         self.check_interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.keepalive = keepalive
+        self.dead_letters = collections.deque(maxlen=dead_letters)
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.rate_limit = rate_limit
         try:
-            smtp = self.establish_SMTP_connection()
+            self._smtp = self.establish_SMTP_connection()
+            self._last_used = time.time()
         except Exception as e:
             log.error('Error establishing connection to SMTP server: {}'.format(
                 e))
@@ -58,71 +103,252 @@ class QueMail(Thread):
         Thread.__init__(self)
         self.daemon = True
         self._do_quit = False
-        self.setName("QueMail")
+        self.name = "QueMail"
+        self._queue = None
+        self._smtp = None
+        self._last_used = 0
+        self._retries = [] # heap of (time, sequence number, email)
+        self._sequence = itertools.count()
+        self._wakeup = Event()
+        self.outbox = None
+        self.batch_size = 50
+        self.poll_interval = 60
+        self.rate_limit = None
         self.smtp_host = None
         self.smtp_login = None
         self.smtp_password = None
         self.smtp_port = None
         self.use_tls = False
-        self.check_interval = interval # number of seconds between queue checks
+        self.check_interval = interval # seconds to wait for SMTP responses
+        self.max_attempts = 6
+        self.retry_delay = 30
+        self.max_retry_delay = 3600
+        self.keepalive = 60
+        self.dead_letters = collections.deque(maxlen=100)
+        self.sent = 0
+        self.failures = 0
+        self.connections = 0
 
     def end(self):
         '''
-        Waits until all emails will be sent and after that stops thread
+        Waits until all queued emails are sent (or fail) and after that
+        stops thread.  Emails waiting to be retried are not sent.
         '''
         log.info("Stopping QueMail thread...")
         self._do_quit = True
-        self.join()
+        if self.outbox is not None:
+            self.notify()
+        elif self._queue is not None:
+            self._queue.put(None)
+        if self.is_alive():
+            self.join()
         log.info("Stopped.")
 
     def run(self):
-        while not self._do_quit:
-            if not self._queue.empty():
-                smtp = None
-                try:
-                    smtp = self.establish_SMTP_connection()
-
-                    while not self._queue.empty():
-                        t = time.time()
-                        eml = self._queue.get()
-                        log.info(u"Sending (qs=%i): %s" % (self._queue.qsize(), eml))
-                        try:
-                            msg = eml.as_rfc_message()
-                            content = msg.as_string()
-                            log.debug(u"with content: %s" % content)
-                            smtp.sendmail(eml.adr_from, eml.adr_to, content)
-                            log.warning(u"Sent (qs=%i,t=%f): %s" % (self._queue.qsize(),time.time()-t, eml))
-                        except Exception as e:
-                            log.error(u"Exception occured while sending email: %s" % eml)
-                            log.exception(e)
-                            # FIXME not good idea: when exception occured, add email at end of queue
-                            self._queue.put(eml, False)
-                            sleep(1)
-                except Exception as e:
-                    log.exception(e)
-                finally:
-                    if smtp:
-                        smtp.quit()
-            sleep(self.check_interval)
+        if self.outbox is not None:
+            return self.drain_outbox()
+        while True:
+            eml = self.next_email()
+            if eml is not None:
+                result = self.deliver(eml)
+                if result == 'retry':
+                    heapq.heappush(self._retries,
+                                   (eml.retry_at, next(self._sequence), eml))
+                elif result == 'dead':
+                    self.dead_letters.append(eml)
+            elif self._do_quit and self._queue.empty():
+                break
+        self.close_SMTP_connection()
+        if self._retries:
+            log.warning("Stopped with %i emails waiting to be retried: %s" % (
+                len(self._retries),
+                ", ".join(str(eml) for t, n, eml in sorted(self._retries))))
+
+    def drain_outbox(self):
+        '''
+        Sends the emails in the outbox in batches as they come due, waiting
+        for notify() when none are due.  If the outbox can't be read or
+        updated, e.g. while the database is locked, logs the error and tries
+        again after poll_interval seconds.  The results of a sent batch are
+        recorded before any more emails are claimed.
+        '''
+        results = None
+        while True:
+            try:
+                if results is not None:
+                    self.outbox.update(**results)
+                    results = None
+                batch = self.outbox.claim(self.batch_size)
+                if batch:
+                    results = {'sent': [], 'retry': [], 'dead': []}
+                    for eml in batch:
+                        results[self.deliver(eml)].append(eml)
+                    continue
+                if self._do_quit:
+                    break
+                due = self.outbox.next_due()
+            except Exception as e:
+                log.error("Error using the outbox, retrying in %g seconds: %s"
+                          % (self.poll_interval, e))
+                if self._do_quit:
+                    break
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self.wait_for_email(due)
+        self.close_SMTP_connection()
+
+    def wait_for_email(self, due):
+        '''
+        Waits until notified of new email, the time an email is due, or
+        poll_interval seconds, closing an idle connection after keepalive
+        seconds
+        '''
+        now = time.time()
+        timeout = self.poll_interval
+        if due is not None:
+            timeout = max(0, min(timeout, due - now))
+        if self._smtp is not None:
+            idle = self._last_used + self.keepalive - now
+            if idle <= 0:
+                self.close_SMTP_connection()
+            else:
+                timeout = min(timeout, idle)
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def notify(self):
+        '''
+        Tells the thread that new email was added to the outbox
+        '''
+        self._wakeup.set()
+
+    def next_email(self):
+        '''
+        Returns the next email to send: a retry whose time has come or the
+        next queued email.  Blocks until one is ready, closing an idle
+        connection after keepalive seconds.  Returns None if woken without
+        an email to send.
+        '''
+        now = time.time()
+        if self._retries and self._retries[0][0] <= now:
+            return heapq.heappop(self._retries)[2]
+        timeout = self._retries[0][0] - now if self._retries else None
+        if self._smtp is not None:
+            idle = self._last_used + self.keepalive - now
+            if idle <= 0:
+                self.close_SMTP_connection()
+            else:
+                timeout = idle if timeout is None else min(timeout, idle)
+        if self._do_quit and self._queue.empty():
+            return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def deliver(self, eml):
+        '''
+        Sends one email.  Returns 'sent' if it was sent, 'retry' if it
+        failed but should be retried at eml.retry_at (with exponential
+        backoff), or 'dead' after max_attempts or a permanent failure
+        '''
+        if self.rate_limit is not None:
+            self.rate_limit.wait()
+        t = time.time()
+        eml.attempts += 1
+        log.info(u"Sending (attempt %i): %s" % (eml.attempts, eml))
+        try:
+            msg = eml.as_rfc_message()
+            content = msg.as_string()
+            log.debug(u"with content: %s" % content)
+            self.sendmail(eml.adr_from, eml.adr_to, content)
+            self.sent += 1
+            log.warning(u"Sent (t=%f): %s" % (time.time() - t, eml))
+            return 'sent'
+        except Exception as e:
+            self.failures += 1
+            eml.error = str(e)
+            if not isinstance(e, (smtplib.SMTPResponseException,
+                                  smtplib.SMTPRecipientsRefused)):
+                self.close_SMTP_connection()
+            if permanent_failure(e) or eml.attempts >= self.max_attempts:
+                log.error(u"Gave up after %i attempts sending %s: %s" % (
+                    eml.attempts, eml, e))
+                return 'dead'
+            delay = min(self.retry_delay * 2 ** (eml.attempts - 1),
+                        self.max_retry_delay)
+            eml.retry_at = time.time() + delay
+            log.warning(u"Retrying in %g seconds after failing to send "
+                        u"%s: %s" % (delay, eml, e))
+            return 'retry'
+
+    def sendmail(self, adr_from, adr_to, content):
+        '''
+        Sends a message on the open SMTP connection, connecting first if
+        needed.  If the server dropped the connection, reconnects and tries
+        once more.
+        '''
+        for retry in (False, True):
+            if self._smtp is None:
+                self._smtp = self.establish_SMTP_connection()
+            try:
+                self._smtp.sendmail(adr_from, adr_to, content)
+                self._last_used = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self.close_SMTP_connection()
+                if retry:
+                    raise
+                log.info(u"Reconnecting to SMTP server after: %s" % e)
 
     def establish_SMTP_connection(self):
         log.debug(u"Connecting to SMTP server: %s:%i%s using TLS" % (
             self.smtp_host, self.smtp_port, '' if self.use_tls else ' not'))
-        smtp = smtplib.SMTP(self.smtp_host, port=self.smtp_port)
+        smtp = smtplib.SMTP(self.smtp_host, port=self.smtp_port,
+                            timeout=self.check_interval)
         if self.use_tls:
             smtp.starttls()
             smtp.ehlo()
-        else:
-            smtp.connect()
-        smtp.login(self.smtp_login, self.smtp_password)
+        if self.smtp_login or self.smtp_password:
+            smtp.login(self.smtp_login, self.smtp_password)
+        self.connections += 1
         return smtp
 
+    def close_SMTP_connection(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                self._smtp.close()
+            self._smtp = None
+
     def send(self, eml):
+        if self.outbox is not None:
+            self.outbox.add([eml])
+            self.notify()
+            return
         if self._queue is None:
             return
         self._queue.put(eml, True, 5);
         log.debug(u'Accepted (qs=%i): %s' % (self._queue.qsize(), eml))
 
+    def stats(self):
+        '''
+        Returns counts of the emails that are queued, waiting to be retried,
+        sent, failed attempts, dead letters, and SMTP connections opened
+        '''
+        stats = {'queued': self._queue.qsize() if self._queue else 0,
+                 'retrying': len(self._retries),
+                 'sent': self.sent,
+                 'failures': self.failures,
+                 'dead': len(self.dead_letters),
+                 'connections': self.connections,
+                 'connected': self._smtp is not None}
+        if self.outbox is not None:
+            stats.update(self.outbox.stats())
+        return stats
+
     @classmethod
     def get_instance(cls):
         if not cls.instance:
@@ -130,6 +356,25 @@ class QueMail(Thread):
         return cls.instance
 
 
+class RateLimit(object):
+    '''
+    Spaces out the calls to wait() from any number of threads so they
+    return at most rate times per second
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+
 class Email(object):
     unique = 'unique-send'
 
@@ -146,6 +391,10 @@ class Email(object):
         self.adr_to = props.get('adr_to', None)
         self.adr_from = props.get('adr_from', None)
         self.mime_type = props.get('mime_type', 'plain')
+        self.attempts = props.get('attempts', 0)
+        self.error = None
+        self.retry_at = None
+        self.id = props.get('id', None)
 
     def __str__(self):
         return "Email to: %s, from: %s, sub: %s" % (self.adr_to, self.adr_from, self.subject)
@@ -162,3 +411,39 @@ class Email(object):
         msg['Reply-To'] = self.adr_from
         msg['Message-Id'] = make_msgid(Email.unique)
         return msg
+
+if __name__ == '__main__':
+    import sqlite3
+    logging.basicConfig(level=logging.INFO)
+
+    class TestOutbox():
+        "Outbox in memory whose first claim fails as if the database is locked"
+        def __init__(self, emails):
+            self.emails, self.failed = emails, False
+        def claim(self, limit):
+            if not self.failed:
+                self.failed = True
+                raise sqlite3.OperationalError('database is locked')
+            batch, self.emails = self.emails[:limit], self.emails[limit:]
+            return batch
+        def update(self, sent=[], retry=[], dead=[]):
+            self.emails.extend(retry)
+        def next_due(self):
+            return None
+
+    class TestQueMail(QueMail):
+        "QueMail that records the messages instead of sending them"
+        def sendmail(self, adr_from, adr_to, content):
+            self.delivered.append(adr_to)
+
+    qm = TestQueMail()
+    qm.outbox = TestOutbox([Email(id=1, adr_to='to@example.com',
+                                  adr_from='from@example.com', subject='Test')])
+    qm.poll_interval, qm.delivered = 0.1, []
+    qm.start()
+    deadline = time.time() + 5
+    while not qm.delivered and time.time() < deadline:
+        sleep(0.05)
+    qm.end()
+    assert qm.delivered == ['to@example.com'], qm.delivered
+    print('Email was delivered after the outbox failed once')
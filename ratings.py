@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import json
-
 import handler
+import jobs
 import db
 import settings
+import util
 
 import scores
 
@@ -13,7 +13,7 @@ class RatingsHandler(handler.BaseHandler):
         self.render("ratings.html")
 
 class RatingsDataHandler(handler.BaseHandler):
-    def get(self):
+    async def get(self):
         columns = ["name", "rating", "count"]
         query = """SELECT
             Players.Name,
@@ -23,7 +23,104 @@ class RatingsDataHandler(handler.BaseHandler):
           WHERE Players.Id != ?
           GROUP BY Players.Id
           ORDER BY Rating DESC;""".format(DEFAULT_RATING=settings.DEFAULT_RATING)
-        with db.getCur() as cur:
-            cur.execute(query, (scores.getUnusedPointsPlayerID(),))
-            players = [dict(zip(columns, row)) for row in cur.fetchall()]
-        self.write(json.dumps({'players':players}))
+        unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
+        rows = db.stream(query, (unusedPointsPlayerID,))
+        await self.write_json_list(
+            (dict(zip(columns, row)) async for row in rows),
+            before='{"players": [', after=']}')
+
+class RatingHistoryDataHandler(handler.BaseHandler):
+    """Return the rating history of players as JSON using the precomputed
+    snapshots in RatingHistory.  Optional query arguments:
+    player=P         only include player P (name or ID; may be repeated)
+    from=D1, to=D2   only include snapshots in the date range D1 to D2
+    points=N         downsample each player's history to at most N
+                     snapshots, always keeping the most recent one
+    """
+    async def get(self):
+        conditions = ["PlayerId != ?"]
+        bindings = [scores.getUnusedPointsPlayerID()]
+        players = self.get_arguments('player')
+        if players:
+            placeholders = ",".join(["?"] * len(players))
+            conditions += ["(Players.Name IN ({0}) OR Players.Id IN ({0}))"
+                           .format(placeholders)]
+            bindings += players * 2
+        for arg, test in (('from', '>='), ('to', '<=')):
+            value = self.get_argument(arg, None)
+            if value:
+                conditions += ["Date {} ?".format(test)]
+                bindings += [value]
+        points = self.get_argument('points', None)
+        points = int(points) if points and points.isdigit() else 0
+        if points > 0:
+            downsample = "Age % ((Snapshots + ? - 1) / ?) = 0"
+            bindings += [points, points]
+        else:
+            downsample = "1"
+
+        columns = ["date", "rating", "count"]
+        query = """SELECT Id, Name, Date, ROUND(Rating * 100) / 100, GameCount
+          FROM (SELECT Players.Id, Players.Name, Date, Rating, GameCount,
+                  ROW_NUMBER() OVER (PARTITION BY PlayerId ORDER BY Date DESC)
+                    - 1 AS Age,
+                  COUNT(*) OVER (PARTITION BY PlayerId) AS Snapshots
+                FROM RatingHistory JOIN Players ON PlayerId = Players.Id
+                WHERE {conditions})
+          WHERE {downsample}
+          ORDER BY Name, Id, Date;""".format(
+              conditions=" AND ".join(conditions), downsample=downsample)
+        snapshots = db.stream(query, bindings)
+        history = (
+            {'id': player[0], 'name': player[1],
+             'history': [dict(zip(columns, row[2:])) for row in rows]}
+            async for player, rows in util.async_groupby(
+                    snapshots, key=lambda row: row[0:2]))
+        await self.write_json_list(
+            history, before='{"players": [', after=']}')
+
+def scheduleRatingHistory(fromDate=None):
+    """Schedule a background job to regenerate the rating history from the
+    given date on.  Requests made while it waits are combined into one
+    starting from the earliest of their dates."""
+    jobs.schedule(('ratinghistory',), genRatingHistory, fromDate,
+                  merge=lambda waiting, new: (
+                      None if None in (waiting[0], new[0]) else
+                      min(waiting[0], new[0]),))
+
+def genRatingHistory(fromDate=None):
+    """Recalculates the rating history snapshots for every game date on or
+    after the given datetime object or date string.  If fromDate is None,
+    then recalculates the whole history.
+    Each snapshot records a player's rating and game count at the end of
+    one game date."""
+    fromDate = scores.dateString(fromDate) if fromDate else ''
+    # Get unused points playerID before opening cursor to change snapshots
+    unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
+    with db.getCur() as cur:
+        cur.execute("DELETE FROM RatingHistory WHERE Date >= ?", (fromDate,))
+        cur.execute(
+            """INSERT INTO RatingHistory (PlayerId, Date, Rating, GameCount)
+               SELECT PlayerId, Date, Rating, GameCount FROM (
+                 SELECT PlayerId, Date,
+                   SUM(SUM(DeltaRating)) OVER Running + ? AS Rating,
+                   SUM(COUNT(*)) OVER Running AS GameCount
+                 FROM Scores WHERE PlayerId != ?
+                 GROUP BY PlayerId, Date
+                 WINDOW Running AS (PARTITION BY PlayerId ORDER BY Date))
+               WHERE Date >= ?""",
+            (settings.DEFAULT_RATING, unusedPointsPlayerID, fromDate))
+
+def initRatingHistory():
+    "Build the rating history snapshots if there are scores but none exist"
+    with db.getCur() as cur:
+        cur.execute("SELECT EXISTS(SELECT 1 FROM Scores) AND"
+                    " NOT EXISTS(SELECT 1 FROM RatingHistory)")
+        missing = cur.fetchone()[0]
+    if missing:
+        genRatingHistory()
+
+if __name__ == '__main__':
+    import timeit
+    elapsed = timeit.timeit('genRatingHistory()', number=1, globals=globals())
+    print('Running genRatingHistory() took {} seconds'.format(elapsed))
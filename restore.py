@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Restore the database as it was at a given time from the most recent
+suitable full backup in the DBBACKUPS directory plus the change log of
+modifications to players, scores, memberships, quarters, user accounts,
+administrators, and user settings made since that backup.  The restored
+database is written to a new file, and its leaderboards and rating
+history are regenerated from the restored scores.
+"""
+
+import os
+import sqlite3
+import datetime
+import argparse
+
+import db
+import settings
+import leaderboard
+import ratings
+
+def change_log_entries(dbfile=None):
+    """Return a dictionary of the change log entries keyed by sequence
+    number.  If a sequence number was logged more than once, only the
+    last was committed."""
+    return dict((entry['seq'], entry) for entry in db.read_change_log(dbfile))
+
+def find_backup(sequence, dbfile=None):
+    """Find the newest backup holding no more than sequence changes.
+    Returns the backup file path and its sequence number or None, None
+    if none are suitable."""
+    best, bestSequence = None, -1
+    for backup in db.list_backups(dbfile=dbfile):
+        backupSequence = db.user_version(backup)
+        if bestSequence <= backupSequence <= sequence:
+            best, bestSequence = backup, backupSequence
+    return best, (bestSequence if best else None)
+
+def restore(when, output, dbfile=None, verbose=False):
+    """Restore the database as of the time string, when, to the output
+    file.  Times are in 'YYYY-MM-DD HH:MM:SS' format and may be truncated.
+    Returns the sequence number of the last change applied.
+    """
+    entries = change_log_entries(dbfile)
+    # Entries held in every kept backup are trimmed from the log, so start
+    # from the one before the earliest remaining entry
+    sequence = max([seq for seq, entry in entries.items()
+                    if entry['time'] <= when] + [min(entries, default=1) - 1])
+    backup, backupSequence = find_backup(sequence, dbfile)
+    if backup is None:
+        raise Exception('No backup found from before {}'.format(when))
+    missing = [seq for seq in range(backupSequence + 1, sequence + 1)
+               if seq not in entries]
+    if missing:
+        raise Exception('Change log is missing entries {}'.format(missing))
+    if os.path.exists(output):
+        raise Exception('Output file {} already exists'.format(output))
+    if verbose:
+        print('Restoring {} and applying changes {} through {}'.format(
+            backup, backupSequence + 1, sequence))
+
+    source = sqlite3.connect(backup)
+    con = sqlite3.connect(output)
+    source.backup(con)
+    source.close()
+    cur = con.cursor()
+    cur.execute("PRAGMA foreign_keys = 1")
+    for seq in range(backupSequence + 1, sequence + 1):
+        for change in entries[seq]['changes']:
+            if 'many' in change:
+                cur.executemany(change['sql'], change['many'])
+            else:
+                cur.execute(change['sql'], change['params'])
+        cur.execute("PRAGMA user_version = {0}".format(seq))
+    con.commit()
+    con.close()
+    return sequence
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'time', nargs='?',
+        default=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        help='Time to restore to in YYYY-MM-DD HH:MM:SS format.')
+    parser.add_argument(
+        'output',
+        help='File for the restored database.  It must not already exist.')
+    parser.add_argument(
+        '-d', '--database', default=settings.DBFILE,
+        help='Database whose backups and change log are used.')
+    parser.add_argument(
+        '-v', '--verbose', default=False, action='store_true',
+        help='Describe the restore.')
+
+    args = parser.parse_args()
+
+    sequence = restore(args.time, args.output, args.database, args.verbose)
+
+    # Regenerate the tables derived from the restored ones without
+    # recording them in the change log
+    db.changeLogEnabled = False
+    settings.DBFILE = args.output
+    leaderboard.genLeaderboard()
+    ratings.genRatingHistory()
+    print('Restored {} as of {} (change {}) to {}'.format(
+        args.database, args.time, sequence, args.output))
@@ -5,10 +5,15 @@ import handler
 import tornado.web
 import datetime
 import collections
+import threading
 
 import db
+import util
 import settings
 import leaderboard
+import ratings
+
+numpy = util.lazy_import('numpy', optional=True)
 
 umas = {4:[15,5,-5,-15],
         5:[15,5,0,-5,-15]}
@@ -80,13 +85,15 @@ class PointSettings(handler.BaseHandler):
 _unusedPointsPlayer = None
 unusedPointsPlayerName = '!#*UnusedPointsPlayer*#!'
 
+_unusedPointsLock = threading.Lock()
+
 def getUnusedPointsPlayerID():
     """ Get the ID of the Players table entry that records unused points in
     games.  If an entry doesn't exist, create one."""
     global _unusedPointsPlayer, unusedPointsPlayerName
     if _unusedPointsPlayer:
         return _unusedPointsPlayer
-    with db.getCur() as cur:
+    with _unusedPointsLock, db.getCur() as cur:
         cur.execute("SELECT Id from Players WHERE Name = ? AND"
                     " MeetupName IS NULL",
                     (unusedPointsPlayerName,))
@@ -104,14 +111,15 @@ def getUnusedPointsPlayerID():
 def getScore(score, uma, perPlayer):
     return (score - perPlayer) / 1000.0 + uma
 
-def rankGame(scores, perPlayer, unusedPointsIncr):
+def rankGame(scores, perPlayer, unusedPointsIncr, unusedPointsPlayerID=None):
     """Calculates rank, point penalties, and umas for a given game.
     Also validates game player names and point totals.
     The scores should be a list of dictionaries.
     Each dictionary should have either a 'PlayerId' or 'Name',
     a 'RawScore', and a 'Chombos' count.
     One of the players may be the UnusedPointsPlayer to represent points
-    that were not claimed at the end of play.
+    that were not claimed at the end of play.  Its ID is looked up in the
+    database unless unusedPointsPlayerID is given.
     Modifies the scores dictionaries adding the calculated fields.
     Returns a dictionary with a 'status' and a 'message' field.  Status of 0
     means success.
@@ -121,7 +129,8 @@ def rankGame(scores, perPlayer, unusedPointsIncr):
 
     hasUnusedPoints = False
     unusedPoints = 0
-    unusedPointsPlayerID = getUnusedPointsPlayerID()
+    if unusedPointsPlayerID is None:
+        unusedPointsPlayerID = getUnusedPointsPlayerID()
     total = 0
     uniqueIDs = set()
     pointHistogram = collections.defaultdict(lambda : 0)
@@ -189,6 +198,130 @@ def rankGame(scores, perPlayer, unusedPointsIncr):
     return {"status": 0, "realPlayerCount": realPlayerCount,
             "hasUnusedPoints": hasUnusedPoints}
 
+def rankGames(rawScores, chombos, playerCounts, perPlayer, unusedPointsIncr,
+              unusedPoints=None, unusedChombos=None, hasUnusedPoints=None):
+    """Calculates ranks, umas, and scores for a batch of games given as
+    columns, producing the same results as calling rankGame on each game.
+    rawScores and chombos are 2-dimensional with one row per game and one
+    column per seat.  Only the first playerCounts[g] seats of game g are
+    used; any others are padding.  perPlayer and unusedPointsIncr may be
+    single values or have one value per game.  unusedPoints and
+    unusedChombos hold the points and chombos of the UnusedPointsPlayer
+    for each game, if any.  hasUnusedPoints indicates which games have an
+    UnusedPointsPlayer; it defaults to those with non-zero unusedPoints.
+    Player names are not checked; callers must ensure players are distinct.
+    Returns a dictionary with 'status' and 'error' lists holding the
+    rankGame status and error message for each game, 'points', 'Rank',
+    'uma', and 'Score' arrays for each seat, and an 'unusedRank' array.
+    Results are NumPy arrays when NumPy is installed and lists otherwise.
+    """
+    if numpy is None:
+        return _rankGamesSlowly(
+            rawScores, chombos, playerCounts, perPlayer, unusedPointsIncr,
+            unusedPoints, unusedChombos, hasUnusedPoints)
+
+    counts = numpy.asarray(playerCounts, dtype=int)
+    games = len(counts)
+    raw = numpy.asarray(rawScores).reshape(games, -1)
+    seats = raw.shape[1]
+    seated = numpy.arange(seats) < counts[:, None]
+    points = raw - settings.CHOMBOPENALTY * numpy.asarray(
+        chombos).reshape(games, seats) * 1000
+    perPlayer = numpy.broadcast_to(perPlayer, (games,))
+    unusedPointsIncr = numpy.broadcast_to(unusedPointsIncr, (games,))
+    unusedRaw = numpy.zeros(games, dtype=raw.dtype) if unusedPoints is None \
+                else numpy.asarray(unusedPoints)
+    unused = unusedRaw - settings.CHOMBOPENALTY * (
+        0 if unusedChombos is None else numpy.asarray(unusedChombos)) * 1000
+    hasUnused = unusedRaw != 0 if hasUnusedPoints is None else \
+                numpy.asarray(hasUnusedPoints, dtype=bool)
+
+    # Rank is 1 + the number of players with more points.  Tied players
+    # split the umas for the places they span
+    higher = ((points[:, None, :] > points[:, :, None]) &
+              seated[:, None, :]).sum(axis=2)
+    ties = ((points[:, None, :] == points[:, :, None]) &
+            seated[:, None, :]).sum(axis=2)
+    ranks = numpy.where(seated, higher + 1, 0)
+    ties = numpy.where(seated, ties, 1)
+    umaTotals = numpy.zeros((6, 6), dtype=int)
+    for playerCount, uma in umas.items():
+        umaTotals[playerCount, 1:playerCount + 1] = numpy.cumsum(uma)
+    totals = umaTotals[numpy.clip(counts, 0, 5)]
+    first = numpy.where(seated, higher, 0)
+    last = numpy.minimum(first + ties, 5)
+    gameUmas = numpy.where(
+        seated,
+        (numpy.take_along_axis(totals, last, axis=1) -
+         numpy.take_along_axis(totals, first, axis=1)) / ties,
+        0)
+    gameScores = numpy.where(
+        seated, (points - perPlayer[:, None]) / 1000.0 + gameUmas, 0)
+
+    # The UnusedPointsPlayer is ranked after all players unless its points
+    # match those of the lowest player(s), in which case it shares their rank
+    lowest = numpy.where(seated, points, numpy.inf).min(axis=1)
+    unusedRank = numpy.where(
+        unused == lowest,
+        ((points > unused[:, None]) & seated).sum(axis=1) + 1,
+        counts + 1)
+
+    total = numpy.where(seated, raw, 0).sum(axis=1) + numpy.where(
+        hasUnused, unusedRaw, 0)
+    status, errors = [], []
+    for g in range(games):
+        error = None
+        if not (4 <= counts[g] and counts[g] <= 5):
+            error = "Please enter 4 or 5 scores"
+        elif hasUnused[g] and unusedRaw[g] % unusedPointsIncr[g] != 0:
+            error = "Unused points must be a multiple of {0}".format(
+                unusedPointsIncr[g])
+        elif total[g] != counts[g] * perPlayer[g]:
+            error = "Scores add up to {}, not {}".format(
+                total[g], counts[g] * perPlayer[g])
+        status.append(0 if error is None else 1)
+        errors.append(error)
+
+    return {"status": status, "error": errors, "points": points,
+            "Rank": ranks, "uma": gameUmas, "Score": gameScores,
+            "unusedRank": numpy.where(hasUnused, unusedRank, 0)}
+
+def _rankGamesSlowly(rawScores, chombos, playerCounts, perPlayer,
+                     unusedPointsIncr, unusedPoints, unusedChombos,
+                     hasUnusedPoints):
+    """Implement rankGames by calling rankGame on each game.  The
+    UnusedPointsPlayer is given the ID -1, so the database isn't used."""
+    result = {"status": [], "error": [], "points": [], "Rank": [], "uma": [],
+              "Score": [], "unusedRank": []}
+    for g, count in enumerate(playerCounts):
+        game = [{'PlayerId': 'seat{}'.format(seat),
+                 'RawScore': rawScores[g][seat], 'Chombos': chombos[g][seat]}
+                for seat in range(count)]
+        unusedRaw = 0 if unusedPoints is None else unusedPoints[g]
+        if (unusedRaw != 0 if hasUnusedPoints is None
+            else hasUnusedPoints[g]):
+            unusedScore = {
+                'PlayerId': -1, 'RawScore': unusedRaw,
+                'Chombos': 0 if unusedChombos is None else unusedChombos[g]}
+            game.append(unusedScore)
+        else:
+            unusedScore = {'Rank': 0}
+        seats = game[:count]
+        status = rankGame(
+            game,
+            perPlayer[g] if isinstance(perPlayer, (list, tuple)) else perPlayer,
+            unusedPointsIncr[g] if isinstance(unusedPointsIncr, (list, tuple))
+            else unusedPointsIncr,
+            unusedPointsPlayerID=-1)
+        result["status"].append(status["status"])
+        result["error"].append(status.get("error", None))
+        padding = [0] * (len(rawScores[g]) - len(seats))
+        for field in ["points", "Rank", "uma", "Score"]:
+            result[field].append(
+                [seat.get(field, 0) for seat in seats] + padding)
+        result["unusedRank"].append(unusedScore.get('Rank', 0))
+    return result
+
 def addGame(scores, gamedate = None, gameid = None):
     """Add or replace game scores for a particular game in the database.
     The scores should be a list of dictionaries.
@@ -229,6 +362,10 @@ def addGame(scores, gamedate = None, gameid = None):
     unusedPointsPlayerID = getUnusedPointsPlayerID()
 
     with db.getCur() as cur:
+        # Take the write lock before reading the last GameId so games
+        # added at the same time, e.g. on the database threads, get
+        # different ones
+        cur.execute("BEGIN IMMEDIATE")
         if gameid is None:
             cur.execute("SELECT COALESCE(GameId, 0) FROM Scores ORDER BY GameId DESC LIMIT 1")
             game_row = cur.fetchone()
@@ -276,9 +413,10 @@ def addGame(scores, gamedate = None, gameid = None):
                 values=",".join(["?"] * len(columns)))
         cur.executemany(query, rows)
 
-    leaderboard.genLeaderboard(gamedate)
+    leaderboard.scheduleLeaderboard(gamedate)
     if olddate != gamedate:
-        leaderboard.genLeaderboard(olddate)
+        leaderboard.scheduleLeaderboard(olddate)
+    ratings.scheduleRatingHistory(min(gamedate, olddate))
     return {"status":0}
 
 adjEvent = 0.5
@@ -316,37 +454,92 @@ def deltaRating(scores, player):
                     "  WHERE PlayerId = ? AND Date < ?",
                     (player['PlayerId'], gamedate))
         gameCount = cur.fetchone()[0]
-        adjPlayer = max(1 - (gameCount * 0.008), 0.2)
 
-    return (player['uma'] * 2 +
-            adjEvent * (avgOppRating - player['Rating'])
-            / 40) * adjPlayer
+    return ratingChange(player['uma'], player['Rating'], avgOppRating,
+                        gameCount)
+
+def ratingChange(uma, rating, avgOppRating, gameCount):
+    """Compute the change in a player's rating from one game given their
+    uma, their rating before the game, the average rating of their
+    opponents, and the number of games they played before it."""
+    adjPlayer = max(1 - (gameCount * 0.008), 0.2)
+    return (uma * 2 + adjEvent * (avgOppRating - rating) / 40) * adjPlayer
+
+scoreColumns = ["Id","PlayerId","GameId","Score","RawScore","Chombos","Date",
+                "DeltaRating","Rank"]
+# The statements for getScores keyed by its getNames and unusedPoints flags
+gameScoresSQL = {}
+for getNames in (False, True):
+    for unusedPoints in (False, True):
+        gameScoresSQL[getNames, unusedPoints] = db.statement(
+            ('allGameScores' if unusedPoints else 'gameScores') +
+            ('WithNames' if getNames else ''),
+            "SELECT Scores.{columns}{names} FROM Scores{join}"
+            " WHERE GameId = ?{unused}".format(
+                columns=",Scores.".join(scoreColumns),
+                names=",Name" if getNames else "",
+                join=" JOIN Players ON PlayerId = Players.Id"
+                if getNames else "",
+                unused="" if unusedPoints else " AND PlayerId != ?"))
 
 def getScores(gameid, getNames = False, unusedPoints = False):
+    columns = scoreColumns + (['Name'] if getNames else [])
+    bindings = [gameid] if unusedPoints else [
+        gameid, getUnusedPointsPlayerID()]
     with db.getCur() as cur:
-        columns = ["Id","PlayerId","GameId","Score","RawScore","Chombos","Date",
-                   "DeltaRating","Rank"]
-        queryColumns = ["Scores.Id","PlayerId","GameId","Score","RawScore","Chombos","Date",
-                   "DeltaRating","Rank"]
-        tables = ["Scores"]
-
-        if getNames:
-            columns += ['Name']
-            queryColumns += ['Name']
-            tables += ["JOIN Players ON PlayerId = Players.Id"]
-
-        conditions = ["GameId = ?"]
-        bindings = [gameid]
-
-        if not unusedPoints:
-            conditions += ["PlayerId != ?"]
-            bindings += [getUnusedPointsPlayerID()]
-
-        query = "SELECT {columns} FROM {tables} WHERE {conditions}".format(
-            columns=",".join(queryColumns),
-            tables=" ".join(tables),
-            conditions=" AND ".join(conditions))
-        cur.execute(query, bindings)
-
-        scores = [dict(zip(columns, row)) for row in cur.fetchall()]
-        return scores
+        cur.execute(gameScoresSQL[getNames, unusedPoints], bindings)
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+if __name__ == '__main__':
+    import timeit, argparse, random
+    parser = argparse.ArgumentParser(
+        description="Compare rankGames with rankGame on random games and "
+        "time their execution.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-n', '--number', type=int, default=10000,
+        help='Number of random games to rank')
+    args = parser.parse_args()
+
+    increment, perPlayer = settings.UNUSEDPOINTSINCREMENT, settings.SCOREPERPLAYER
+    counts, rawScores, chombos, unusedPoints = [], [], [], []
+    for g in range(args.number):
+        count = random.choice([4, 5])
+        unused = random.choice([0, 0, increment, 2 * increment])
+        raw = [random.randrange(-20, 80) * 100 for seat in range(count - 1)]
+        raw.append(count * perPlayer - unused - sum(raw))
+        counts.append(count)
+        rawScores.append(raw + [0] * (5 - count))
+        chombos.append([int(random.random() < 0.05) for seat in range(5)])
+        unusedPoints.append(unused)
+
+    elapsed = timeit.timeit(
+        'rankGames(rawScores, chombos, counts, perPlayer, increment,'
+        ' unusedPoints)', number=1, globals=globals())
+    batch = rankGames(rawScores, chombos, counts, perPlayer, increment,
+                      unusedPoints)
+    print('rankGames on {} games took {} seconds'.format(args.number, elapsed))
+    games = []
+    for g in range(args.number):
+        games.append([{'PlayerId': 'seat{}'.format(seat),
+                       'RawScore': rawScores[g][seat],
+                       'Chombos': chombos[g][seat]}
+                      for seat in range(counts[g])])
+        if unusedPoints[g]:
+            games[-1].append({'PlayerId': -1, 'RawScore': unusedPoints[g],
+                              'Chombos': 0})
+    elapsed = timeit.timeit(
+        'for game in games: rankGame(game[:], perPlayer, increment)',
+        number=1, globals=globals())
+    print('rankGame on {} games took {} seconds'.format(args.number, elapsed))
+    mismatches = 0
+    for g, game in enumerate(games):
+        for seat, score in enumerate(game[:counts[g]]):
+            if any(batch[field][g][seat] != score[field]
+                   for field in ['Rank', 'uma', 'Score']):
+                mismatches += 1
+        if len(game) > counts[g] and (
+                batch['unusedRank'][g] != game[-1]['Rank']):
+            mismatches += 1
+    print('{} mismatch{} found'.format(
+        mismatches, '' if mismatches == 1 else 'es'))
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib
-import urllib.request
+import urllib.parse
 import json
 import tornado.web
 import random
@@ -16,9 +15,13 @@ import db
 import handler
 import settings
 import scores
+import util
 
 log = logging.getLogger("WebServer")
 
+# The meetup.com requests are only made when adding players from meetup
+urllib_request = util.lazy_import('urllib.request')
+
 def meetup_ready():
     return (settings.MEETUP_CONSUMER_KEY and settings.MEETUP_GROUPNAME and
             len(settings.MEETUP_CONSUMER_KEY) > 1 and
@@ -40,11 +43,11 @@ def make_meetup_request(endpoint, accessToken, data):
     }
 
     data = urllib.parse.urlencode(data)
-    req = urllib.request.Request(
+    req = urllib_request.Request(
             url + "?" + data,
             headers=headers
           )
-    with urllib.request.urlopen(req) as response:
+    with urllib_request.urlopen(req) as response:
         responseText = response.read()
         return json.loads(
                    responseText
@@ -166,8 +169,8 @@ def FetchAccessToken(requestData, host):
     headers = {'User-Agent': settings.USER_AGENT}
 
     data = urllib.parse.urlencode(data).encode('utf-8')
-    req = urllib.request.Request(url, data, headers)
-    with urllib.request.urlopen(req) as response:
+    req = urllib_request.Request(url, data, headers)
+    with urllib_request.urlopen(req) as response:
         accessResponse = response.read().decode('utf-8')
 
     # If our authorization response succeeded above
@@ -419,7 +422,7 @@ def getCurrentTables():
                 tables += [{"index": str(table + 1), "players": players}]
     return tables, numplayers
 
-class CurrentTables(tornado.web.RequestHandler):
+class CurrentTables(handler.BaseHandler):
     def get(self):
         self.set_header('Content-Type', 'application/json')
         tables, numplayers = getCurrentTables()
@@ -432,13 +435,13 @@ class CurrentTables(tornado.web.RequestHandler):
                           numplayers)}
         self.write(json.dumps(result))
 
-class PlayersList(tornado.web.RequestHandler):
-    def get(self):
-        with db.getCur() as cur:
-            self.set_header('Content-Type', 'application/json')
-            cur.execute("SELECT Name FROM Players WHERE Id != ? ORDER BY Name",
-                        (scores.getUnusedPointsPlayerID(),))
-            self.write(json.dumps(list(map(lambda x:x[0], cur.fetchall()))))
+class PlayersList(handler.BaseHandler):
+    async def get(self):
+        unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
+        self.set_header('Content-Type', 'application/json')
+        rows = db.stream("SELECT Name FROM Players WHERE Id != ? ORDER BY Name",
+                         (unusedPointsPlayerID,))
+        await self.write_json_list(row[0] async for row in rows)
 
 class AddGameHandler(handler.BaseHandler):
     @tornado.web.authenticated
@@ -449,8 +452,8 @@ class AddGameHandler(handler.BaseHandler):
                     unusedPointsIncrement=unusedPointsIncrement)
 
     @tornado.web.authenticated
-    def post(self):
-        self.write(json.dumps(scores.addGame(json.loads(
+    async def post(self):
+        self.write(json.dumps(await db.run(scores.addGame, json.loads(
             self.get_argument('scores', None)))))
 
 POPULATION = 256
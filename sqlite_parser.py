@@ -49,7 +49,7 @@ anothertable_schema = [
 database_spec = {'MyTable': mytable_schema, 
                  'AnotherTable': anothertable_schema}
 
-import sys, collections, sqlite3, re, argparse
+import sys, collections, sqlite3, re, argparse, functools
 
 from sqlite_pragma import *
 
@@ -301,9 +301,10 @@ def create_index_sqls_from_spec(index_specs, table_pragma_records):
             m.group('cnames'), m.group('partial') or '')
     return result
             
+spec_patterns = column_def_patterns + post_column_spec_patterns
+
 def table_pragma_records(
-        table_spec, tablename='',
-        patterns_to_try = column_def_patterns + post_column_spec_patterns,
+        table_spec, tablename='', patterns_to_try=spec_patterns,
         throwexceptions=True, printto=sys.stderr):
     """Parse a table specification that is a list of strings with exactly
     one column definition, one table constraint, or one create index
@@ -313,7 +314,14 @@ def table_pragma_records(
     tree of regex tuples).  If grammar errors are found, they can
     either cause exceptions, or be printed to a file (or be silently
     ignored if printto is None).
+    Tables parsed with the standard grammar are remembered, so parsing
+    the same specification again is fast.  The records are shared, so
+    they must not be modified.
     """
+    if patterns_to_try is spec_patterns and (
+            throwexceptions or printto is None):
+        return list(parsed_table_pragma_records(
+            tuple(table_spec), tablename, throwexceptions))
     pragmas = []
     for spec in table_spec:
         pragmas.extend(
@@ -328,10 +336,18 @@ def table_pragma_records(
                 #                  else []) + post_column_spec_patterns,
                 throwexceptions=throwexceptions, printto=printto))
     return pragmas
+
+@functools.lru_cache(maxsize=1024)
+def parsed_table_pragma_records(table_spec, tablename, throwexceptions):
+    "Parse a table specification tuple with the standard grammar once"
+    # Passing a copy of the grammar makes table_pragma_records parse it
+    return tuple(table_pragma_records(
+        table_spec, tablename, patterns_to_try=list(spec_patterns),
+        throwexceptions=throwexceptions, printto=None))
     
 def column_def_or_constraint_to_pragma_records(
         spec, context=[], tablename='',
-        patterns_to_try = column_def_patterns + post_column_spec_patterns,
+        patterns_to_try=spec_patterns,
         throwexceptions=True, printto=sys.stderr):
     """Parse a single column definition, table constraint or index
     creation statement within a table specification.  The context
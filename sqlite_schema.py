@@ -39,8 +39,10 @@ import collections
 import sqlite3
 import re
 import argparse
-import tempfile
 import datetime
+import tempfile
+import time
+import zlib
 
 from sqlite_pragma import *
 from sqlite_parser import *
@@ -206,6 +208,8 @@ def compare_db_schema(new_schema, old_schema, verbose=0, ordermatters=False):
       mapped to new field names (dictionary of dictionaries: outer dictionary
       maps table name to inner dictionary, inner dictionary maps old name to
       new name)
+    change_defaults: list of tables where only the default values of
+      fields change
     different_table: list of tables with more complex differences
     add_index: list of tables with indices to add
     drop_index: list of tables with indices to drop
@@ -216,6 +220,7 @@ def compare_db_schema(new_schema, old_schema, verbose=0, ordermatters=False):
         'drop_tables': [],
         'add_fields': [],
         'renamed_fields': {},
+        'change_defaults': [],
         'different_table': [],
         'add_index': [],
         'drop_index': [],
@@ -235,8 +240,9 @@ def compare_db_schema(new_schema, old_schema, verbose=0, ordermatters=False):
                 new_schema[table], old_schema[table], table, verbose=verbose)
             categorized = False
             for k in [kind, index_kind]:
-                if k in ('add_fields', 'same', 'different_table', 
-                         'add_index', 'drop_index', 'different_index'):
+                if k in ('add_fields', 'same', 'change_defaults',
+                         'different_table', 'add_index', 'drop_index',
+                         'different_index'):
                     result['same_tables' if k == 'same' else k].append(table)
                     categorized = True
             if isinstance(kind, dict):
@@ -256,7 +262,8 @@ def compare_table_schema(
     """Compare 2 tables described by their pragma dictionaries.  Return
     'same' if they are same, 'add_fields' if the new table has just
     added some fields to the table, a dictionary mapping old field
-    names to new ones if the new table only renames some fields, or
+    names to new ones if the new table only renames some fields,
+    'change_defaults' if only the default values of some fields differ, or
     'different_table' if they differ in some other way.
     """
     if new_table['table_sql'] and old_table['table_sql']:
@@ -306,12 +313,32 @@ def compare_table_schema(
                       '-> {}'.format(value[r]) if isinstance(value, dict)
                       else '')
     return 'same' if not changed else (
-        'add_fields' if len(fields_to_add) > 0 and
+        'change_defaults' if len(fields_to_rename) == 0 and
+        len(fields_to_add + deleted + constraints_to_add +
+            constraints_deleted) == 0 and
+        len(changed_defaults(new_table['column'], old_table['column'],
+                             True, actual_cols)) == len(altered) and
+        same_except_defaults(new_table['table_sql'], old_table['table_sql'])
+        else 'add_fields' if len(fields_to_add) > 0 and
         len(deleted + altered + constraints_to_add + constraints_deleted) == 0
         else fields_to_rename if len(fields_to_rename) > 0 and
         len(deleted + altered + constraints_to_add + constraints_deleted) == 0
         else 'different_table')
 
+default_clause = re.compile(
+    r"\s*\bdefault\s*(\((?:[^()']|'(?:[^']|'')*'|\([^()]*\))*\)|"
+    r"'(?:[^']|'')*'|\"[^\"]*\"|[-+]?[\w.]+)", re.IGNORECASE)
+
+def same_except_defaults(new_sql, old_sql):
+    """Return whether the SQL of 2 CREATE TABLE statements is the same
+    apart from the DEFAULT clauses of their columns.  Only then can the
+    defaults be changed by rewriting the statement in the schema, because
+    the stored rows depend on everything else, like the column order."""
+    if not (new_sql and old_sql):
+        return False
+    return (default_clause.sub('', standardize_SQL(new_sql).lower()) ==
+            default_clause.sub('', standardize_SQL(old_sql).lower()))
+
 def renamed_fields(table_pragmas, actual_pragmas, actual_cols=None):
     """Return a mapping of columns in actual_pragmas whose name matches
     a former name of a column in table_pragmas."""
@@ -379,6 +406,22 @@ def altered_fields(
                                      for d in diff]))
     return result
 
+def changed_defaults(
+        table_pragmas, actual_pragmas, ordermatters=False, actual_cols=None):
+    """Return the columns in table_pragmas that differ from those of the
+    same name in actual_pragmas only in their default value"""
+    if actual_cols is None:
+        actual_cols = dict_by_col_name(actual_pragmas)
+    return [col for col in table_pragmas
+            if isinstance(col, sqlite_column_record) and
+            col.name.lower() in actual_cols and
+            record_differences(col, actual_cols[col.name.lower()],
+                               include=['dflt_value']) and
+            not record_differences(
+                col, actual_cols[col.name.lower()],
+                exclude=([] if ordermatters else ['cid']) +
+                ['dflt_value', 'formerly', 'spec_line'])]
+
 def compare_table_indices(new_table, old_table, tablename, verbose=0):
     """Compare the indices for 2 tables described by their pragma
     dictionaries.  This compares only the indices built from CREATE
@@ -438,20 +481,76 @@ def altered_indices(new_table, old_table, verbose=0):
                         new_index.name, diff))
     return result
     
+migration_table = 'MigrationProgress'
+
+def migration_signature(new_db_schema, dbfile):
+    """Return a 31-bit hash identifying the migration of a database file
+    to a new schema.  It changes if the file is modified or the schema
+    is different."""
+    stat = os.stat(dbfile)
+    spec = sorted((table, pd['table_sql'], sorted(pd['index_sqls'].items()))
+                  for table, pd in new_db_schema.items())
+    return zlib.crc32(repr([stat.st_size, stat.st_mtime_ns, spec]).encode()
+                      ) & 0x7fffffff
+
 def backup_db_and_migrate(
         new_db_schema, old_db_schema, dbfile, backup_dir, backup_prefix, 
-        preserve_unspecified=True, verbose=0):
+        preserve_unspecified=True, verbose=0, chunk_rows=10000,
+        progress=None):
+    """Migrate the data in a database file into a new database with the
+    new schema, backing up the old file in backup_dir and replacing it
+    with the new one.
+    Each table is copied in chunks of chunk_rows rows in rowid order,
+    committing after each one, and its indices are created once all its
+    rows are copied.  The progress function, if given, is called after
+    each chunk with the table name, the number of rows copied so far, and
+    the total number of rows in the old table.  The migration is built in
+    backup_dir and records how far it got, so if it is interrupted, calling
+    this again for the same, unchanged database and schema continues where
+    it left off.  Returns True for success, false otherwise.
+    """
     if not os.path.isdir(backup_dir):
         print('Creating directory for backup files: {}'.format(backup_dir))
         os.mkdir(backup_dir)
     filename, ext = os.path.splitext(os.path.basename(dbfile))
-    newdbfile = tempfile.NamedTemporaryFile(delete=False)
-    newdbfile.close()
-    if verbose > 1:
-        print('Temporary database file to be created in {}'.format(
-            newdbfile.name))
+    newdbfile = os.path.join(backup_dir, filename + '-migrating' + ext)
+
+    # Move any changes in the write ahead log into the database file so
+    # it stays the same while it is migrated
+    with sqliteCur(DBfile=dbfile) as cur:
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    signature = migration_signature(new_db_schema, dbfile)
+    copied_tables = {}
+    if os.path.exists(newdbfile):
+        with sqliteCur(DBfile=newdbfile) as cur:
+            cur.execute("PRAGMA user_version")
+            resumable = cur.fetchone()[0] == signature
+            if resumable:
+                cur.execute("SELECT Tbl, LastRowid, Copied, Total, Done"
+                            "  FROM {}".format(migration_table))
+                copied_tables = dict((row[0], row[1:]) for row in
+                                     cur.fetchall())
+        if resumable:
+            if verbose > 0:
+                print('Continuing the migration in {} of {} table{}'.format(
+                    newdbfile, len(copied_tables),
+                    '' if len(copied_tables) == 1 else 's'))
+        else:
+            if verbose > 0:
+                print('Discarding incomplete migration of a different '
+                      'database or schema in {}'.format(newdbfile))
+            os.remove(newdbfile)
+    elif verbose > 1:
+        print('Migrated database to be created in {}'.format(newdbfile))
     try:
-        with sqliteCur(DBfile=newdbfile.name) as cur:
+        with sqliteCur(DBfile=newdbfile) as cur:
+            con = cur.connection
+            if not copied_tables:
+                cur.execute("PRAGMA user_version = {}".format(signature))
+                cur.execute("CREATE TABLE IF NOT EXISTS {} ("
+                            "  Tbl TEXT PRIMARY KEY, LastRowid INTEGER,"
+                            "  Copied INTEGER, Total INTEGER, Done INTEGER)"
+                            .format(migration_table))
             old_name = "Old"
             cur.execute("ATTACH DATABASE '{}' AS {}".format(dbfile, old_name))
             done = []
@@ -462,28 +561,39 @@ def backup_db_and_migrate(
                 old_cols = old_db_schema[table]['column'] if in_old else []
                 if table in done:
                     return
+                if copied_tables.get(table, (0, 0, 0, False))[3]:
+                    done.append(table)
+                    return
                 rename = {}
                 if in_new and in_old:
                     old_dict = dict_by_col_name(old_cols)
                     rename = renamed_fields(new_cols, old_cols, old_dict)
                     for name in [n for n in rename if n not in old_dict]:
                             del rename[name]  # Remove case variations
-                if in_new:
-                    if verbose > 1:
-                        print('{} {} table ...'.format(
-                            'Creating new' if in_new else 'Preserving', table))
-                        if len(rename) > 0:
-                            print('Renaming fields as follows:')
-                            for name in rename:
-                                print(' ', name, '->', rename[name])
-                    cur.execute(pd['table_sql'])
-                    if verbose > 1:
-                        print(' {} Done.'.format(table))
-                    if pd['index_sqls']:
+                if table not in copied_tables:
+                    total = 0
+                    if in_old and in_new:
+                        cur.execute('SELECT COUNT(*) FROM {}.{}'.format(
+                            old_name, table))
+                        total = cur.fetchone()[0]
+                    copied_tables[table] = (None, 0, total, False)
+                    cur.execute(
+                        'INSERT INTO {} (Tbl, LastRowid, Copied, Total, Done)'
+                        ' VALUES (?, NULL, 0, ?, 0)'.format(migration_table),
+                        (table, total))
+                    if in_new:
+                        if verbose > 1:
+                            print('{} {} table ...'.format(
+                                'Creating new' if in_new else 'Preserving',
+                                table))
+                            if len(rename) > 0:
+                                print('Renaming fields as follows:')
+                                for name in rename:
+                                    print(' ', name, '->', rename[name])
+                        cur.execute(pd['table_sql'])
                         if verbose > 1:
-                            print('Creating indices for {}'.format(table))
-                        for index_name in pd['index_sqls']:
-                            cur.execute(pd['index_sqls'][index_name])
+                            print(' {} Done.'.format(table))
+                    con.commit()
                 old_col_names = [c.name for c in
                     (common_fields(pd['column'], old_cols)
                      if in_new and in_old else pd['column'])]
@@ -492,48 +602,117 @@ def backup_db_and_migrate(
                     old_col_names.append(name)
                     new_col_names.append(rename[name])
                 if in_old and in_new:
+                    last, copied, total, finished = copied_tables[table]
                     if verbose > 1:
                         print('Copying old data from {} ... '.format(table),
                               end='')
-                    cur.execute(
-                        'INSERT INTO main.{0} ({1}) SELECT {2} FROM {3}.{0}'
-                        .format(table, ','.join(new_col_names), 
-                                ','.join(old_col_names), old_name))
+                    cur.execute('SELECT sql FROM {}.sqlite_master'
+                                '  WHERE type = ? AND name = ?'.format(
+                                    old_name), ('table', table))
+                    rowids = not re.search(r'WITHOUT\s+ROWID',
+                                           cur.fetchone()[0], re.IGNORECASE)
+                    while True:
+                        if rowids:
+                            after = '' if last is None else 'WHERE rowid > ?'
+                            params = () if last is None else (last,)
+                            cur.execute(
+                                'SELECT MAX(rowid) FROM (SELECT rowid FROM '
+                                '{0}.{1} {2} ORDER BY rowid LIMIT ?)'.format(
+                                    old_name, table, after),
+                                params + (chunk_rows,))
+                            end = cur.fetchone()[0]
+                            if end is None:
+                                break
+                            chunk = 'WHERE {} rowid <= ? ORDER BY rowid'.format(
+                                '' if last is None else 'rowid > ? AND')
+                            params += (end,)
+                        else:
+                            chunk, params, end = '', (), None
+                        cur.execute(
+                            'INSERT INTO main.{0} ({1}) SELECT {2} FROM {3}.{0} '
+                            '{4}'.format(table, ','.join(new_col_names), 
+                                         ','.join(old_col_names), old_name,
+                                         chunk), params)
+                        last, copied = end, copied + cur.rowcount
+                        cur.execute(
+                            'UPDATE {} SET LastRowid = ?, Copied = ?'
+                            '  WHERE Tbl = ?'.format(migration_table),
+                            (last, copied, table))
+                        con.commit()
+                        if progress:
+                            progress(table, copied, total)
+                        if not rowids:
+                            break
                     if verbose > 1:
                         print('Copied {} row{} into {}'.format(
-                            cur.rowcount, '' if cur.rowcount == 1 else 's',
-                            table))
+                            copied, '' if copied == 1 else 's', table))
+                cur.execute('UPDATE {} SET Done = 1 WHERE Tbl = ?'.format(
+                    migration_table), (table,))
+                if in_new and pd['index_sqls']:
+                    if verbose > 1:
+                        print('Creating indices for {}'.format(table))
+                    for index_name in pd['index_sqls']:
+                        cur.execute(pd['index_sqls'][index_name])
+                con.commit()
                 done.append(table)
             walk_tables(new_db_schema, copy_table, verbose=verbose)
             if preserve_unspecified:
                 walk_tables(old_db_schema, copy_table, verbose=verbose,
                             ignore=done)
+            cur.execute("DROP TABLE {}".format(migration_table))
+            cur.execute("PRAGMA user_version = 0")
+            con.commit()
+            cur.execute("DETACH DATABASE {}".format(old_name))
         if verbose > 1:
-            print('Database successfully migrated to {}'.format(newdbfile.name))
+            print('Database successfully migrated to {}'.format(newdbfile))
         dbfile_stat = os.stat(dbfile)
         backupfile = os.path.join(
             backup_dir,
             datetime.datetime.now().strftime(backup_prefix) +
             os.path.basename(dbfile))
         os.replace(dbfile, backupfile)
-        os.replace(newdbfile.name, dbfile)
+        os.replace(newdbfile, dbfile)
         os.chmod(dbfile, dbfile_stat.st_mode)
         if verbose > 0:
             print(('Existing database backed up to {} and migrated database '
                    'now in {}').format(backupfile, dbfile))
         return True
     except sqlite3.DatabaseError as e:
-        print('Error during database migration to {}:'.format(newdbfile.name),
-              e)
+        print('Error during database migration to {}:'.format(newdbfile), e)
+        print('Tables copied so far are kept in it for the next attempt')
         return False
 
-def upgrade_database(new_db_schema, old_db_schema, delta, dbfile, verbose=0):
-    """Try upgrading database to create new tables, adding fields, and
-    renaming fields.
+in_place_changes = ('new_tables', 'add_fields', 'renamed_fields',
+                    'change_defaults', 'add_index', 'different_index')
+
+def upgrade_path(delta, preserve_unspecified=True):
+    """Return how the differences found by compare_db_schema are applied
+    to a database: 'none' if there are none to apply, 'alter' if they can
+    all be made in the existing database by upgrade_database, or 'migrate'
+    if the data must be copied into a new database.  Tables and indices
+    missing from the new schema are only dropped if preserve_unspecified
+    is false."""
+    migrate_only = ['different_table'] + (
+        [] if preserve_unspecified else ['drop_tables'])
+    if any(delta[kind] for kind in migrate_only):
+        return 'migrate'
+    if any(delta[kind] for kind in in_place_changes) or (
+            not preserve_unspecified and delta['drop_index']):
+        return 'alter'
+    return 'none'
+
+def upgrade_database(new_db_schema, old_db_schema, delta, dbfile, verbose=0,
+                     preserve_unspecified=True):
+    """Try upgrading database to create new tables, adding fields,
+    renaming fields, changing default values, and adding, changing, or
+    dropping indices.  Indices are only dropped if preserve_unspecified
+    is false.  All the changes are made in one transaction.
     This method ignores any tables with more complex changes.
     Return True for success, false otherwise."""
+    cur = None
     try:
         with sqliteCur(DBfile=dbfile) as cur:
+            cur.execute('BEGIN')
             def alter_table(table, pd):
                 if table in old_db_schema:
                     rename = {}
@@ -564,11 +743,19 @@ def upgrade_database(new_db_schema, old_db_schema, delta, dbfile, verbose=0):
                             print('Adding column {}'.format(field.name))
                         cur.execute('ALTER TABLE {} ADD COLUMN {}'.format(
                             table, field.spec_line))
-                    for kind in ['drop', 'add']:
-                        if table in delta[kind + '_index']:
-                            indices = (deleted_indices(pd, old_db_schema[table])
-                                       if kind == 'drop' else
-                                       missing_indices(pd, old_db_schema[table]))
+                    if table in delta['change_defaults']:
+                        change_defaults(cur, table, pd, old_db_schema[table],
+                                        verbose=verbose)
+                    if any(table in delta[kind] for kind in
+                           ('add_index', 'drop_index', 'different_index')):
+                        altered = [idx for idx, diff in altered_indices(
+                            pd, old_db_schema[table])]
+                        drop = altered + (
+                            [] if preserve_unspecified else
+                            deleted_indices(pd, old_db_schema[table]))
+                        add = altered + missing_indices(
+                            pd, old_db_schema[table])
+                        for kind, indices in (('drop', drop), ('add', add)):
                             if indices and verbose > 1:
                                 print('{} {} table ind{} {}'.format(
                                     kind.capitalize(), table,
@@ -579,20 +766,122 @@ def upgrade_database(new_db_schema, old_db_schema, delta, dbfile, verbose=0):
                                     'DROP INDEX {}'.format(idx.name) 
                                     if kind == 'drop' else
                                     idx.spec_line)
-                            if kind == 'add':
-                                if verbose > 1:
-                                    print('Re-indexing all', table, 'indices')
-                                cur.execute('REINDEX {}'.format(table))
                 else:
                     if verbose > 1:
                         print('Creating new {} table'.format(table))
                     cur.execute(pd['table_sql'])
+                    for index_name in pd['index_sqls']:
+                        cur.execute(pd['index_sqls'][index_name])
             walk_tables(new_db_schema, alter_table, verbose=verbose)
         return True
     except sqlite3.DatabaseError as e:
+        if cur:
+            cur.connection.rollback()
+            cur.connection.close()
         print('Error while trying to update {} in place:'.format(dbfile), e)
         return False
 
+def change_defaults(cur, table, new_table, old_table, verbose=0):
+    """Change the default values of a table's columns by rewriting its
+    CREATE TABLE statement in the schema.  SQLite stores no defaults in
+    the rows, so the table isn't copied, but rows from before a column
+    was added read its default from the schema.  Those rows are updated
+    to store the old default first."""
+    if not same_except_defaults(new_table['table_sql'],
+                                old_table['table_sql']):
+        raise sqlite3.DatabaseError(
+            'Table {} differs in more than its default values'.format(table))
+    columns = changed_defaults(new_table['column'], old_table['column'])
+    if verbose > 1:
+        print('Changing default value{} of {} in {} table'.format(
+            '' if len(columns) == 1 else 's', [c.name for c in columns],
+            table))
+    old_cols = dict_by_col_name(old_table['column'])
+    for column in columns:
+        old_default = old_cols[column.name.lower()].dflt_value
+        if old_default is not None:
+            cur.execute('UPDATE {0} SET {1} = {1} WHERE {1} IS ({2})'.format(
+                table, column.name, old_default))
+    cur.execute('PRAGMA schema_version')
+    schema_version = cur.fetchone()[0]
+    cur.execute('PRAGMA writable_schema = ON')
+    cur.execute("UPDATE sqlite_master SET sql = ?"
+                "  WHERE type = 'table' AND name = ?",
+                (new_table['table_sql'], table))
+    cur.execute('PRAGMA schema_version = {}'.format(schema_version + 1))
+    cur.execute('PRAGMA writable_schema = OFF')
+
+def sample_rates(cur, table, sample_rows=1000):
+    """Measure the seconds per row to copy the rows of a table in the
+    attached Old database and to index them, using a sample of up to
+    sample_rows rows in the database of the cursor"""
+    cur.execute("SELECT sql FROM Old.sqlite_master"
+                "  WHERE type = 'table' AND name = ?", (table,))
+    cur.execute(cur.fetchone()[0])
+    start = time.perf_counter()
+    cur.execute('INSERT INTO main.{0} SELECT * FROM Old.{0} LIMIT ?'.format(
+        table), (sample_rows,))
+    copied = cur.rowcount
+    copy_time = time.perf_counter() - start
+    cur.execute('PRAGMA main.table_info({})'.format(table))
+    start = time.perf_counter()
+    cur.execute('CREATE INDEX Sample_{0} ON {0}({1})'.format(
+        table, cur.fetchone()[1]))
+    index_time = time.perf_counter() - start
+    cur.connection.commit()
+    return (copy_time / max(1, copied), index_time / max(1, copied))
+
+def estimate_upgrade(
+        new_db_schema, old_db_schema, dbfile, ordermatters=False,
+        preserve_unspecified=True, sample_rows=1000):
+    """Predict how compare_and_prompt_to_upgrade_database would upgrade a
+    database without changing it.  Returns the path, as described for
+    upgrade_path, and an estimate of the seconds it would take.  The
+    estimate scales the time to copy and index a sample of the rows of
+    each table involved in a scratch database to the size of the table."""
+    delta = compare_db_schema(new_db_schema, old_db_schema,
+                              ordermatters=ordermatters)
+    path = upgrade_path(delta, preserve_unspecified)
+    seconds = 0.0
+    if path == 'none':
+        return path, seconds
+    with tempfile.TemporaryDirectory() as scratch:
+        with sqliteCur(DBfile=os.path.join(scratch, 'sample.db')) as cur:
+            cur.execute("PRAGMA foreign_keys = 0") # Samples lack references
+            cur.execute("ATTACH DATABASE '{}' AS Old".format(dbfile))
+            for table in new_db_schema:
+                if table not in old_db_schema:
+                    continue
+                # Migrating copies every row and builds every index, while
+                # altering updates the rows for columns whose default
+                # changes from a value and builds new indices
+                if path == 'migrate':
+                    copies = 1
+                    indices = len(new_db_schema[table]['index_sqls'])
+                else:
+                    old = old_db_schema[table]
+                    new = new_db_schema[table]
+                    old_cols = dict_by_col_name(old['column'])
+                    copies = len([
+                        col for col in changed_defaults(
+                            new['column'], old['column'])
+                        if table in delta['change_defaults'] and
+                        old_cols[col.name.lower()].dflt_value is not None])
+                    indices = len(
+                        [idx for idx, diff in altered_indices(new, old)] +
+                        missing_indices(new, old))
+                if copies + indices == 0:
+                    continue
+                cur.execute('SELECT COUNT(*) FROM Old.{}'.format(table))
+                count = cur.fetchone()[0]
+                if count > 0:
+                    copy_rate, index_rate = sample_rates(
+                        cur, table, sample_rows)
+                    seconds += count * (copies * copy_rate +
+                                        indices * index_rate)
+            cur.execute("DETACH DATABASE Old")
+    return path, seconds
+
 def create_database(db_schema, dbfile, verbose=0):
     "Create a database with the given specification."
     if os.path.exists(dbfile):
@@ -634,11 +923,12 @@ def compare_and_prompt_to_upgrade_database(
         force_response=None, backup_dir='./backups',
         response_dict={True: ['y', 'yes', '1'], False: ['n', 'no', '0']}, 
         backup_prefix="%Y-%m-%d-%H-%M-%S-", preserve_unspecified=True,
-        verbose=0):
+        verbose=0, chunk_rows=10000, progress=None):
     """Compare an actual SQLite database schema to a desired one and
     prompt user to upgrade if differences are found.  If the
-    differences are simple, new tables or new fields without new
-    constraints, it will attempt to alter the existing database.  If
+    differences are simple, new tables, new or renamed fields without new
+    constraints, changed default values, or index changes, it will
+    attempt to alter the existing database (see upgrade_path).  If
     that fails or the differences are more complex, it will backup the
     existing database and migrate the data into a new database that
     will be placed in the file for the current database.
@@ -655,6 +945,8 @@ def compare_and_prompt_to_upgrade_database(
     are not in the desired database schema will be migrated unchanged.  Tables
     are only dropped if migration is performed and preserve_unspecifed is
     false (not if tables are simply altered in the existing database).
+    Migrations copy chunk_rows rows at a time, calling the progress
+    function after each chunk (see backup_db_and_migrate).
     With higher verbosity levels, more debugging information is printed.
     """
     if force_response and interpret_response(
@@ -670,13 +962,13 @@ def compare_and_prompt_to_upgrade_database(
             print('{}:'.format(k))
             for table in delta[k]:
                 print(' ', table)
-    simple_change_keys = [key for key in delta if key.split('_')[0] in 
-                          ('new', 'add', 'renamed')]
+    simple_change_keys = list(in_place_changes) + (
+        [] if preserve_unspecified else ['drop_index'])
     simple_changes = sum(len(delta[k]) for k in simple_change_keys)
     migrate_only_changes = sum(len(delta[k]) for k in
-                               ['different_table', 'different_index'] + 
+                               ['different_table'] + 
                                ([] if preserve_unspecified else
-                                ['drop_tables', 'drop_index']))
+                                ['drop_tables']))
 
     # If there are no changes or the forced response is no upgrade,
     # then no more work needs to be done
@@ -700,7 +992,7 @@ def compare_and_prompt_to_upgrade_database(
                 print('Unrecognized response.  Please answer yes or no.')
         if resp and upgrade_database(
                 desired_db_schema, actual_db_schema, delta, dbfile,
-                verbose=verbose):
+                verbose=verbose, preserve_unspecified=preserve_unspecified):
             if verbose > 0:
                 print('Successfully performed', description)
             simple_changes = 0
@@ -731,7 +1023,8 @@ def compare_and_prompt_to_upgrade_database(
         if dbexists:
             if backup_db_and_migrate(
                     desired_db_schema, actual_db_schema, dbfile, backup_dir,
-                    backup_prefix, preserve_unspecified, verbose=verbose):
+                    backup_prefix, preserve_unspecified, verbose=verbose,
+                    chunk_rows=chunk_rows, progress=progress):
                 
                 # Backup and migration succeed, print something if no other
                 # verbose messages were already printed
@@ -802,12 +1095,22 @@ if __name__ == '__main__':
         '-d', '--drop-unused', default=False, action='store_true',
         help='Drop any tables and indices not mentioned in the schema '
         'when upgrading.')
+    parser.add_argument(
+        '-e', '--estimate', default=False, action='store_true',
+        help='Print whether the database would be altered in place or '
+        'migrated, and about how long it would take, without changing it.')
+    parser.add_argument(
+        '-c', '--chunk-rows', type=int, default=10000,
+        help='Number of rows to copy from a table at a time when migrating.')
     parser.add_argument(
         '-v', '--verbose', action='count', default=0,
         help='Add verbose comments.')
 
     args = parser.parse_args()
 
+    def print_progress(table, copied, total):
+        print('Copied {} of {} rows of {}'.format(copied, total, table))
+
     if args.force_migration and not args.upgrade:
         print('The -F/--force-migration option can only be used with '
               'the -u/--upgrade option.')
@@ -866,7 +1169,21 @@ if __name__ == '__main__':
                         verbose=args.verbose)
             print(linesep)
             
-    if desired_db_schema and args.database:
+    if desired_db_schema and args.database and args.estimate:
+        if not os.path.exists(args.database):
+            print('The database would be created')
+        else:
+            path, seconds = estimate_upgrade(
+                desired_db_schema, actual_db_schema, args.database,
+                ordermatters=args.order_matters,
+                preserve_unspecified=not args.drop_unused)
+            print({'none': 'The database needs no changes',
+                   'alter': 'The database would be altered in place',
+                   'migrate': 'The database would be migrated to a new file'}
+                  [path], end='')
+            print(' in about {:.2f} seconds'.format(seconds)
+                  if path != 'none' else '')
+    elif desired_db_schema and args.database:
         if not os.path.exists(args.database):
             if not create_database(desired_db_schema, args.database,
                                    verbose=args.verbose):
@@ -876,7 +1193,8 @@ if __name__ == '__main__':
                     desired_db_schema, actual_db_schema, args.database,
                     args.backup_dir, args.backup_file_prefix,
                     preserve_unspecified=not args.drop_unused,
-                    verbose=args.verbose):
+                    verbose=args.verbose, chunk_rows=args.chunk_rows,
+                    progress=print_progress if args.verbose > 0 else None):
                 sys.exit(-1)
         else:
             if args.force_response is None and not args.upgrade:
@@ -889,5 +1207,6 @@ if __name__ == '__main__':
                     backup_dir=args.backup_dir, 
                     backup_prefix=args.backup_file_prefix,
                     preserve_unspecified=not args.drop_unused,
-                    verbose=args.verbose):
+                    verbose=args.verbose, chunk_rows=args.chunk_rows,
+                    progress=print_progress if args.verbose > 0 else None):
                 sys.exit(-1)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+__doc__ = """
+Measure how long the web server takes to start.  Each run is a new Python
+process that imports main and builds main.Application on a fresh copy of
+the database, so nothing is cached from an earlier run.  The slowest
+run is compared with the startup budget, and the exit status is 1 if it
+is over.  With --imports, the modules that take the longest to import
+are listed, as measured by Python's -X importtime option.
+"""
+
+import sys
+import os
+import json
+import re
+import subprocess
+import tempfile
+import argparse
+
+import settings
+import loadtest
+
+child = """
+import sys, time, json
+start = time.perf_counter()
+import settings
+settings.DBFILE, settings.DBBACKUPS = sys.argv[1:3]
+import main
+imported = time.perf_counter()
+main.Application(force=True)
+json.dump({'import': imported - start,
+           'application': time.perf_counter() - imported}, sys.stdout)
+"""
+
+def measure(dbfile, runs=3):
+    """Start the application runs times on copies of dbfile and return
+    a list of dictionaries with the seconds taken to import main,
+    to build the Application, and in total"""
+    results = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    for i in range(runs):
+        with tempfile.TemporaryDirectory() as tempdir:
+            copy = os.path.join(tempdir, os.path.basename(dbfile))
+            loadtest.copy_database(dbfile, copy)
+            output = subprocess.run(
+                [sys.executable, '-c', child, copy,
+                 os.path.join(tempdir, 'backups')],
+                cwd=here, stdout=subprocess.PIPE, check=True).stdout
+        result = json.loads(output)
+        result['total'] = result['import'] + result['application']
+        results.append(result)
+    return results
+
+def slowest_imports(count=20):
+    """Return the count modules with the largest cumulative import times
+    when main is imported, as (microseconds, module) pairs"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=here, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True).stderr
+    times = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s*\d+ \|\s*(\d+) \| (.*)', line)
+        if match:
+            times.append((int(match.group(1)), match.group(2)))
+    return sorted(times, reverse=True)[:count]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'database', nargs='?', default=settings.DBFILE,
+        help='Database to start with.  It is copied so it is not changed.  '
+        'Defaults to %(default)s.')
+    parser.add_argument(
+        '-r', '--runs', type=int, default=3,
+        help='Number of times to start the application.')
+    parser.add_argument(
+        '-b', '--budget', type=float, default=settings.STARTUPBUDGET,
+        help='Most seconds startup may take.  Defaults to %(default)s.')
+    parser.add_argument(
+        '-i', '--imports', default=False, action='store_true',
+        help='List the modules that take the longest to import.')
+    parser.add_argument(
+        '-n', '--count', type=int, default=20,
+        help='Number of modules to list with --imports.')
+
+    args = parser.parse_args()
+    if not os.path.exists(args.database):
+        parser.error('No database at {}'.format(args.database))
+
+    if args.imports:
+        print('{:>9}  {}'.format('ms', 'Module (cumulative import time)'))
+        for microseconds, module in slowest_imports(args.count):
+            print('{:9.1f}  {}'.format(microseconds / 1000, module))
+        print()
+
+    results = measure(args.database, args.runs)
+    print('{:>4} {:>9} {:>13} {:>9}'.format(
+        'Run', 'Import s', 'Application s', 'Total s'))
+    for i, result in enumerate(results):
+        print('{:4d} {import:9.3f} {application:13.3f} {total:9.3f}'.format(
+            i + 1, **result))
+    slowest = max(result['total'] for result in results)
+    if slowest > args.budget:
+        print('Startup took {:.3f} seconds, over the budget of {} '
+              'seconds'.format(slowest, args.budget))
+        sys.exit(1)
+    print('Startup took at most {:.3f} seconds, within the budget of {} '
+          'seconds'.format(slowest, args.budget))
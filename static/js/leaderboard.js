@@ -20,19 +20,46 @@ $(function() {
 	function getData(period) {
 		if (periods.indexOf(period) === -1)
 			period = "quarter";
-		$.getJSON("/leaderdata/" + period,
+		$("#olderboards").hide();
+		$.getJSON("/leaderdata/" + period, {
+				boards: 1
+			},
 			function(data) {
 				scores = data;
 				$("#leaderboards").html(Mustache.render(leaderboard, data)).promise().done(function() {
-					$(".ordering").click(changeOrdering);
-					updateLeaderScores($("#min_games").val(), rank_visible());
-					$("tr.eligible, div.membersymbol").click(
-						scrollToLegend);
-					setupReturnToTop(".returntotop")
+					setupBoards(data);
 				});
 			});
 	};
 
+	function getOlderData() {
+		var period = $("#period").val(),
+			boards = scores['leaderboards'],
+			oldest = boards.length > 0 ? boards[boards.length - 1]['Date'] : '';
+		$("#olderboards").hide();
+		$.getJSON("/leaderdata/" + period, {
+				boards: 4,
+				before: oldest
+			},
+			function(data) {
+				if ($("#period").val() != period)
+					return;
+				scores['leaderboards'] = boards.concat(data['leaderboards']);
+				$("#leaderboards").append(Mustache.render(leaderboard, data)).promise().done(function() {
+					setupBoards(data);
+				});
+			});
+	};
+
+	function setupBoards(data) {
+		$(".ordering").text($(".ordering:first").text());
+		$(".ordering").off("click").click(changeOrdering);
+		updateLeaderScores($("#min_games").val(), rank_visible());
+		$("tr.eligible, div.membersymbol").off("click").click(scrollToLegend);
+		setupReturnToTop(".returntotop");
+		$("#olderboards").toggle(data['more']);
+	};
+
 	function scrollToLegend() { // Smooth scroll to bottom, slow->fast->slow
 		window.smoothScrollTo();
 	};
@@ -106,6 +133,7 @@ $(function() {
 		$(".helptext").slideUp();
 		$("." + period + "_help").slideDown();
 	});
+	$("#olderboards").click(getOlderData);
 	$("#min_games").change(function() {
 		updateLeaderScores($("#min_games").val(), rank_visible());
 	});
@@ -14,6 +14,7 @@ $(function() {
 		else {
 			player = parts.slice(j + 1).join('/');
 			getData(player);
+			getRatingHistory(parts[j + 1]);
 		}
 	});
 
@@ -82,6 +83,48 @@ $(function() {
 		});
 	}
 
+	function getRatingHistory(player) {
+		if ($(".ratinghistorychart").length == 0)
+			return;
+		$.getJSON("/ratingsdata/history", {
+			player: decodeURIComponent(player),
+			points: 200
+		}, function(data) {
+			if (data.players.length > 0)
+				drawRatingHistory(d3.select(".ratinghistorychart"),
+					data.players[0].history);
+		});
+	}
+
+	function drawRatingHistory(svg_selection, history) {
+		var rect = svg_selection.nodes()[0].getBoundingClientRect(),
+			margin = 40,
+			width = (rect.width || 800) - 2 * margin,
+			height = (rect.height || 240) - 2 * margin,
+			parseDate = d3.timeParse("%Y-%m-%d"),
+			x = d3.scaleTime().range([0, width]).domain(
+				d3.extent(history, function(d) {
+					return parseDate(d.date)
+				})),
+			y = d3.scaleLinear().range([height, 0]).domain(
+				d3.extent(history, function(d) {
+					return d.rating
+				})).nice(),
+			line = d3.line().x(function(d) {
+				return x(parseDate(d.date))
+			}).y(function(d) {
+				return y(d.rating)
+			}),
+			g = svg_selection.html(""). // Remove any error message
+		append("g").attr("transform",
+			"translate(" + margin + "," + margin / 2 + ")");
+		g.append("g").attr("transform", "translate(0," + height + ")").
+		call(d3.axisBottom(x).ticks(5));
+		g.append("g").call(d3.axisLeft(y).ticks(5));
+		g.append("path").datum(history).attr("class", "ratingline").
+		attr("d", line);
+	}
+
 	function drawData(svg_selection, legend_selection, data) {
 		var rect = svg_selection.nodes()[0].getBoundingClientRect(),
 			width = rect.width || 800,
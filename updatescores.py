@@ -1,27 +1,99 @@
 #!/usr/bin/env python3
 
+import collections
+import itertools
+
 import db
 import util
 import leaderboard
 import scores
 import settings
+import importgames
+import jobs
 
-def updateGame(gameid):
-    print("Updating game", gameid)
-    game = scores.getScores(gameid, unusedPoints = True)
-    status = scores.addGame(game)
-    if status['status'] != 0:
-        print(status)
-    return game
+def rescoreGames(games, unusedPointsPlayerID):
+    """Rank a list of games, each a list of Scores rows of (Id, GameId,
+    PlayerId, RawScore, Chombos, Date, DeltaRating), with one call to
+    scores.rankGames.  Returns the rankGames result and the rows of each
+    game's players and UnusedPointsPlayer."""
+    seated = [[row for row in game if row[2] != unusedPointsPlayerID]
+              for game in games]
+    unused = [[row for row in game if row[2] == unusedPointsPlayerID]
+              for game in games]
+    width = max([len(seats) for seats in seated] + [0])
+    pointSettings = {}
+    for game in games:
+        quarter = scores.quarterString(date=game[0][5])
+        if quarter not in pointSettings:
+            pointSettings[quarter] = scores.getPointSettings(quarter=quarter)
+    quarters = [scores.quarterString(date=game[0][5]) for game in games]
+    result = scores.rankGames(
+        [[row[3] for row in seats] + [0] * (width - len(seats))
+         for seats in seated],
+        [[row[4] for row in seats] + [0] * (width - len(seats))
+         for seats in seated],
+        [len(seats) for seats in seated],
+        [pointSettings[quarter][1] for quarter in quarters],
+        [pointSettings[quarter][0] for quarter in quarters],
+        [sum(row[3] for row in rows) for rows in unused],
+        [sum(row[4] for row in rows) for rows in unused],
+        [len(rows) > 0 for rows in unused])
+    return result, seated, unused, quarters
 
 def main():
+    unusedPointsPlayerID = scores.getUnusedPointsPlayerID()
     with db.getCur() as cur:
-        cur.execute("SELECT DISTINCT GameId FROM Scores WHERE RawScore != 0 ORDER BY Date ASC")
-        games = cur.fetchall()
+        cur.execute("SELECT Id, GameId, PlayerId, RawScore, Chombos, Date,"
+                    "  DeltaRating FROM Scores ORDER BY Date, GameId, Id")
+        games = [list(rows) for gameid, rows in
+                 itertools.groupby(cur.fetchall(), key=lambda row: row[1])]
 
-    for game in games:
-        gameid = game[0]
-        updateGame(gameid)
+    # Games without any raw scores are left as they are
+    rescored = [game for game in games if any(row[3] != 0 for row in game)]
+    print("Updating", len(rescored), "games")
+    result, seated, unused, quarters = rescoreGames(
+        rescored, unusedPointsPlayerID)
+    index = dict((game[0][1], g) for g, game in enumerate(rescored))
+
+    # Rating changes use the ratings and game counts of the players from
+    # before the day of the game, including the updated earlier games
+    before = collections.defaultdict(lambda: [settings.DEFAULT_RATING, 0])
+    updates, dates = [], set()
+    for date, day in itertools.groupby(games, key=lambda game: game[0][5]):
+        deltas = []
+        for game in day:
+            g = index.get(game[0][1])
+            if g is None or result['status'][g] != 0:
+                if g is not None:
+                    print("Game", game[0][1], result['error'][g])
+                deltas += [(row[2], row[6]) for row in game]
+                continue
+            players = [row[2] for row in seated[g]]
+            total = sum(before[player][0] for player in players)
+            for seat, row in enumerate(seated[g]):
+                rating, gameCount = before[row[2]]
+                delta = scores.ratingChange(
+                    float(result['uma'][g][seat]), rating,
+                    (total - rating) / (len(players) - 1), gameCount)
+                updates.append((int(result['Rank'][g][seat]), len(players),
+                                float(result['Score'][g][seat]), delta,
+                                quarters[g], row[0]))
+                deltas.append((row[2], delta))
+            for row in unused[g]:
+                updates.append((int(result['unusedRank'][g]), len(players),
+                                0, 0, quarters[g], row[0]))
+            dates.add(date)
+        for player, delta in deltas:
+            if player != unusedPointsPlayerID:
+                before[player][0] += delta or 0
+                before[player][1] += 1
+
+    with db.getCur() as cur:
+        cur.executemany(
+            "UPDATE Scores SET Rank = ?, PlayerCount = ?, Score = ?,"
+            "  DeltaRating = ?, Quarter = ? WHERE Id = ?", updates)
+    importgames.regenerate(list(dates))
+    jobs.wait()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+import sys
 import random
 import string
 import operator
+import importlib
+import importlib.util
 from quemail import QueMail, Email
 
 import settings
+import db
+import outbox
 
 def stringify(x):
     if x is None or isinstance(x, str):
@@ -15,14 +20,71 @@ def stringify(x):
     else:
         return str(x)
 
+class LazyModule():
+    "Stand-in for a module that imports it when an attribute is first used"
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+def lazy_import(name, optional=False):
+    """Return the named module without loading it until one of its
+    attributes is first used.  This keeps slow modules from delaying
+    startup.  If the module isn't installed, ImportError is raised, or
+    None is returned if it is optional."""
+    if name in sys.modules:
+        return sys.modules[name]
+    # Finding a submodule would import its parent packages, so only the
+    # top level package is looked for
+    try:
+        found = importlib.util.find_spec(name.partition('.')[0]) is not None
+    except (ImportError, ValueError):
+        found = False
+    if not found:
+        if optional:
+            return None
+        raise ImportError('No module named {!r}'.format(name), name=name)
+    return LazyModule(name)
+
+async def as_async(items):
+    "Generate the items of an iterable or asynchronous iterable asynchronously"
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+async def async_groupby(items, key):
+    """Generate (key, list of items) pairs for the runs of consecutive items
+    with the same key in an asynchronous iterable, like itertools.groupby"""
+    group, groupKey = [], None
+    async for item in items:
+        itemKey = key(item)
+        if group and itemKey != groupKey:
+            yield groupKey, group
+            group = []
+        group.append(item)
+        groupKey = itemKey
+    if group:
+        yield groupKey, group
+
 def randString(length):
     return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for x in range(length))
 
-def sendEmail(toaddr, subject, body):
+def sendEmail(toaddr, subject, body, cur=None):
+    """Queue an email in the Outbox table for the QueMail thread to send.
+    If the cursor of an open transaction is given, the email is queued in
+    it and only sent if it is committed."""
     fromaddr = settings.EMAILFROM
-
-    qm = QueMail.get_instance()
-    qm.send(Email(subject=subject, text=body, adr_to=toaddr, adr_from=fromaddr, mime_type='html'))
+    eml = Email(subject=subject, text=body, adr_to=toaddr, adr_from=fromaddr,
+                mime_type='html')
+    if cur is None:
+        with db.getCur() as cur:
+            return sendEmail(toaddr, subject, body, cur)
+    outbox.enqueue(cur, [eml])
+    cur.getCur.onCommit.append(QueMail.get_instance().notify)
 
 def prompt(msg, default=None):
     resp = None
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
-import handler
+import json
+import time
 import os.path
-try:
-    from pygit2 import Repository
-except:
+
+import handler
+import util
+import settings
+
+# pygit2 is only loaded when the version is first looked up
+pygit2 = util.lazy_import('pygit2', optional=True)
+if pygit2 is None:
     import collections
     authorRecord = collections.namedtuple('Author', 'name, email')
     committerRecord = collections.namedtuple('Committer', 'name, email')
@@ -20,24 +26,35 @@ except:
         def __init__(self, filename=None):
             self.head = Node()
 
-class VersionHandler(handler.BaseHandler):
-    def get(self):
-        version = 'Unknown'
-        description = ''
-        author = ''
-        committer = ''
+_info = None
+_expires = 0
+
+def commit_info():
+    """Return a dictionary describing the commit the site is running.
+    Opening the repository can be slow, so the result is kept for
+    VERSIONCACHESECONDS before it is read again."""
+    global _info, _expires
+    if _info is None or time.time() >= _expires:
+        info = {'version': 'Unknown', 'description': '', 'author': '',
+                'committer': ''}
         try:
-            commit = Repository(os.path.dirname(__file__)).head.get_object()
-            version = commit.id
-            description = commit.message
-            author = commit.author.name
-            committer = commit.committer.name
+            commit = (pygit2.Repository if pygit2 else Repository)(
+                os.path.dirname(__file__)).head.get_object()
+            info['version'] = str(commit.id)
+            info['description'] = commit.message
+            info['author'] = commit.author.name
+            info['committer'] = commit.committer.name
         except:
             pass
-        self.render(
-            "version.html",
-            version=version,
-            description=description,
-            author=author,
-            committer=committer
-        )
+        _info = info
+        _expires = time.time() + settings.VERSIONCACHESECONDS
+    return _info
+
+class VersionHandler(handler.BaseHandler):
+    def get(self):
+        self.render("version.html", **commit_info())
+
+class VersionDataHandler(handler.BaseHandler):
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(commit_info()))